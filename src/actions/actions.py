@@ -29,6 +29,12 @@ import charmhelpers.core as ch_core
 import charms_openstack.bus
 import charms_openstack.charm as charm
 
+import charm.openstack.batch as batch
+import charm.openstack.fanout as fanout
+import charm.openstack.history as history
+import charm.openstack.profiling as profiling
+import charm.openstack.sizing as sizing
+
 # load reactive interfaces
 reactive.bus.discover()
 
@@ -41,14 +47,70 @@ def retrofit_image(*args):
     keystone_endpoint = reactive.endpoint_from_flag(
         'identity-credentials.available')
     with charm.provide_charm_instance() as instance:
-        instance.retrofit(
+        appliance_sizing = instance.appliance_sizing()
+        ch_core.hookenv.action_set(sizing.action_results(appliance_sizing))
+        uploads = instance.retrofit(
             keystone_endpoint,
             ch_core.hookenv.action_get('force'),
-            ch_core.hookenv.action_get('source-image'))
+            ch_core.hookenv.action_get('source-image'),
+            appliance_sizing=appliance_sizing,
+            profile=ch_core.hookenv.action_get('profile'))
+    ch_core.hookenv.action_set(fanout.action_results(uploads))
+    failed = [str(region) for region, result in uploads.items()
+              if result.error]
+    if failed:
+        ch_core.hookenv.action_fail('upload failed for regions: {}'
+                                    .format(', '.join(failed)))
+
+
+def retrofit_batch(*args):
+    """Retrofit images for configured series and architectures."""
+    keystone_endpoint = reactive.endpoint_from_flag(
+        'identity-credentials.available')
+    with charm.provide_charm_instance() as instance:
+        appliance_sizing = instance.appliance_sizing(
+            workers=instance.config['batch-build-workers'])
+        ch_core.hookenv.action_set(sizing.action_results(appliance_sizing))
+        items = instance.retrofit_batch(
+            keystone_endpoint,
+            ch_core.hookenv.action_get('force'),
+            appliance_sizing=appliance_sizing)
+    ch_core.hookenv.action_set(batch.action_results(items))
+    failed = [item.key for item in items
+              if item.status == batch.STATUS_FAILED]
+    if failed:
+        ch_core.hookenv.action_fail('retrofitting failed for: {}'
+                                    .format(', '.join(failed)))
+
+
+def show_retrofit_history(*args):
+    """Show recent retrofit runs and percentiles of their phases."""
+    with charm.provide_charm_instance() as instance:
+        entries = instance.run_history()
+    ch_core.hookenv.action_set(history.action_results(
+        entries, limit=ch_core.hookenv.action_get('limit')))
+
+
+def show_retrofit_profile(*args):
+    """Show hottest functions and peak memory of last profiled run."""
+    summary = profiling.last_profile(profiling.PROFILE_DIR)
+    if not summary:
+        ch_core.hookenv.action_fail('no profiled retrofit run found, run '
+                                    'retrofit-image with profile=true')
+        return
+    limit = ch_core.hookenv.action_get('limit')
+    functions = profiling.hottest_functions(
+        summary['pstats'], sort=ch_core.hookenv.action_get('sort'),
+        limit=limit or None)
+    ch_core.hookenv.action_set(profiling.action_results(
+        summary, functions, limit=limit))
 
 
 ACTIONS = {
     'retrofit-image': retrofit_image,
+    'retrofit-batch': retrofit_batch,
+    'show-retrofit-history': show_retrofit_history,
+    'show-retrofit-profile': show_retrofit_profile,
 }
 
 
@@ -0,0 +1,54 @@
+#!/usr/bin/env python3
+# Copyright 2022 Canonical Ltd
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#  http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+# Entry points run outside of any hook context that only need the charm
+# venv, not the reactive framework.  Must be run from the charm directory
+# through one of the links named in ENTRY_POINTS.
+
+import importlib
+import os
+import sys
+
+# Load basic layer module from $CHARM_DIR/lib
+sys.path.append('lib')
+from charms.layer import basic
+
+# setup module loading from charm venv without bootstrapping the charm
+basic.activate_venv()
+
+ENTRY_POINTS = {
+    # Builds the libguestfs appliance into the persistent cache and records
+    # cold and warm start timings, spawned detached from hooks.
+    'prewarm-appliance.py': 'charm.openstack.appliance',
+    # Exits 0 when there is no retrofit work pending, non-zero otherwise.
+    'retrofit-precheck.py': 'charm.openstack.precheck',
+    # Listens for Glance notifications about new cloud images and starts
+    # image retrofitting for them, run by systemd on the leader.
+    'notification-listener.py': 'charm.openstack.notifications',
+}
+
+
+def main(args):
+    name = os.path.basename(args[0])
+    try:
+        module = ENTRY_POINTS[name]
+    except KeyError:
+        return 'Entry point {} is undefined'.format(name)
+    # only import the module of the entry point to keep startup fast
+    return importlib.import_module(module).main(args)
+
+
+if __name__ == '__main__':
+    sys.exit(main(sys.argv))
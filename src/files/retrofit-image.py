@@ -47,7 +47,11 @@ def retrofit_image():
         try:
             ch_core.hookenv.log('Starting image retrofitting...',
                                 level=ch_core.hookenv.INFO)
-            instance.retrofit(keystone_endpoint)
+            profile = instance.config['profile-auto-retrofit']
+            if instance.batch_matrix():
+                instance.retrofit_batch(keystone_endpoint, profile=profile)
+            else:
+                instance.retrofit(keystone_endpoint, profile=profile)
             ch_core.hookenv.log('Image retrofitting completed.',
                                 level=ch_core.hookenv.INFO)
         except DestinationImageExists as e:
@@ -63,6 +67,9 @@ def main(args):
         ch_core.hookenv.log('Image retrofitting failed: "{}" "{}"'
                             .format(str(e), traceback.format_exc()),
                             level=ch_core.hookenv.ERROR)
+    finally:
+        # Remove the scratch files of the run, as the action entry points do.
+        ch_core.hookenv._run_atexit()
 
 
 if __name__ == '__main__':
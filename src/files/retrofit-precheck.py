@@ -0,0 +1 @@
+entry-points.py
\ No newline at end of file
@@ -0,0 +1,221 @@
+# Copyright 2022 Canonical Ltd
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#  http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Persistent libguestfs appliance cache for the retrofit tool."""
+
+import fcntl
+import json
+import os
+import shutil
+import subprocess
+import sys
+import time
+
+import charm.openstack.precheck as precheck
+import charm.openstack.supervisor as supervisor
+
+CACHE_ROOT = '/var/snap/octavia-diskimage-retrofit/common/libguestfs-cache'
+TIMINGS_FILE = 'timings.json'
+LOCK_FILE = '.prewarm.lock'
+# Written once a pre-warm of the revision has succeeded.
+PREWARMED_FILE = '.prewarmed'
+PREWARM_SCRIPT = './files/prewarm-appliance.py'
+PREWARM_TIMEOUT = 1800
+# Boots the appliance, which builds it into ``LIBGUESTFS_CACHEDIR`` when
+# not already there.
+TEST_TOOL_CMD = ['snap', 'run', '--shell', 'octavia-diskimage-retrofit',
+                 '-c', 'exec libguestfs-test-tool']
+
+
+def cache_dir(snap_revision, root=CACHE_ROOT):
+    """Get appliance cache directory for a revision of the snap.
+
+    :param snap_revision: Revision of ``octavia-diskimage-retrofit`` snap
+    :type snap_revision: Optional[str]
+    :param root: Directory holding the caches of all revisions
+    :type root: str
+    :rtype: str
+    """
+    return os.path.join(root, snap_revision or 'unknown')
+
+
+def prepare(snap_revision, root=CACHE_ROOT):
+    """Create cache directory.
+
+    :param snap_revision: Revision of ``octavia-diskimage-retrofit`` snap
+    :type snap_revision: Optional[str]
+    :param root: Directory holding the caches of all revisions
+    :type root: str
+    :returns: Path to cache directory
+    :rtype: str
+    """
+    path = cache_dir(snap_revision, root)
+    os.makedirs(path, exist_ok=True)
+    return path
+
+
+def remove_stale(snap_revision, root=CACHE_ROOT):
+    """Remove caches of other snap revisions.
+
+    An appliance built by another revision of the snap may not match the
+    libguestfs it ships.
+
+    :param snap_revision: Revision of ``octavia-diskimage-retrofit`` snap
+    :type snap_revision: Optional[str]
+    :param root: Directory holding the caches of all revisions
+    :type root: str
+    """
+    path = cache_dir(snap_revision, root)
+    for entry in os.listdir(root):
+        stale = os.path.join(root, entry)
+        if stale != path and os.path.isdir(stale):
+            shutil.rmtree(stale, ignore_errors=True)
+
+
+def is_prewarmed(snap_revision, root=CACHE_ROOT):
+    """Check whether a pre-warm of a snap revision has succeeded.
+
+    :param snap_revision: Revision of ``octavia-diskimage-retrofit`` snap
+    :type snap_revision: Optional[str]
+    :param root: Directory holding the caches of all revisions
+    :type root: str
+    :rtype: bool
+    """
+    return os.path.exists(os.path.join(cache_dir(snap_revision, root),
+                                       PREWARMED_FILE))
+
+
+def is_warm(path):
+    """Check whether an appliance has been built into cache directory.
+
+    :param path: Path to cache directory
+    :type path: str
+    :rtype: bool
+    """
+    try:
+        return bool(os.listdir(
+            os.path.join(path, '.guestfs-{}'.format(os.getuid()))))
+    except OSError:
+        return False
+
+
+def environment(snap_revision, root=CACHE_ROOT):
+    """Environment variables making libguestfs use the persistent cache.
+
+    :param snap_revision: Revision of ``octavia-diskimage-retrofit`` snap
+    :type snap_revision: Optional[str]
+    :param root: Directory holding the caches of all revisions
+    :type root: str
+    :rtype: Dict[str, str]
+    """
+    return {'LIBGUESTFS_CACHEDIR': prepare(snap_revision, root)}
+
+
+def read_timings(snap_revision, root=CACHE_ROOT):
+    """Read timings recorded by ``prewarm``.
+
+    :param snap_revision: Revision of ``octavia-diskimage-retrofit`` snap
+    :type snap_revision: Optional[str]
+    :param root: Directory holding the caches of all revisions
+    :type root: str
+    :returns: Seconds taken by a 'cold' and a 'warm' appliance start
+    :rtype: Dict[str, float]
+    """
+    try:
+        with open(os.path.join(cache_dir(snap_revision, root),
+                               TIMINGS_FILE)) as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return {}
+
+
+def prewarm(snap_revision, root=CACHE_ROOT):
+    """Build the appliance into the cache and time cold and warm starts.
+
+    Only one pre-warm runs at a time, a concurrent call returns at once.
+    The caches of other snap revisions are removed first and the revision
+    is marked as pre-warmed on success.  Sizing of the appliance is taken
+    from the environment.
+
+    :param snap_revision: Revision of ``octavia-diskimage-retrofit`` snap
+    :type snap_revision: Optional[str]
+    :param root: Directory holding the caches of all revisions
+    :type root: str
+    :returns: Timings or None if another pre-warm is running
+    :rtype: Optional[Dict[str, float]]
+    :raises: subprocess.CalledProcessError, subprocess.TimeoutExpired
+    """
+    env = os.environ.copy()
+    env.update(environment(snap_revision, root))
+    path = env['LIBGUESTFS_CACHEDIR']
+    with open(os.path.join(path, LOCK_FILE), 'w') as lock:
+        try:
+            fcntl.flock(lock, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except BlockingIOError:
+            return None
+        remove_stale(snap_revision, root)
+        timings = read_timings(snap_revision, root)
+        for kind in ('warm',) if is_warm(path) else ('cold', 'warm'):
+            start = time.monotonic()
+            supervisor.run(TEST_TOOL_CMD, env=env,
+                           name='appliance-prewarm',
+                           timeout=PREWARM_TIMEOUT)
+            timings[kind] = round(time.monotonic() - start, 1)
+        with open(os.path.join(path, TIMINGS_FILE), 'w') as f:
+            json.dump(timings, f, sort_keys=True)
+        with open(os.path.join(path, PREWARMED_FILE), 'w') as f:
+            f.write(snap_revision or '')
+    return timings
+
+
+def spawn_prewarm(charm_dir, envvars=None):
+    """Pre-warm the appliance in a process detached from the hook.
+
+    :param charm_dir: Directory of the charm
+    :type charm_dir: str
+    :param envvars: Environment variables to add for the pre-warm, such as
+                    the sizing of the appliance
+    :type envvars: Optional[Dict[str, str]]
+    """
+    env = os.environ.copy()
+    env.update(envvars or {})
+    subprocess.Popen([PREWARM_SCRIPT], cwd=charm_dir, env=env,
+                     stdin=subprocess.DEVNULL, stdout=subprocess.DEVNULL,
+                     stderr=subprocess.DEVNULL, start_new_session=True)
+
+
+def main(args):
+    """Pre-warm the appliance for the installed snap revision.
+
+    :param args: Command line arguments
+    :type args: List[str]
+    :returns: Exit code
+    :rtype: int
+    """
+    try:
+        timings = prewarm(precheck.get_snap_revision())
+    except Exception as e:
+        supervisor.log('appliance-prewarm',
+                       'Pre-warming appliance failed: {}'.format(str(e)))
+        print('Pre-warming appliance failed: {}'.format(str(e)),
+              file=sys.stderr)
+        return 1
+    if timings is None:
+        print('Pre-warming appliance already in progress')
+    else:
+        supervisor.log('appliance-prewarm',
+                       'Appliance start timings: {}'.format(timings))
+        for kind, seconds in sorted(timings.items()):
+            print('{} appliance start: {:.1f}s'.format(kind, seconds))
+    return 0
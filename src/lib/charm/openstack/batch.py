@@ -0,0 +1,247 @@
+# Copyright 2022 Canonical Ltd
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#  http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import collections
+import concurrent.futures
+import heapq
+import itertools
+import os
+import re
+
+import charmhelpers.core as ch_core
+
+NETWORK, BUILD = 'network', 'build'
+STATUS_PENDING = 'pending'
+STATUS_CREATED = 'created'
+STATUS_UP_TO_DATE = 'up-to-date'
+STATUS_NOT_FOUND = 'not-found'
+STATUS_FAILED = 'failed'
+
+
+class BatchItem(object):
+    """One series and architecture combination of a batch retrofit."""
+
+    def __init__(self, series, release, arch):
+        self.series = series
+        self.release = release
+        self.arch = arch
+        self.status = STATUS_PENDING
+        self.message = ''
+        self.source_image = None
+        self.uca_pocket = None
+        self.fingerprints = {}
+        self.regions = []
+        self.disk_formats = {}
+        self.input_path = None
+        self.source_digests = None
+        self.output_path = None
+        self.image_id = None
+        self.upload_digests = None
+
+    @property
+    def key(self):
+        return '{}-{}'.format(self.series, self.arch)
+
+    def result(self):
+        """Result of item for use as action output.
+
+        :rtype: Dict[str, str]
+        """
+        result = {'status': self.status}
+        if self.image_id:
+            result['image-id'] = self.image_id
+        if self.message:
+            result['message'] = self.message
+        return result
+
+
+def action_key(label):
+    """Make label usable as a segment of an ``action_set`` key.
+
+    Juju only accepts lower case letters, digits and inner dashes.
+
+    :param label: Label, for example a region name
+    :type label: Optional[str]
+    :rtype: str
+    """
+    return re.sub('[^a-z0-9]+', '-', (label or '').lower()).strip(
+        '-') or 'default'
+
+
+def action_results(items):
+    """Flatten item results into keys for ``action_set``.
+
+    :param items: Items of batch
+    :type items: Iterable[BatchItem]
+    :rtype: Dict[str, str]
+    """
+    results = {}
+    for item in items:
+        for key, value in item.result().items():
+            results['results.{}.{}'.format(
+                action_key(item.key), key)] = value
+    return results
+
+
+def free_space(path):
+    """Get space available to unprivileged users on file system of path.
+
+    :param path: Path on file system
+    :type path: str
+    :returns: Free space in bytes or None if it can not be determined
+    :rtype: Optional[int]
+    """
+    try:
+        st = os.statvfs(path)
+    except OSError:
+        return None
+    return st.f_bavail * st.f_frsize
+
+
+class BatchScheduler(object):
+    """Run batch items through a pipeline of stages.
+
+    Each stage runs on the worker pool of the resource it is bound by, so
+    that for example downloading one image and uploading another overlaps
+    with a long running retrofit of a third.  When a worker becomes free it
+    picks up the item furthest along the pipeline first, which drains
+    finished work before new work is started.
+
+    The number of items admitted to the pipeline is bounded, and an item is
+    only admitted when the scratch space it needs fits in the space
+    available at the start of the run, less the space reserved by items
+    already in the pipeline.  Space is measured once, as the files items in
+    the pipeline are writing already count against free space measured
+    later.  The reservation of an item is only given back once its files
+    are removed, space taken by files it leaves behind stays reserved for
+    the rest of the run.  A failing stage fails its item only, the
+    remaining items carry on.
+    """
+
+    def __init__(self, network_workers=1, build_workers=1,
+                 max_in_flight=None, scratch_dir=None, space_available=None):
+        self.workers = {
+            NETWORK: max(network_workers or 1, 1),
+            BUILD: max(build_workers or 1, 1),
+        }
+        # Enough to keep every worker busy with one item waiting per pool.
+        self.max_in_flight = max_in_flight or (
+            sum(self.workers.values()) + len(self.workers))
+        self.scratch_dir = scratch_dir
+        # Space available may be limited further than by the file system,
+        # for example by a quota.
+        self.space_available = space_available or (
+            lambda: free_space(self.scratch_dir))
+
+    def run(self, items, stages, space_needed=None, cleanup=None):
+        """Run pending items through stages.
+
+        :param items: Items to process, only pending ones are run
+        :type items: Iterable[BatchItem]
+        :param stages: Sequence of (pool, callable) tuples, the callable is
+                       passed the item and stores its results on it
+        :type stages: Sequence[Tuple[str, Callable[[BatchItem], None]]]
+        :param space_needed: Callable returning scratch space in bytes an
+                             item needs until it leaves the pipeline
+        :type space_needed: Optional[Callable[[BatchItem], int]]
+        :param cleanup: Callable removing the scratch files of an item
+                        leaving the pipeline, whether it succeeded or
+                        failed, and returning the space in bytes its files
+                        kept still take up
+        :type cleanup: Optional[Callable[[BatchItem], int]]
+        """
+        pools = {name: concurrent.futures.ThreadPoolExecutor(workers)
+                 for name, workers in self.workers.items()}
+        busy = {name: 0 for name in pools}
+        ready = {name: [] for name in pools}
+        waiting = collections.deque(
+            item for item in items if item.status == STATUS_PENDING)
+        reserved = {}
+        running = {}
+        sequence = itertools.count()
+        space = {'kept': 0}
+
+        def queue(item, stage):
+            heapq.heappush(ready[stages[stage][0]],
+                           (-stage, next(sequence), stage, item))
+
+        def admit():
+            while waiting and len(reserved) < self.max_in_flight:
+                item = waiting[0]
+                need = space_needed(item) if space_needed else 0
+                if self.scratch_dir and need and 'available' not in space:
+                    space['available'] = self.space_available()
+                available = space.get('available')
+                if (reserved and available is not None and
+                        need + sum(reserved.values()) + space['kept'] >
+                        available):
+                    ch_core.hookenv.log('Waiting for {} bytes of scratch '
+                                        'space for "{}"'
+                                        .format(need, item.key),
+                                        level=ch_core.hookenv.DEBUG)
+                    return
+                waiting.popleft()
+                reserved[item] = need
+                queue(item, 0)
+
+        def release(item):
+            need = reserved[item]
+            if cleanup:
+                try:
+                    kept = cleanup(item) or 0
+                except Exception as e:
+                    ch_core.hookenv.log('Removing files of "{}" failed: "{}"'
+                                        .format(item.key, str(e)),
+                                        level=ch_core.hookenv.ERROR)
+                    kept = need
+                space['kept'] += min(kept, need)
+            del reserved[item]
+
+        def dispatch():
+            for name, heap in ready.items():
+                while heap and busy[name] < self.workers[name]:
+                    _, _, stage, item = heapq.heappop(heap)
+                    busy[name] += 1
+                    running[pools[name].submit(stages[stage][1], item)] = (
+                        item, stage)
+
+        try:
+            admit()
+            dispatch()
+            while running:
+                done, _ = concurrent.futures.wait(
+                    running, return_when=concurrent.futures.FIRST_COMPLETED)
+                for future in done:
+                    item, stage = running.pop(future)
+                    busy[stages[stage][0]] -= 1
+                    try:
+                        future.result()
+                    except Exception as e:
+                        ch_core.hookenv.log('Retrofitting "{}" failed: "{}"'
+                                            .format(item.key, str(e)),
+                                            level=ch_core.hookenv.ERROR)
+                        item.status = STATUS_FAILED
+                        item.message = str(e)
+                        release(item)
+                        continue
+                    if stage + 1 < len(stages):
+                        queue(item, stage + 1)
+                    else:
+                        item.status = STATUS_CREATED
+                        release(item)
+                admit()
+                dispatch()
+        finally:
+            for pool in pools.values():
+                pool.shutdown(wait=True)
@@ -0,0 +1,284 @@
+# Copyright 2022 Canonical Ltd
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#  http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import concurrent.futures
+import os
+import queue
+import threading
+import time
+
+import charm.openstack.batch as batch
+import charm.openstack.glance_retrofitter as glance_retrofitter
+import charm.openstack.progress as progress
+import charm.openstack.sparse_io as sparse_io
+import charm.openstack.ratelimit as ratelimit
+
+# Number of chunks buffered for each reader, bounds memory use to
+# ``WINDOW * glance_retrofitter.CHUNK_SIZE`` as chunks are shared.
+WINDOW = 16
+POLL_INTERVAL = 0.1
+MIB = 1024 * 1024
+METHOD_UPLOAD, METHOD_IMPORT = 'upload', 'import'
+
+
+class FanOutReader(object):
+    """File object reading the data shared by a ``FanOut``."""
+
+    def __init__(self, window):
+        self.queue = queue.Queue(window)
+        self.closed = threading.Event()
+        self.buffer = memoryview(b'')
+        self.eof = False
+        self.error = None
+
+    def put(self, item):
+        """Hand chunk or error to reader, blocking while its window is full.
+
+        :param item: Chunk of data, empty at end of file, or read error
+        :type item: Union[bytes, Exception]
+        :returns: Whether the reader still consumes data
+        :rtype: bool
+        """
+        while not self.closed.is_set():
+            try:
+                self.queue.put(item, timeout=POLL_INTERVAL)
+                return True
+            except queue.Full:
+                pass
+        return False
+
+    def close(self):
+        """Stop consuming data, unblocking the ``FanOut``."""
+        self.closed.set()
+
+    def read(self, size=-1):
+        if size is None or size < 0:
+            chunks = []
+            for chunk in iter(
+                    lambda: self.read(glance_retrofitter.CHUNK_SIZE), b''):
+                chunks.append(chunk)
+            return b''.join(chunks)
+        if self.error:
+            raise self.error
+        if not self.buffer and not self.eof:
+            item = self.queue.get()
+            if isinstance(item, Exception):
+                self.error = glance_retrofitter.TransferError(
+                    'reading image data failed: {}'.format(str(item)))
+                raise self.error
+            self.eof = not item
+            self.buffer = memoryview(item)
+        data = bytes(self.buffer[:size])
+        self.buffer = self.buffer[size:]
+        return data
+
+
+class FanOut(object):
+    """Share a single read of a file object between several readers.
+
+    Every chunk is read once and handed to all readers.  As each reader
+    buffers at most ``window`` chunks, the slowest reader paces reading
+    instead of the file piling up in memory.  Readers that are closed, for
+    example because their upload failed, no longer hold the others up.
+    """
+
+    def __init__(self, fileobj, names, hasher=None,
+                 chunk_size=glance_retrofitter.CHUNK_SIZE, window=WINDOW):
+        """Initialize fan-out.
+
+        :param fileobj: File object to read
+        :type fileobj: io.RawIOBase
+        :param names: Names of readers to create
+        :type names: Iterable[Any]
+        :param hasher: Updated with all data read
+        :type hasher: Optional[glance_retrofitter.MultiHasher]
+        :param chunk_size: Size of chunks to read
+        :type chunk_size: int
+        :param window: Number of chunks to buffer for each reader
+        :type window: int
+        """
+        self.fileobj = fileobj
+        self.hasher = hasher
+        self.chunk_size = chunk_size
+        self.readers = {name: FanOutReader(window) for name in names}
+        self.error = None
+
+    def pump(self):
+        """Read file to its end, handing each chunk to all readers.
+
+        A read error is handed to the readers and kept in ``error``.
+
+        :returns: Number of bytes read
+        :rtype: int
+        """
+        size = 0
+        try:
+            while True:
+                chunk = self.fileobj.read(self.chunk_size)
+                if self.hasher:
+                    self.hasher.update(chunk)
+                size += len(chunk)
+                consumed = [reader.put(chunk)
+                            for reader in self.readers.values()]
+                if not (chunk and any(consumed)):
+                    break
+        except Exception as e:
+            self.error = e
+            for reader in self.readers.values():
+                reader.put(e)
+        return size
+
+
+class UploadResult(object):
+    """Outcome of uploading image data to one Glance."""
+
+    def __init__(self, image_id=None, error=None):
+        self.image_id = image_id
+        self.error = error
+        self.method = METHOD_UPLOAD
+        self.digests = None
+        self.size = 0
+        self.seconds = 0.0
+        self.attempts = 0
+
+    @property
+    def throughput(self):
+        """Upload throughput in MiB/s.
+
+        :rtype: float
+        """
+        if not self.seconds:
+            return 0.0
+        return self.size / MIB / self.seconds
+
+    def result(self):
+        """Result for reporting.
+
+        :rtype: Dict[str, str]
+        """
+        result = {'attempts': str(self.attempts), 'method': self.method}
+        if self.error:
+            result['error'] = str(self.error) or type(self.error).__name__
+        else:
+            result['image-id'] = self.image_id
+            result['throughput'] = '{:.1f} MiB/s'.format(self.throughput)
+        return result
+
+
+def upload(targets, path, hash_algo=None, window=WINDOW, imports=None,
+           throttle=None, meter=None):
+    """Upload image data to several Glance images from a single read.
+
+    Uploads run concurrently, a failing upload does not affect the others.
+    The data is hashed once while it is read and verified against the
+    checksum each Glance reports for its image afterwards.  Holes in the
+    file are not read from disk.
+
+    Targets listed in ``imports`` have the data staged and imported with
+    ``glance_retrofitter.import_image``, the others have it uploaded
+    through the API.
+
+    With ``throttle`` the single read is rate limited, which limits each
+    of the concurrent uploads to that rate.  With ``meter`` the progress of
+    the read, which the slowest upload paces, is reported.  A stall
+    detected by the meter fails all uploads.
+
+    :param targets: Glance client and ID of image to upload to, keyed by name
+    :type targets: Dict[Any, Tuple[glanceclient.Client, str]]
+    :param path: Path to file with image data
+    :type path: str
+    :param hash_algo: Hash algorithm used by Glance, default 'sha512'
+    :type hash_algo: Optional[str]
+    :param window: Number of chunks to buffer for each upload
+    :type window: int
+    :param imports: Keyword arguments for ``import_image`` keyed by name
+    :type imports: Optional[Dict[Any, Dict[str, Any]]]
+    :param throttle: Limits the rate data is read at
+    :type throttle: Optional[ratelimit.TokenBucket]
+    :param meter: Updated with the data read, restarted with the size of
+                  the file as total
+    :type meter: Optional[progress.ProgressMeter]
+    :returns: Result of each upload keyed by name
+    :rtype: Dict[Any, UploadResult]
+    """
+    imports = imports or {}
+    results = {name: UploadResult(image_id)
+               for name, (_, image_id) in targets.items()}
+    for name in imports:
+        if name in results:
+            results[name].method = METHOD_IMPORT
+    if not targets:
+        return results
+    hasher = glance_retrofitter.MultiHasher(
+        (hash_algo or glance_retrofitter.DEFAULT_HASH_ALGO,))
+    with open(path, 'rb') as fin:
+        reader = sparse_io.SparseReader(fin)
+        if throttle:
+            reader = ratelimit.ThrottledReader(reader, throttle)
+        if meter:
+            meter.total = os.fstat(fin.fileno()).st_size
+            meter.restart()
+            reader = progress.MeteredReader(reader, meter)
+        fanout = FanOut(reader, targets, hasher=hasher, window=window)
+
+        def _upload(name):
+            glance, image_id = targets[name]
+            reader = fanout.readers[name]
+            start = time.monotonic()
+            try:
+                if name in imports:
+                    glance_retrofitter.import_image(glance, image_id, reader,
+                                                    **imports[name])
+                else:
+                    glance.images.upload(image_id, reader)
+            except Exception as e:
+                results[name].error = e
+            finally:
+                reader.close()
+                results[name].seconds = time.monotonic() - start
+
+        with concurrent.futures.ThreadPoolExecutor(
+                max_workers=len(targets)) as executor:
+            for name in targets:
+                executor.submit(_upload, name)
+            size = fanout.pump()
+    digests = hasher.hexdigests()
+    for name, result in results.items():
+        if fanout.error and not result.error:
+            result.error = fanout.error
+        if result.error:
+            continue
+        glance, image_id = targets[name]
+        result.size = size
+        try:
+            glance_retrofitter.verify_digests(
+                glance_retrofitter.image_digests(glance.images.get(image_id)),
+                digests, 'uploaded image "{}"'.format(image_id))
+        except Exception as e:
+            result.error = e
+            continue
+        result.digests = digests
+    return results
+
+
+def action_results(results):
+    """Upload results as keys for ``action_set``.
+
+    :param results: Results as returned by ``upload`` keyed by region
+    :type results: Dict[Optional[str], UploadResult]
+    :rtype: Dict[str, str]
+    """
+    return {'regions.{}.{}'.format(batch.action_key(region), field): value
+            for region, result in results.items()
+            for field, value in result.result().items()}
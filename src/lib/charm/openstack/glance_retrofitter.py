@@ -12,42 +12,300 @@
 # See the License for the specific language governing permissions and
 # limitations under the License.
 
+import concurrent.futures
+import contextlib
+import hashlib
+import json
+import os
 import subprocess
+import threading
+import time
 
 import glanceclient
 import keystoneauth1.loading
 import keystoneauth1.session
 
+import charmhelpers.core as ch_core
+
+import charm.openstack.sparse_io as sparse_io
+
 SYSTEM_CA_BUNDLE = '/etc/ssl/certs/ca-certificates.crt'
+IMAGE_DATA_URL = '/v2/images/{}/file'
+HTTP_PARTIAL_CONTENT = 206
+CHUNK_SIZE = 1024 * 1024
+DEFAULT_HASH_ALGO = 'sha512'
+IMPORT_METHOD = 'glance-direct'
+IMPORT_TIMEOUT = 3600
+IMPORT_POLL_INTERVAL, IMPORT_POLL_MAX_INTERVAL = 2, 30
+DOWNLOAD_ATTEMPTS = 5
+DOWNLOAD_RETRY_INTERVAL, DOWNLOAD_RETRY_MAX_INTERVAL = 2, 60
+# Amount of downloaded data between updates of the download journal.
+JOURNAL_INTERVAL = 64 * CHUNK_SIZE
+JOURNAL_SUFFIX = '.journal'
+# Upper bound for data of a segmented download held in memory until the
+# data before it has arrived and it can be hashed.
+REORDER_BUFFER_SIZE = 256 * CHUNK_SIZE
+REORDER_POLL_INTERVAL = 0.1
 
 
-def session_from_identity_credentials(identity_credentials):
-    """Get Keystone Session from ``identity-credentials`` relation.
+class RangeRequestNotSupported(Exception):
+    pass
+
+
+class TransferError(Exception):
+    pass
+
+
+class ChecksumMismatch(TransferError):
+    pass
+
+
+class ImportFailed(TransferError):
+    pass
+
+
+class MultiHasher(object):
+    """Compute digests of several hash algorithms in a single pass."""
+
+    def __init__(self, algorithms):
+        """Initialize hashers.
+
+        Algorithms not supported by ``hashlib`` are ignored.
+
+        :param algorithms: Names of hash algorithms as used by Glance
+        :type algorithms: Iterable[str]
+        """
+        self.hashers = {}
+        for algo in algorithms:
+            try:
+                self.hashers[algo] = hashlib.new(algo)
+            except ValueError:
+                ch_core.hookenv.log('Unsupported hash algorithm "{}", not '
+                                    'verifying it'.format(algo),
+                                    level=ch_core.hookenv.WARNING)
+
+    def update(self, data):
+        for hasher in self.hashers.values():
+            hasher.update(data)
+
+    def hexdigests(self):
+        """Get digests computed so far.
+
+        :returns: Map of algorithm name to hex digest
+        :rtype: Dict[str, str]
+        """
+        return {algo: hasher.hexdigest()
+                for algo, hasher in self.hashers.items()}
+
+
+class OrderedHasher(object):
+    """Feed data arriving out of order to a hasher in file order.
+
+    Data at the offset hashed up to is hashed right away, data further
+    ahead is held in memory until the data before it has arrived.  Writers
+    ahead of that offset wait while ``max_buffered`` bytes are held, the
+    writer at the offset never waits so hashing always makes progress.
+    """
+
+    def __init__(self, hasher, offset=0, max_buffered=REORDER_BUFFER_SIZE,
+                 progress=None):
+        """Initialize hasher.
+
+        :param hasher: Hasher to feed data to
+        :type hasher: MultiHasher
+        :param offset: Offset of first byte not hashed yet
+        :type offset: int
+        :param max_buffered: Maximum bytes to hold in memory
+        :type max_buffered: int
+        :param progress: Advanced as data is hashed
+        :type progress: Optional[DownloadProgress]
+        """
+        self.hasher = hasher
+        self.offset = offset
+        self.max_buffered = max_buffered
+        self.progress = progress
+        self.pending = {}
+        self.buffered = 0
+        self.aborted = False
+        self.cond = threading.Condition()
+
+    def update(self, offset, data):
+        """Hash data written at offset, or hold it until it can be.
+
+        The data must be written to the file before, so that all data
+        before the offset hashed up to is on disk.
+
+        :param offset: Offset of data in file
+        :type offset: int
+        :param data: Data
+        :type data: bytes
+        :raises: TransferError when aborted
+        """
+        with self.cond:
+            while (offset != self.offset and not self.aborted and
+                   self.buffered and
+                   self.buffered + len(data) > self.max_buffered):
+                self.cond.wait(REORDER_POLL_INTERVAL)
+            if self.aborted:
+                raise TransferError('download aborted')
+            if offset != self.offset:
+                self.pending[offset] = data
+                self.buffered += len(data)
+                return
+            self.hasher.update(data)
+            self.offset += len(data)
+            while self.offset in self.pending:
+                data = self.pending.pop(self.offset)
+                self.buffered -= len(data)
+                self.hasher.update(data)
+                self.offset += len(data)
+            if self.progress:
+                self.progress.advance(self.offset)
+            self.cond.notify_all()
+
+    def abort(self):
+        """Release writers waiting for buffer space."""
+        with self.cond:
+            self.aborted = True
+            self.pending.clear()
+            self.buffered = 0
+            self.cond.notify_all()
+
+
+def image_digests(image):
+    """Get checksums Glance reports for image.
+
+    The multihash (``os_hash_algo``/``os_hash_value``) is preferred, the
+    legacy md5 ``checksum`` is used for images that were created before
+    Glance provided multihash.
+
+    :param image: Glance image object
+    :type image: Glance image object
+    :returns: Map of algorithm name to hex digest, empty if the image carries
+              no checksum
+    :rtype: Dict[str, str]
+    """
+    algo = getattr(image, 'os_hash_algo', None)
+    value = getattr(image, 'os_hash_value', None)
+    if algo and value:
+        return {algo: value.lower()}
+    checksum = getattr(image, 'checksum', None)
+    if checksum:
+        return {'md5': checksum.lower()}
+    return {}
+
+
+def verify_digests(expected, actual, description):
+    """Compare computed digests with the ones reported by Glance.
+
+    :param expected: Map of algorithm name to hex digest reported by Glance
+    :type expected: Dict[str, str]
+    :param actual: Map of algorithm name to computed hex digest
+    :type actual: Dict[str, str]
+    :param description: Description of data for use in error message
+    :type description: str
+    :raises: ChecksumMismatch
+    """
+    for algo, value in expected.items():
+        if algo in actual and actual[algo] != value.lower():
+            raise ChecksumMismatch(
+                '{} checksum mismatch for {}: expected "{}", got "{}"'
+                .format(algo, description, value, actual[algo]))
+    if not any(algo in actual for algo in expected):
+        ch_core.hookenv.log('Not verifying {}: checksum reported by Glance '
+                            '({}) was not computed ({})'
+                            .format(description,
+                                    ', '.join(sorted(expected)) or 'none',
+                                    ', '.join(sorted(actual)) or 'none'),
+                            level=ch_core.hookenv.WARNING)
+
+
+def upload_hash_algo(source_digests):
+    """Get hash algorithm to verify uploads with.
+
+    Glance computes the multihash of uploaded data with its configured
+    ``hashing_algorithm``, the multihash of a source image in the same
+    deployment tells which one that is.  Source images that only carry the
+    legacy md5 checksum do not, the Glance default is assumed for them.
+
+    :param source_digests: Digests of the source image
+    :type source_digests: Dict[str, str]
+    :rtype: str
+    """
+    for algo in source_digests:
+        if algo != 'md5':
+            return algo
+    return DEFAULT_HASH_ALGO
+
+
+def credentials_from_identity_credentials(identity_credentials):
+    """Get Keystone password auth options from ``identity-credentials``.
 
     :param identity_credentials: reactive Endpoint
     :type identity_credentials: RelationBase
+    :returns: Options for the Keystone ``password`` auth plugin
+    :rtype: Dict[str, str]
+    """
+    return {
+        'auth_url': '{}://{}:{}/'.format(
+            identity_credentials.auth_protocol(),
+            identity_credentials.auth_host(),
+            identity_credentials.auth_port()),
+        'user_domain_name': (
+            identity_credentials.credentials_user_domain_name()),
+        'project_domain_name': (
+            identity_credentials.credentials_project_domain_name()),
+        'project_name': identity_credentials.credentials_project(),
+        'username': identity_credentials.credentials_username(),
+        'password': identity_credentials.credentials_password(),
+    }
+
+
+def session_from_credentials(credentials, token_cache=None, timeout=None):
+    """Get Keystone Session from password auth options.
+
+    :param credentials: Options for the Keystone ``password`` auth plugin
+    :type credentials: Dict[str, str]
+    :param token_cache: Reuse token from and persist token to cache
+    :type token_cache: Optional[token_cache.TokenCache]
+    :param timeout: Seconds to wait for the server to accept or send data
+                    before a request fails, default is to wait forever
+    :type timeout: Optional[float]
     :returns: Keystone session
     :rtype: keystoneauth1.session.Session
     """
     loader = keystoneauth1.loading.get_plugin_loader('password')
-    auth = loader.load_from_options(
-        auth_url='{}://{}:{}/'
-                 .format(identity_credentials.auth_protocol(),
-                         identity_credentials.auth_host(),
-                         identity_credentials.auth_port()),
-        user_domain_name=identity_credentials.credentials_user_domain_name(),
-        project_domain_name=(
-            identity_credentials.credentials_project_domain_name()),
-        project_name=identity_credentials.credentials_project(),
-        username=identity_credentials.credentials_username(),
-        password=identity_credentials.credentials_password())
+    auth = loader.load_from_options(**credentials)
+    if token_cache:
+        token_cache.restore(auth, credentials)
     session = keystoneauth1.session.Session(
         auth=auth,
-        verify=SYSTEM_CA_BUNDLE)
+        verify=SYSTEM_CA_BUNDLE,
+        timeout=timeout)
     return session
 
 
-def get_glance_client(session, endpoint_type=None, region=None):
+def session_from_identity_credentials(identity_credentials,
+                                      token_cache=None, timeout=None):
+    """Get Keystone Session from ``identity-credentials`` relation.
+
+    :param identity_credentials: reactive Endpoint
+    :type identity_credentials: RelationBase
+    :param token_cache: Reuse token from and persist token to cache
+    :type token_cache: Optional[token_cache.TokenCache]
+    :param timeout: Seconds to wait for the server to accept or send data
+                    before a request fails, default is to wait forever
+    :type timeout: Optional[float]
+    :returns: Keystone session
+    :rtype: keystoneauth1.session.Session
+    """
+    return session_from_credentials(
+        credentials_from_identity_credentials(identity_credentials),
+        token_cache=token_cache, timeout=timeout)
+
+
+def get_glance_client(session, endpoint_type=None, region=None,
+                      token_cache=None):
     """Get Glance Client from Keystone Session.
 
     :param session: Keystone Session object
@@ -56,16 +314,38 @@ def get_glance_client(session, endpoint_type=None, region=None):
     :type endpoint_type: Optional[str]
     :param region: The OpenStack region
     :type region: Optional[str]
+    :param token_cache: Reuse endpoint from and persist endpoint to cache
+    :type token_cache: Optional[token_cache.TokenCache]
     :returns: Glance Client
     :rtype: glanceclient.Client
     """
-    endpoint = session.auth.get_endpoint(
-        session, service_type='image', interface=endpoint_type or 'publicURL',
-        region_name=region)
+    interface = endpoint_type or 'publicURL'
+    endpoint = token_cache and token_cache.endpoint(region, interface)
+    if not endpoint:
+        endpoint = session.auth.get_endpoint(
+            session, service_type='image', interface=interface,
+            region_name=region)
+        if token_cache:
+            token_cache.update(session.auth, region, interface, endpoint)
     return glanceclient.Client(
         '2', session=session, endpoint=endpoint)
 
 
+SOURCE_STREAMS = ('daily', 'released')
+SOURCE_VARIANTS = ('server', 'minimal')
+
+
+def get_architecture():
+    """Get architecture of the host as Debian would name it.
+
+    :returns: Architecture string
+    :rtype: str
+    """
+    return subprocess.check_output(
+        ['dpkg', '--print-architecture'],
+        universal_newlines=True).rstrip()
+
+
 def get_product_name(stream=None, variant=None, release=None, arch=None):
     """Build Simple Streams ``product_name`` string.
 
@@ -84,11 +364,7 @@ def get_product_name(stream=None, variant=None, release=None, arch=None):
     stream = stream or 'daily'
     variant = variant or 'server'
     release = release or '18.04'
-    arch = arch or ''
-    if not arch:
-        arch = subprocess.check_output(
-            ['dpkg', '--print-architecture'],
-            universal_newlines=True).rstrip()
+    arch = arch or get_architecture()
     if stream and stream != 'released':
         return ('com.ubuntu.cloud.{}:{}:{}:{}'
                 .format(stream, variant, release, arch))
@@ -115,22 +391,80 @@ def find_image(glance, filters):
     return candidate
 
 
-def find_destination_image(glance, product_name, version_name):
+def find_destination_image(glance, product_name, version_name,
+                           fingerprint=None):
     """Find previously retrofitted image.
 
     :param product_name: SimpleStreams ``product_name``
     :type product_name: str
     :param version_name: SimpleStreams ``version_name``
     :type version_name: str
+    :param fingerprint: Only find images retrofitted from the same inputs
+    :type fingerprint: Optional[str]
     :returns: Glance image object
     :rtype: generator
     """
-    return glance.images.list(filters={'source_product_name': product_name,
-                                       'source_version_name': version_name})
+    filters = {'source_product_name': product_name,
+               'source_version_name': version_name}
+    if fingerprint:
+        filters['retrofit_fingerprint'] = fingerprint
+    return glance.images.list(filters=filters)
+
+
+def discover_source_images(glance, releases, architectures=None):
+    """Find candidate source images in Glance in a single discovery pass.
+
+    All candidate ``product_name`` values are requested at once using the
+    ``in:`` filter operator.  Glance versions that do not support the
+    operator for image properties return no images for it, in which case
+    all Ubuntu images are listed once and filtered locally.
+
+    :param glance: Glance client
+    :type glance: glanceclient.Client
+    :param releases: Ubuntu release numbers to look for
+    :type releases: Iterable[str]
+    :param architectures: Architectures to look for, default is the
+                          architecture of the host
+    :type architectures: Optional[Iterable[str]]
+    :returns: Most recent image keyed by (stream, variant, release, arch)
+    :rtype: Dict[Tuple[str, str, str, str], Glance image object]
+    """
+    products = {}
+    for arch in architectures or (get_architecture(),):
+        for release in releases:
+            for stream in SOURCE_STREAMS:
+                for variant in SOURCE_VARIANTS:
+                    product = get_product_name(stream=stream,
+                                               variant=variant,
+                                               release=release, arch=arch)
+                    products[product] = (stream, variant, release, arch)
+
+    def _index(images):
+        index = {}
+        for image in images:
+            key = products.get(getattr(image, 'product_name', None))
+            if not key:
+                continue
+            # glance does not offer ``version_name`` as a sort key.
+            # iterate over result to make sure we get the most recent image.
+            candidate = index.get(key)
+            if not candidate or candidate.version_name < image.version_name:
+                index[key] = image
+        return index
+
+    index = _index(glance.images.list(
+        filters={'product_name': 'in:' + ','.join(sorted(products))},
+        sort_key='created_at',
+        sort_dir='desc'))
+    if not index:
+        index = _index(glance.images.list(filters={'os_distro': 'ubuntu'},
+                                          sort_key='created_at',
+                                          sort_dir='desc'))
+    return index
 
 
-def find_source_image(glance, release):
-    """Find source image in Glance.
+def find_source_image(index, release, arch=None):
+    """Find source image in index built by ``discover_source_images``.
 
     Attempts to find a image from the ``daily`` stream first and reverts to
     the ``released`` stream if none is found there.
@@ -140,34 +474,595 @@ def find_source_image(glance, release):
     the standard image and its presence being more commonplace in deployed
     clouds.
 
+    :param index: Index of candidate source images
+    :type index: Dict[Tuple[str, str, str, str], Glance image object]
     :param release: Ubuntu release number to look for
     :type release: str
+    :param arch: Architecture to look for, default is the architecture of
+                 the host
+    :type arch: Optional[str]
     :returns: Glance image object or None
     :rtype: Option[..., None]
     """
-    for stream in 'daily', 'released':
-        for variant in 'server', 'minimal':
-            product = get_product_name(stream=stream, variant=variant,
-                                       release=release)
-            image = find_image(glance, filters={'product_name': product})
+    arch = arch or get_architecture()
+    for stream in SOURCE_STREAMS:
+        for variant in SOURCE_VARIANTS:
+            image = index.get((stream, variant, release, arch))
             if image:
-                break
-        else:
-            continue
-        break
-    return image
+                return image
+    return None
+
+
+def get_image_segment(glance, image, start, end):
+    """Request a byte range of image data from Glance.
+
+    :param glance: Glance client
+    :type glance: glanceclient.Client
+    :param image: Glance image object
+    :type image: Glance image object
+    :param start: Offset of first byte to request
+    :type start: int
+    :param end: Offset of last byte to request (inclusive), None for all
+                data up to the end of the image
+    :type end: Optional[int]
+    :returns: Iterator over the chunks of the requested range
+    :rtype: Iterator[bytes]
+    :raises: RangeRequestNotSupported
+    """
+    resp, body = glance.http_client.get(
+        IMAGE_DATA_URL.format(image.id),
+        headers={'Range': 'bytes={}-{}'.format(
+            start, '' if end is None else end)})
+    if resp.status_code != HTTP_PARTIAL_CONTENT:
+        if hasattr(body, 'close'):
+            body.close()
+        raise RangeRequestNotSupported(
+            'server responded with status {} to range request'
+            .format(resp.status_code))
+    return body
 
 
-def download_image(glance, image, file_object):
+def _write_segment(glance, image, fd, start, end, throttle=None,
+                   meter=None, hasher=None):
+    """Download a byte range of image data and write it at its offset.
+
+    Blocks of zeros are not written, leaving holes in the file.  The data is
+    hashed as it is received.
+
+    :param glance: Glance client
+    :type glance: glanceclient.Client
+    :param image: Glance image object
+    :type image: Glance image object
+    :param fd: File descriptor to write data to
+    :type fd: int
+    :param start: Offset of first byte of segment
+    :type start: int
+    :param end: Offset of last byte of segment (inclusive)
+    :type end: int
+    :param throttle: Limits the rate data is received at
+    :type throttle: Optional[ratelimit.TokenBucket]
+    :param meter: Updated with the data received
+    :type meter: Optional[progress.ProgressMeter]
+    :param hasher: Fed with the data received
+    :type hasher: Optional[OrderedHasher]
+    :returns: Number of bytes skipped because they were zero
+    :rtype: int
+    :raises: RangeRequestNotSupported, TransferError,
+             progress.TransferStalled
+    """
+    offset = start
+    skipped = 0
+    for chunk in get_image_segment(glance, image, start, end):
+        if throttle:
+            throttle.consume(len(chunk))
+        if meter:
+            meter.update(len(chunk))
+        skipped += sparse_io.write_sparse(fd, chunk, offset)
+        if hasher:
+            hasher.update(offset, chunk)
+        offset += len(chunk)
+    if offset != end + 1:
+        raise TransferError(
+            'short read for segment {}-{} of image "{}": got {} bytes'
+            .format(start, end, image.id, offset - start))
+    return skipped
+
+
+def _hash_file_range(fd, hasher, start, end):
+    """Feed a range of an open file to hasher.
+
+    :param fd: File descriptor to read data from
+    :type fd: int
+    :param hasher: Hasher to update
+    :type hasher: MultiHasher
+    :param start: Offset of first byte
+    :type start: int
+    :param end: Offset of last byte (inclusive)
+    :type end: int
+    """
+    offset = start
+    while offset <= end:
+        data = os.pread(fd, min(CHUNK_SIZE, end + 1 - offset), offset)
+        if not data:
+            break
+        hasher.update(data)
+        offset += len(data)
+
+
+class DownloadJournal(object):
+    """Record of how much of a partial download is safely on disk.
+
+    The journal is kept next to the partial download so that a download
+    interrupted in one run can be continued by the next.  It names the
+    image the data belongs to and the offset up to which the data has been
+    flushed to disk.  Hash objects can not be saved, the data before that
+    offset is hashed again from disk when the download is resumed.
+    """
+
+    def __init__(self, path):
+        """Initialize journal.
+
+        :param path: Path to partial download
+        :type path: str
+        """
+        self.path = path
+        self.journal_path = path + JOURNAL_SUFFIX
+
+    @staticmethod
+    def _identity(image):
+        return {'id': image.id,
+                'size': getattr(image, 'size', None),
+                'digests': image_digests(image)}
+
+    def open(self):
+        """Open partial download for writing without discarding its data.
+
+        :returns: Open file object
+        :rtype: io.BufferedRandom
+        """
+        return os.fdopen(
+            os.open(self.path, os.O_RDWR | os.O_CREAT, 0o600), 'r+b')
+
+    def load(self, image):
+        """Get offset a download of image can be resumed from.
+
+        :param image: Glance image object
+        :type image: Glance image object
+        :returns: Offset of first byte not on disk, 0 when there is no
+                  journal for this image or it does not match the file
+        :rtype: int
+        """
+        try:
+            with open(self.journal_path) as f:
+                entry = json.load(f)
+            size = os.stat(self.path).st_size
+        except (OSError, ValueError):
+            return 0
+        if not isinstance(entry, dict) or (
+                entry.get('image') != self._identity(image)):
+            return 0
+        offset = entry.get('offset')
+        if not isinstance(offset, int) or not 0 < offset <= size:
+            return 0
+        return offset
+
+    def save(self, image, fd, offset):
+        """Flush downloaded data to disk and record its offset.
+
+        :param image: Glance image object
+        :type image: Glance image object
+        :param fd: File descriptor of partial download
+        :type fd: int
+        :param offset: Offset of first byte not downloaded yet
+        :type offset: int
+        :raises: OSError
+        """
+        os.fsync(fd)
+        tmp_path = self.journal_path + '.tmp'
+        with open(tmp_path, 'w') as f:
+            json.dump({'image': self._identity(image), 'offset': offset}, f)
+        os.replace(tmp_path, self.journal_path)
+
+    def remove(self):
+        """Remove journal, keeping the downloaded data."""
+        with contextlib.suppress(FileNotFoundError):
+            os.unlink(self.journal_path)
+
+    def discard(self):
+        """Remove journal and partial download."""
+        self.remove()
+        with contextlib.suppress(FileNotFoundError):
+            os.unlink(self.path)
+
+
+class DownloadProgress(object):
+    """Offset up to which a download is written and hashed."""
+
+    def __init__(self, image, fd, offset=0, journal=None):
+        """Initialize progress.
+
+        :param image: Glance image object
+        :type image: Glance image object
+        :param fd: File descriptor data is written to
+        :type fd: int
+        :param offset: Offset the download starts at
+        :type offset: int
+        :param journal: Journal to record progress in
+        :type journal: Optional[DownloadJournal]
+        """
+        self.image = image
+        self.fd = fd
+        self.offset = self.saved = offset
+        self.journal = journal
+
+    def advance(self, offset):
+        """Record that all data before offset is written and hashed.
+
+        The journal is updated every ``JOURNAL_INTERVAL`` bytes.
+
+        :param offset: Offset of first byte not downloaded yet
+        :type offset: int
+        """
+        self.offset = offset
+        if offset - self.saved >= JOURNAL_INTERVAL:
+            self.save()
+
+    def save(self):
+        if self.journal and self.offset != self.saved:
+            self.journal.save(self.image, self.fd, self.offset)
+            self.saved = self.offset
+
+
+def download_image_segmented(glance, image, out, connections,
+                             segment_size, hasher=None, start=0,
+                             progress=None, throttle=None, meter=None):
+    """Download image from glance using concurrent range requests.
+
+    The first segment is fetched on its own to find out whether the server
+    honours range requests, the remaining segments are then fetched from a
+    pool of ``connections`` threads and written at their offset in ``out``.
+
+    Segments arrive out of order, ``hasher`` is fed with the data as it is
+    received through an ``OrderedHasher``, which holds data ahead of the
+    hashed offset in memory rather than reading it back from the file.
+
+    :param glance: Glance client
+    :type glance: glanceclient.Client
+    :param image: Glance image object
+    :type image: Glance image object
+    :param out: Open file object to write data to
+    :type out: Python file object
+    :param connections: Maximum number of concurrent connections
+    :type connections: int
+    :param segment_size: Size of each segment in bytes
+    :type segment_size: int
+    :param hasher: Hasher to feed downloaded data to
+    :type hasher: Optional[MultiHasher]
+    :param start: Offset to start downloading at, data before it must have
+                  been fed to ``hasher`` already
+    :type start: int
+    :param progress: Advanced as segments are hashed
+    :type progress: Optional[DownloadProgress]
+    :param throttle: Limits the rate data is received at over all
+                     connections
+    :type throttle: Optional[ratelimit.TokenBucket]
+    :param meter: Updated with the data received over all connections
+    :type meter: Optional[progress.ProgressMeter]
+    :returns: Number of bytes skipped because they were zero
+    :rtype: int
+    :raises: RangeRequestNotSupported, TransferError,
+             progress.TransferStalled
+    """
+    size = image.size
+    segments = [(offset, min(offset + segment_size, size) - 1)
+                for offset in range(start, size, segment_size)]
+    fd = out.fileno()
+    os.ftruncate(fd, size)
+    ordered = OrderedHasher(hasher or MultiHasher(()), offset=start,
+                            progress=progress)
+    # Segments are started in order, so the one at the hashed offset is
+    # always being downloaded while writers further ahead wait.
+    skipped = _write_segment(glance, image, fd, *segments[0],
+                             throttle=throttle, meter=meter, hasher=ordered)
+    with concurrent.futures.ThreadPoolExecutor(
+            max_workers=connections) as executor:
+        futures = [executor.submit(_write_segment, glance, image, fd,
+                                   start, end, throttle=throttle,
+                                   meter=meter, hasher=ordered)
+                   for start, end in segments[1:]]
+        try:
+            for future in concurrent.futures.as_completed(futures):
+                skipped += future.result()
+        except Exception:
+            for future in futures:
+                future.cancel()
+            ordered.abort()
+            raise
+    if ordered.offset != size:
+        raise TransferError('segmented download of image "{}" hashed {} of '
+                            '{} bytes'.format(image.id, ordered.offset, size))
+    return skipped
+
+
+def _download_stream(glance, image, fd, hasher, progress, throttle=None,
+                     meter=None):
+    """Download image data from the current offset in a single stream.
+
+    :param glance: Glance client
+    :type glance: glanceclient.Client
+    :param image: Glance image object
+    :type image: Glance image object
+    :param fd: File descriptor to write data to
+    :type fd: int
+    :param hasher: Hasher to feed downloaded data to
+    :type hasher: MultiHasher
+    :param progress: Offset to start at, advanced with each chunk
+    :type progress: DownloadProgress
+    :param throttle: Limits the rate data is received at
+    :type throttle: Optional[ratelimit.TokenBucket]
+    :param meter: Updated with the data received
+    :type meter: Optional[progress.ProgressMeter]
+    :returns: Number of bytes skipped because they were zero
+    :rtype: int
+    :raises: RangeRequestNotSupported, TransferError,
+             progress.TransferStalled
+    """
+    size = getattr(image, 'size', None) or 0
+    offset = progress.offset
+    if offset:
+        body = get_image_segment(glance, image, offset,
+                                 size - 1 if size else None)
+    else:
+        body = glance.images.data(image.id)
+    if size:
+        os.ftruncate(fd, size)
+    skipped = 0
+    for chunk in body:
+        if throttle:
+            throttle.consume(len(chunk))
+        if meter:
+            meter.update(len(chunk))
+        skipped += sparse_io.write_sparse(fd, chunk, offset)
+        offset += len(chunk)
+        hasher.update(chunk)
+        progress.advance(offset)
+    if size and offset != size:
+        raise TransferError('short read for image "{}": got {} of {} bytes'
+                            .format(image.id, offset, size))
+    os.ftruncate(fd, offset)
+    return skipped
+
+
+def download_image(glance, image, file_object, connections=None,
+                   segment_size=None, journal=None,
+                   attempts=DOWNLOAD_ATTEMPTS,
+                   interval=DOWNLOAD_RETRY_INTERVAL,
+                   max_interval=DOWNLOAD_RETRY_MAX_INTERVAL,
+                   throttle=None, meter=None):
     """Download image from glance.
 
+    When ``connections`` is greater than one and the image is larger than
+    ``segment_size`` the image is downloaded in segments over concurrent
+    connections, falling back to a single stream if the server does not
+    honour range requests.
+
+    The data is hashed while it is written and verified against the checksum
+    Glance reports for the image.  Blocks of zeros are skipped, leaving
+    holes in the file, so no space is preallocated for it.
+
+    A failed transfer is retried up to ``attempts`` times with a range
+    request for the data not downloaded yet, doubling the wait between
+    attempts up to ``max_interval``.  With a ``journal`` the progress is
+    recorded on disk as well, and a download left behind by an earlier
+    failed run is continued where it stopped.  Downloads that can not be
+    resumed with a range request start over.  A stalled download, as
+    detected by ``meter``, is retried like a failed one.
+
     :param glance: Glance client
     :type glance: glanceclient.Client
     :param image: Glance image object
     :type image: Glance image object
     :param file_object: Open file object to write data to
     :type file_object: Python file object
+    :param connections: Maximum number of concurrent connections
+    :type connections: Optional[int]
+    :param segment_size: Size of each segment in bytes
+    :type segment_size: Optional[int]
+    :param journal: Journal of partial download in ``file_object``
+    :type journal: Optional[DownloadJournal]
+    :param attempts: Maximum number of attempts
+    :type attempts: int
+    :param interval: Seconds to wait before the first retry
+    :type interval: float
+    :param max_interval: Upper bound for interval
+    :type max_interval: float
+    :param throttle: Limits the rate data is received at
+    :type throttle: Optional[ratelimit.TokenBucket]
+    :param meter: Reports progress of the download and detects stalls
+    :type meter: Optional[progress.ProgressMeter]
+    :returns: Map of algorithm name to hex digest of downloaded data
+    :rtype: Dict[str, str]
+    :raises: ChecksumMismatch, TransferError, progress.TransferStalled
     """
+    expected = image_digests(image)
     with file_object as out:
-        for chunk in glance.images.data(image.id):
-            out.write(chunk)
+        fd = out.fileno()
+        hasher = MultiHasher(expected.keys())
+        size = getattr(image, 'size', None) or 0
+        offset = journal.load(image) if journal else 0
+        if offset:
+            ch_core.hookenv.log('Resuming download of image "{}" at offset '
+                                '{}'.format(image.id, offset),
+                                level=ch_core.hookenv.INFO)
+            _hash_file_range(fd, hasher, 0, offset - 1)
+        progress = DownloadProgress(image, fd, offset, journal=journal)
+        segmented = bool(connections and connections > 1 and segment_size)
+        skipped = 0
+        attempt = 1
+        while True:
+            # Data beyond what has been hashed is fetched again, truncating
+            # turns it into a hole that sparse writes can skip zeros in.
+            os.ftruncate(fd, progress.offset)
+            if meter:
+                meter.restart(progress.offset)
+            try:
+                if segmented and size - progress.offset > segment_size:
+                    skipped += download_image_segmented(
+                        glance, image, out, connections, segment_size,
+                        hasher=hasher, start=progress.offset,
+                        progress=progress, throttle=throttle, meter=meter)
+                else:
+                    skipped += _download_stream(glance, image, fd, hasher,
+                                                progress, throttle=throttle,
+                                                meter=meter)
+                break
+            except RangeRequestNotSupported as e:
+                if segmented:
+                    ch_core.hookenv.log('Segmented download of image "{}" '
+                                        'not possible, falling back to '
+                                        'single stream: {}'
+                                        .format(image.id, str(e)),
+                                        level=ch_core.hookenv.INFO)
+                    segmented = False
+                    continue
+                ch_core.hookenv.log('Download of image "{}" can not be '
+                                    'resumed, starting over: {}'
+                                    .format(image.id, str(e)),
+                                    level=ch_core.hookenv.INFO)
+                if journal:
+                    journal.remove()
+                hasher = MultiHasher(expected.keys())
+                progress = DownloadProgress(image, fd, journal=journal)
+            except Exception as e:
+                if attempt >= attempts:
+                    with contextlib.suppress(OSError):
+                        progress.save()
+                    raise
+                ch_core.hookenv.log('Download of image "{}" failed at offset '
+                                    '{} (attempt {}/{}), retrying in {}s: {}'
+                                    .format(image.id, progress.offset,
+                                            attempt, attempts, interval,
+                                            str(e)),
+                                    level=ch_core.hookenv.WARNING)
+                time.sleep(interval)
+                interval = min(interval * 2, max_interval)
+                attempt += 1
+    ch_core.hookenv.log('Downloaded image "{}", skipped writing {} bytes of '
+                        'zeros'.format(image.id, skipped),
+                        level=ch_core.hookenv.DEBUG)
+    digests = hasher.hexdigests()
+    verify_digests(expected, digests, 'image "{}"'.format(image.id))
+    return digests
+
+
+def get_stores(glance):
+    """Get stores Glance keeps image data in.
+
+    Only the detailed listing, which requires admin privileges, includes
+    the type of each store.  The plain listing is used without them.
+
+    :param glance: Glance client
+    :type glance: glanceclient.Client
+    :returns: Properties of store keyed by store ID, empty when Glance is not
+              configured with multiple stores
+    :rtype: Dict[str, Dict[str, Any]]
+    """
+    for method in ('get_stores_info_detail', 'get_stores_info'):
+        try:
+            info = getattr(glance.images, method)()
+        except Exception as e:
+            ch_core.hookenv.log('Unable to list image stores with {}: {}'
+                                .format(method, str(e)),
+                                level=ch_core.hookenv.DEBUG)
+            continue
+        return {store['id']: store for store in info.get('stores', [])}
+    return {}
+
+
+def import_methods(glance):
+    """Get image import methods Glance advertises.
+
+    :param glance: Glance client
+    :type glance: glanceclient.Client
+    :returns: Names of import methods, empty for clouds without the
+              interoperable image import API
+    :rtype: List[str]
+    """
+    try:
+        info = glance.images.get_import_info()
+    except Exception as e:
+        ch_core.hookenv.log('Unable to get image import methods: {}'
+                            .format(str(e)),
+                            level=ch_core.hookenv.DEBUG)
+        return []
+    return info.get('import-methods', {}).get('value', [])
+
+
+def wait_for_import(glance, image_id, timeout=IMPORT_TIMEOUT,
+                    interval=IMPORT_POLL_INTERVAL,
+                    max_interval=IMPORT_POLL_MAX_INTERVAL):
+    """Poll image until Glance finished importing it to all stores.
+
+    The interval between polls is doubled up to ``max_interval``.
+
+    :param glance: Glance client
+    :type glance: glanceclient.Client
+    :param image_id: ID of Glance image being imported
+    :type image_id: str
+    :param timeout: Seconds to wait for the import
+    :type timeout: float
+    :param interval: Seconds to wait before polling again
+    :type interval: float
+    :param max_interval: Upper bound for interval
+    :type max_interval: float
+    :returns: Imported Glance image object
+    :rtype: Glance image object
+    :raises: ImportFailed
+    """
+    deadline = time.monotonic() + timeout
+    while True:
+        image = glance.images.get(image_id)
+        failed = getattr(image, 'os_glance_failed_import', None)
+        if failed:
+            raise ImportFailed('import of image "{}" failed for stores: {}'
+                               .format(image_id, failed))
+        if image.status in ('killed', 'deleted'):
+            raise ImportFailed('import of image "{}" failed, image is {}'
+                               .format(image_id, image.status))
+        if (image.status == 'active' and
+                not getattr(image, 'os_glance_importing_to_stores', None)):
+            return image
+        if time.monotonic() + interval > deadline:
+            raise ImportFailed('import of image "{}" did not finish within '
+                               '{}s'.format(image_id, timeout))
+        time.sleep(interval)
+        interval = min(interval * 2, max_interval)
+
+
+def import_image(glance, image_id, fileobj, stores=None, all_stores=False):
+    """Stage image data in Glance and import it with ``glance-direct``.
+
+    Glance distributes the staged data to the stores server-side.
+
+    :param glance: Glance client
+    :type glance: glanceclient.Client
+    :param image_id: ID of Glance image to import data to
+    :type image_id: str
+    :param fileobj: File object to read image data from
+    :type fileobj: io.RawIOBase
+    :param stores: Stores to import to, default is the default store
+    :type stores: Optional[List[str]]
+    :param all_stores: Import to all stores
+    :type all_stores: bool
+    :returns: Imported Glance image object
+    :rtype: Glance image object
+    :raises: ImportFailed
+    """
+    glance.images.stage(image_id, fileobj)
+    kwargs = {}
+    if all_stores:
+        kwargs.update(all_stores=True, allow_failure=False)
+    elif stores:
+        kwargs.update(stores=list(stores), allow_failure=False)
+    glance.images.image_import(image_id, method=IMPORT_METHOD, **kwargs)
+    return wait_for_import(glance, image_id)
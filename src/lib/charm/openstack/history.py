@@ -0,0 +1,183 @@
+# Copyright 2022 Canonical Ltd
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#  http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import time
+
+import charm.openstack.batch as batch
+import charm.openstack.metrics as metrics
+
+# Number of runs kept, older runs are dropped as new ones are recorded.
+HISTORY_SIZE = 50
+PERCENTILES = (50, 95)
+TOTAL = 'total'
+OUTCOME_SUCCEEDED, OUTCOME_FAILED, OUTCOME_UP_TO_DATE = (
+    'succeeded', 'failed', 'up-to-date')
+MIB = 1024 * 1024
+
+
+def entry(run):
+    """Get compact history entry for a run.
+
+    :param run: Metrics as returned by ``metrics.RunMetrics.to_dict``
+    :type run: Dict[str, Any]
+    :returns: History entry
+    :rtype: Dict[str, Any]
+    """
+    if not run['success']:
+        outcome = OUTCOME_FAILED
+    elif run.get('up-to-date'):
+        outcome = OUTCOME_UP_TO_DATE
+    else:
+        outcome = OUTCOME_SUCCEEDED
+    record = {
+        # Sub-second start times tell apart runs started in the same second.
+        'started': round(run['started'], 6),
+        'duration': round(run['duration'], 1),
+        'outcome': outcome,
+        'phases': {name: [round(phase['seconds'], 1), phase['bytes']]
+                   for name, phase in run['phases'].items()},
+        'images': [[image['label'], image['source'], image['status'],
+                    image['image-id']]
+                   for image in run.get('images') or []],
+    }
+    if run.get('error'):
+        record['error'] = run['error']
+    return record
+
+
+def append(entries, record, size=HISTORY_SIZE):
+    """Add entry to history, dropping the oldest entries beyond size.
+
+    :param entries: History, oldest entry first
+    :type entries: List[Dict[str, Any]]
+    :param record: Entry as returned by ``entry``
+    :type record: Dict[str, Any]
+    :param size: Maximum number of entries
+    :type size: int
+    :returns: New history
+    :rtype: List[Dict[str, Any]]
+    """
+    return (list(entries) + [record])[-size:]
+
+
+def percentile(values, pct):
+    """Get percentile of values, interpolating between closest ranks.
+
+    :param values: Values
+    :type values: Iterable[float]
+    :param pct: Percentile between 0 and 100
+    :type pct: float
+    :returns: Percentile or None when there are no values
+    :rtype: Optional[float]
+    """
+    values = sorted(values)
+    if not values:
+        return None
+    rank = (len(values) - 1) * pct / 100.0
+    lower = int(rank)
+    upper = min(lower + 1, len(values) - 1)
+    return values[lower] + (values[upper] - values[lower]) * (rank - lower)
+
+
+def summary(entries):
+    """Get percentiles of the duration and throughput of each phase.
+
+    Only successful runs are taken into account, not those that found all
+    images up to date and ended after discovery.  The total duration only
+    counts runs that created images, which leaves out up to date runs
+    recorded before they had an outcome of their own.
+
+    :param entries: History
+    :type entries: List[Dict[str, Any]]
+    :returns: Number of runs and percentiles keyed by phase, then by
+              'seconds' or 'throughput' and percentile
+    :rtype: Dict[str, Dict[str, Dict[int, float]]]
+    """
+    durations = {}
+    throughputs = {}
+    for record in entries:
+        if record['outcome'] != OUTCOME_SUCCEEDED:
+            continue
+        for name, (seconds, size) in record['phases'].items():
+            durations.setdefault(name, []).append(seconds)
+            if size and seconds:
+                throughputs.setdefault(name, []).append(size / seconds)
+        if any(image[2] == batch.STATUS_CREATED
+               for image in record['images']):
+            durations.setdefault(TOTAL, []).append(record['duration'])
+    result = {}
+    for name in metrics.PHASES + (TOTAL,):
+        if name not in durations:
+            continue
+        result[name] = {
+            'runs': len(durations[name]),
+            'seconds': {pct: percentile(durations[name], pct)
+                        for pct in PERCENTILES}}
+        if name in throughputs:
+            result[name]['throughput'] = {
+                pct: percentile(throughputs[name], pct)
+                for pct in PERCENTILES}
+    return result
+
+
+def action_results(entries, limit=None):
+    """History as keys for ``action_set``.
+
+    :param entries: History, oldest entry first
+    :type entries: List[Dict[str, Any]]
+    :param limit: Maximum number of most recent runs to list, all when 0
+                  or None
+    :type limit: Optional[int]
+    :rtype: Dict[str, str]
+    """
+    results = {
+        'summary.runs': str(len(entries)),
+        'summary.failed': str(sum(1 for record in entries
+                                  if record['outcome'] == OUTCOME_FAILED)),
+        'summary.up-to-date': str(sum(
+            1 for record in entries
+            if record['outcome'] == OUTCOME_UP_TO_DATE)),
+    }
+    for name, stats in summary(entries).items():
+        results['summary.{}.runs'.format(name)] = str(stats['runs'])
+        for pct, value in stats['seconds'].items():
+            results['summary.{}.p{}'.format(name, pct)] = '{:.1f}s'.format(
+                value)
+        for pct, value in stats.get('throughput', {}).items():
+            results['summary.{}.throughput-p{}'.format(name, pct)] = (
+                '{:.1f} MiB/s'.format(value / MIB))
+    for record in entries[-limit if limit else 0:]:
+        # Keys sort chronologically in the action output.
+        seconds, fraction = divmod(record['started'], 1)
+        prefix = 'runs.{}-{:06d}'.format(
+            time.strftime('%Y%m%d-%H%M%S', time.gmtime(seconds)),
+            min(int(round(fraction * 1000000)), 999999))
+        results[prefix + '.outcome'] = record['outcome']
+        results[prefix + '.duration'] = '{:.1f}s'.format(record['duration'])
+        if record.get('error'):
+            results[prefix + '.error'] = record['error']
+        for name, (seconds, size) in record['phases'].items():
+            value = '{:.1f}s'.format(seconds)
+            if size:
+                value += ', {:.1f} MiB'.format(size / MIB)
+            results['{}.phases.{}'.format(prefix, name)] = value
+        for label, source, status, image_id in record['images']:
+            value = status
+            if source:
+                value += ' from {}'.format(source)
+            if image_id:
+                value += ' as {}'.format(image_id)
+            results['{}.images.{}'.format(
+                prefix, batch.action_key(label))] = value
+    return results
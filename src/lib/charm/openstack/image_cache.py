@@ -0,0 +1,237 @@
+# Copyright 2022 Canonical Ltd
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#  http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import contextlib
+import errno
+import fcntl
+import os
+import re
+import shutil
+import threading
+
+import charmhelpers.core as ch_core
+
+CACHE_DIR = '/var/snap/octavia-diskimage-retrofit/common/image-cache'
+VALID_KEY = re.compile(r'^[a-z0-9]+-[0-9a-f]+$')
+LOCK_FILE = '.cache.lock'
+
+# Caches are shared by the threads of a batch retrofit as well as by
+# concurrent processes, which are serialized by a lock file.
+_lock = threading.Lock()
+
+
+def cache_key(image):
+    """Build content address for Glance image.
+
+    The multihash properties ``os_hash_algo`` and ``os_hash_value`` are
+    preferred, the legacy md5 ``checksum`` is used for images that were
+    created before Glance provided multihash.
+
+    :param image: Glance image object
+    :type image: Glance image object
+    :returns: Cache key or None if the image carries no usable checksum
+    :rtype: Optional[str]
+    """
+    algo = getattr(image, 'os_hash_algo', None)
+    value = getattr(image, 'os_hash_value', None)
+    if not (algo and value):
+        algo, value = 'md5', getattr(image, 'checksum', None)
+    if not value:
+        return None
+    key = '{}-{}'.format(algo, value).lower()
+    if not VALID_KEY.match(key):
+        return None
+    return key
+
+
+def key_digests(key):
+    """Get the digest a cache key is the content address for.
+
+    :param key: Cache key as returned by ``cache_key``
+    :type key: str
+    :returns: Map of algorithm name to hex digest
+    :rtype: Dict[str, str]
+    """
+    algo, value = key.split('-', 1)
+    return {algo: value}
+
+
+class ImageCache(object):
+    """Content addressed store of source images with LRU eviction.
+
+    Entries are plain files named by their cache key.  The modification time
+    of an entry is updated on every hit and used as the LRU order.  Source
+    images are only inserted with digests verified to match their key, so
+    an entry can be used without hashing it again.
+    """
+
+    def __init__(self, path, max_bytes):
+        """Initialize cache.
+
+        :param path: Directory to keep cached images in
+        :type path: str
+        :param max_bytes: Upper bound for total size of cached images,
+                          caching is disabled when not positive
+        :type max_bytes: int
+        """
+        self.path = path
+        self.max_bytes = max_bytes or 0
+
+    @property
+    def enabled(self):
+        return self.max_bytes > 0
+
+    @contextlib.contextmanager
+    def _locked(self):
+        with _lock:
+            os.makedirs(self.path, mode=0o700, exist_ok=True)
+            with open(os.path.join(self.path, LOCK_FILE), 'a') as lock:
+                fcntl.flock(lock, fcntl.LOCK_EX)
+                yield
+
+    def _entry_path(self, key):
+        return os.path.join(self.path, key)
+
+    def _entries(self):
+        """List cache entries.
+
+        :returns: List of (mtime, size, path) tuples, oldest first
+        :rtype: List[Tuple[float, int, str]]
+        """
+        entries = []
+        try:
+            names = os.listdir(self.path)
+        except FileNotFoundError:
+            return entries
+        for name in names:
+            if not VALID_KEY.match(name):
+                continue
+            entry = os.path.join(self.path, name)
+            try:
+                st = os.stat(entry)
+            except FileNotFoundError:
+                continue
+            entries.append((st.st_mtime, st.st_size, entry))
+        return sorted(entries)
+
+    def size(self):
+        """Total size of cached images in bytes.
+
+        :rtype: int
+        """
+        return sum(size for _, size, _ in self._entries())
+
+    def lookup(self, key):
+        """Look up image in cache and mark it as recently used.
+
+        :param key: Cache key as returned by ``cache_key``
+        :type key: Optional[str]
+        :returns: Path to cached image or None
+        :rtype: Optional[str]
+        """
+        if not (self.enabled and key):
+            return None
+        entry = self._entry_path(key)
+        if not os.path.exists(entry):
+            return None
+        with self._locked():
+            try:
+                os.utime(entry)
+            except FileNotFoundError:
+                return None
+        return entry
+
+    def remove(self, key):
+        """Remove entry from cache.
+
+        :param key: Cache key as returned by ``cache_key``
+        :type key: Optional[str]
+        """
+        if not key:
+            return
+        with self._locked():
+            try:
+                os.unlink(self._entry_path(key))
+            except FileNotFoundError:
+                pass
+
+    def evict(self, reserve=0):
+        """Evict least recently used images until ``reserve`` bytes fit.
+
+        :param reserve: Number of bytes to make room for
+        :type reserve: int
+        """
+        with self._locked():
+            self._evict(reserve)
+
+    def _evict(self, reserve):
+        entries = self._entries()
+        total = sum(size for _, size, _ in entries)
+        for _, size, entry in entries:
+            if total + reserve <= self.max_bytes:
+                break
+            ch_core.hookenv.log('Evicting "{}" from image cache'
+                                .format(entry),
+                                level=ch_core.hookenv.DEBUG)
+            try:
+                os.unlink(entry)
+            except FileNotFoundError:
+                pass
+            total -= size
+
+    def insert(self, key, source, digests=None):
+        """Add downloaded image to cache.
+
+        The file is hard linked into the cache so the caller remains free to
+        remove ``source`` afterwards, a copy is made when ``source`` resides
+        on a different file system.
+
+        :param key: Cache key as returned by ``cache_key``
+        :type key: Optional[str]
+        :param source: Path to downloaded image
+        :type source: str
+        :param digests: Digests computed from the data in ``source``, when
+                        given it is only cached when they include the digest
+                        the key is the content address for
+        :type digests: Optional[Dict[str, str]]
+        :returns: Path to cached image or None if it was not cached
+        :rtype: Optional[str]
+        """
+        if not (self.enabled and key):
+            return None
+        algo, value = key.split('-', 1)
+        if digests is not None and digests.get(algo) != value:
+            ch_core.hookenv.log('Not caching "{}", its {} digest was not '
+                                'verified'.format(key, algo),
+                                level=ch_core.hookenv.WARNING)
+            return None
+        size = os.stat(source).st_size
+        if size > self.max_bytes:
+            ch_core.hookenv.log('Not caching "{}", size {} exceeds cache '
+                                'size {}'.format(key, size, self.max_bytes),
+                                level=ch_core.hookenv.INFO)
+            return None
+        entry = self._entry_path(key)
+        with self._locked():
+            self._evict(size)
+            try:
+                os.link(source, entry)
+            except FileExistsError:
+                os.utime(entry)
+            except OSError as ex:
+                if ex.errno != errno.EXDEV:
+                    raise
+                shutil.copyfile(source, entry + '.partial')
+                os.replace(entry + '.partial', entry)
+        return entry
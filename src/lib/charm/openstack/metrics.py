@@ -0,0 +1,248 @@
+# Copyright 2022 Canonical Ltd
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#  http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import contextlib
+import os
+import threading
+import time
+
+AUTH, DISCOVERY, DOWNLOAD, RETROFIT, UPLOAD = (
+    'auth', 'discovery', 'download', 'retrofit', 'upload')
+PHASES = (AUTH, DISCOVERY, DOWNLOAD, RETROFIT, UPLOAD)
+TEXTFILE_NAME = 'octavia-diskimage-retrofit.prom'
+METRIC_PREFIX = 'octavia_diskimage_retrofit_'
+MIB = 1024 * 1024
+
+
+class Phase(object):
+    """Data volume of a phase, updated by the code being timed."""
+
+    def __init__(self):
+        self.bytes = 0
+
+
+class RunMetrics(object):
+    """Duration and data volume of the phases of a retrofit run.
+
+    The outcome for each image of the run is recorded along with them, and
+    whether the run found all images up to date and did no work.  In batch
+    mode the phases of concurrently retrofitted images add up,
+    the durations of a phase are then the sum of the time each image spent
+    in it rather than wall clock time.
+    """
+
+    def __init__(self):
+        self.started = time.time()
+        self.finished = None
+        self.duration = 0.0
+        self.success = None
+        self.up_to_date = False
+        self.error = None
+        self.phases = {}
+        self.images = []
+        self._start = time.monotonic()
+        self._lock = threading.Lock()
+
+    @contextlib.contextmanager
+    def phase(self, name):
+        """Time a phase of the run.
+
+        The phase is recorded when the context is left, also when it is
+        left with an exception.
+
+        :param name: Name of phase, one of ``PHASES``
+        :type name: str
+        :returns: Phase to add the bytes transferred or written to
+        :rtype: Phase
+        """
+        phase = Phase()
+        start = time.monotonic()
+        try:
+            yield phase
+        finally:
+            self.add(name, time.monotonic() - start, phase.bytes)
+
+    def add(self, name, seconds, size=0):
+        """Record time spent and bytes transferred in a phase.
+
+        :param name: Name of phase
+        :type name: str
+        :param seconds: Time spent in phase
+        :type seconds: float
+        :param size: Bytes transferred or written
+        :type size: int
+        """
+        with self._lock:
+            phase = self.phases.setdefault(
+                name, {'seconds': 0.0, 'bytes': 0, 'count': 0})
+            phase['seconds'] += seconds
+            phase['bytes'] += size
+            phase['count'] += 1
+
+    def add_image(self, source, status, image_id=None, label=None):
+        """Record outcome for an image of the run.
+
+        :param source: ID of source image
+        :type source: Optional[str]
+        :param status: Outcome, one of the ``batch.STATUS_*`` values
+        :type status: str
+        :param image_id: ID of created or up to date image
+        :type image_id: Optional[str]
+        :param label: Region or batch item the outcome applies to
+        :type label: Optional[str]
+        """
+        with self._lock:
+            self.images.append({'source': source, 'status': status,
+                                'image-id': image_id, 'label': label})
+
+    def finish(self, success):
+        """Mark run as ended.
+
+        A run already marked as failed, for example because some images of
+        a batch failed, stays failed.
+
+        :param success: Whether the run succeeded
+        :type success: bool
+        """
+        self.finished = time.time()
+        self.duration = time.monotonic() - self._start
+        self.success = bool(success) and self.success is not False
+
+    def to_dict(self):
+        """Get metrics in a form suitable for the unit database.
+
+        :rtype: Dict[str, Any]
+        """
+        with self._lock:
+            phases = {name: dict(phase)
+                      for name, phase in self.phases.items()}
+            images = [dict(image) for image in self.images]
+        return {'started': self.started, 'finished': self.finished,
+                'duration': self.duration, 'success': self.success,
+                'up-to-date': self.up_to_date, 'error': self.error,
+                'phases': phases, 'images': images}
+
+
+def throughput(phase):
+    """Get throughput of a phase.
+
+    :param phase: Phase as found in ``RunMetrics.to_dict()['phases']``
+    :type phase: Dict[str, Any]
+    :returns: Bytes per second
+    :rtype: float
+    """
+    if not (phase.get('seconds') and phase.get('bytes')):
+        return 0.0
+    return phase['bytes'] / phase['seconds']
+
+
+def summary(run):
+    """Describe a run for logging.
+
+    :param run: Metrics as returned by ``RunMetrics.to_dict``
+    :type run: Dict[str, Any]
+    :rtype: str
+    """
+    parts = []
+    for name in PHASES:
+        phase = run['phases'].get(name)
+        if not phase:
+            continue
+        part = '{} {:.1f}s'.format(name, phase['seconds'])
+        if phase['bytes']:
+            part += ' ({:.1f} MiB, {:.1f} MiB/s)'.format(
+                phase['bytes'] / MIB, throughput(phase) / MIB)
+        parts.append(part)
+    return 'total {:.1f}s: {}'.format(run['duration'], ', '.join(parts))
+
+
+def render(run, last_success=None):
+    """Render metrics in the Prometheus text exposition format.
+
+    Runs that found all images up to date are reported by the
+    ``up_to_date`` gauges only, ``run`` then holds the metrics of the last
+    run that did work with ``up-to-date`` and ``last-up-to-date`` updated.
+
+    :param run: Metrics as returned by ``RunMetrics.to_dict``
+    :type run: Dict[str, Any]
+    :param last_success: End of last successful run as Unix time
+    :type last_success: Optional[float]
+    :rtype: str
+    """
+    lines = []
+
+    def family(name, help_text, samples):
+        lines.append('# HELP {}{} {}'.format(METRIC_PREFIX, name, help_text))
+        lines.append('# TYPE {}{} gauge'.format(METRIC_PREFIX, name))
+        for labels, value in samples:
+            lines.append('{}{}{} {}'.format(
+                METRIC_PREFIX, name,
+                '{{phase="{}"}}'.format(labels) if labels else '', value))
+
+    phases = [(name, run['phases'][name]) for name in PHASES
+              if name in run['phases']]
+    family('phase_duration_seconds',
+           'Time spent in each phase of the last retrofit run.',
+           [(name, '{:.3f}'.format(phase['seconds']))
+            for name, phase in phases])
+    family('phase_bytes',
+           'Bytes transferred or written in each phase of the last '
+           'retrofit run.',
+           [(name, '{:d}'.format(phase['bytes'])) for name, phase in phases])
+    family('phase_throughput_bytes_per_second',
+           'Throughput of each phase of the last retrofit run.',
+           [(name, '{:.3f}'.format(throughput(phase)))
+            for name, phase in phases if phase['bytes']])
+    family('last_run_duration_seconds',
+           'Duration of the last retrofit run.',
+           [(None, '{:.3f}'.format(run['duration']))])
+    family('last_run_timestamp_seconds',
+           'Time the last retrofit run ended.',
+           [(None, '{:.3f}'.format(run['finished'] or 0))])
+    family('last_run_success',
+           'Whether the last retrofit run succeeded.',
+           [(None, '1' if run['success'] else '0')])
+    if last_success:
+        family('last_success_timestamp_seconds',
+               'Time the last successful retrofit run ended.',
+               [(None, '{:.3f}'.format(last_success))])
+    family('up_to_date',
+           'Whether the last retrofit run found all images up to date.',
+           [(None, '1' if run.get('up-to-date') else '0')])
+    if run.get('last-up-to-date'):
+        family('last_up_to_date_timestamp_seconds',
+               'Time the last retrofit run finding all images up to date '
+               'ended.',
+               [(None, '{:.3f}'.format(run['last-up-to-date']))])
+    return '\n'.join(lines) + '\n'
+
+
+def write_textfile(path, run, last_success=None):
+    """Write metrics for the node_exporter textfile collector.
+
+    The file is replaced atomically so the collector never reads a
+    partially written file.
+
+    :param path: Path to ``.prom`` file
+    :type path: str
+    :param run: Metrics as returned by ``RunMetrics.to_dict``
+    :type run: Dict[str, Any]
+    :param last_success: End of last successful run as Unix time
+    :type last_success: Optional[float]
+    """
+    tmp_path = path + '.tmp'
+    with open(tmp_path, 'w') as f:
+        f.write(render(run, last_success=last_success))
+    os.chmod(tmp_path, 0o644)
+    os.replace(tmp_path, path)
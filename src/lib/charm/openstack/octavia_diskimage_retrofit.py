@@ -12,9 +12,9 @@
 # See the License for the specific language governing permissions and
 # limitations under the License.
 
+import contextlib
 import os
 import subprocess
-import tempfile
 import time
 
 import charms_openstack.adapters
@@ -24,14 +24,38 @@ import charms_openstack.charm.core
 import charmhelpers.core as ch_core
 import charmhelpers.core.unitdata as unitdata
 
+import charm.openstack.appliance as appliance
+import charm.openstack.batch as batch
+import charm.openstack.fanout as fanout
 import charm.openstack.glance_retrofitter as glance_retrofitter
+import charm.openstack.history as history
+import charm.openstack.image_cache as image_cache
+import charm.openstack.metrics as metrics
+import charm.openstack.notifications as notifications
+import charm.openstack.package_proxy as package_proxy
+import charm.openstack.precheck as precheck
+import charm.openstack.profiling as profiling
+import charm.openstack.progress as progress
+import charm.openstack.ratelimit as ratelimit
+import charm.openstack.scratch as scratch
+import charm.openstack.sizing as sizing
+import charm.openstack.supervisor as supervisor
+import charm.openstack.token_cache as token_cache
 
 TMPDIR = '/var/snap/octavia-diskimage-retrofit/common/tmp'
+DOWNLOAD_FILE_NAME = 'download-{}'
 SCRIPT_WRAPPER_NAME = "auto-retrofit.sh"
 SCRIPT_WRAPPER_TEMPLATE_NAME = "auto-retrofit.tmpl"
 CRON_JOB_LINKNAME = 'auto-retrofit'
 ERR_FILE_EXISTS, ERR_FILE_NOT_EXISTS = 17, 2
 KEY_LAST_RUN_IMAGE_ID, KEY_LAST_RUN_TIME = 'last-image-id', 'last-timestamp'
+KEY_LAST_RUN_DIGESTS = 'last-digests'
+KEY_LAST_RUN_METRICS = 'last-run-metrics'
+KEY_RUN_HISTORY = 'run-history'
+MIB = 1024 * 1024
+UPLOAD_ATTEMPTS = 3
+FORMAT_AUTO = precheck.FORMAT_AUTO
+FORMAT_RAW, FORMAT_QCOW2 = precheck.FORMAT_RAW, precheck.FORMAT_QCOW2
 
 
 class SourceImageNotFound(Exception):
@@ -42,11 +66,19 @@ class DestinationImageExists(Exception):
     pass
 
 
+class BatchNotConfigured(Exception):
+    pass
+
+
+class RegionUploadFailed(Exception):
+    pass
+
+
 class OctaviaDiskimageRetrofitCharm(charms_openstack.charm.OpenStackCharm):
     release = 'rocky'
     name = 'octavia-diskimage-retrofit'
     python_version = 3
-    packages = ['distro-info']
+    packages = ['distro-info', 'qemu-utils']
     adapters_class = charms_openstack.adapters.OpenStackRelationAdapters
     required_relations = ['juju-info', 'identity-credentials']
     db = unitdata.kv()
@@ -75,6 +107,108 @@ class OctaviaDiskimageRetrofitCharm(charms_openstack.charm.OpenStackCharm):
         output = subprocess.check_output(cmd, universal_newlines=True)
         return output.split()[0]
 
+    def get_snap_revision(self):
+        """Determine revision of installed ``octavia-diskimage-retrofit`` snap.
+
+        :returns: Snap revision or None if the snap is not installed
+        :rtype: Optional[str]
+        """
+        return precheck.get_snap_revision()
+
+    def prewarm_appliance(self):
+        """Pre-warm libguestfs appliance cache unless done for the snap.
+
+        The appliance is built in the background so that the hook is not
+        held up, the pre-warm discards the cache of the previous snap
+        revision and marks the revision as done once it has succeeded.
+        """
+        revision = self.get_snap_revision()
+        if not revision or appliance.is_prewarmed(revision):
+            return
+        ch_core.hookenv.log('Pre-warming libguestfs appliance for snap '
+                            'revision {}'.format(revision),
+                            level=ch_core.hookenv.INFO)
+        appliance.spawn_prewarm(
+            ch_core.hookenv.charm_dir(),
+            sizing.environment(self.appliance_sizing()))
+
+    def retrofit_fingerprint(self, source_image, uca_pocket,
+                             disk_format=None):
+        """Build fingerprint of all inputs to the retrofitting process.
+
+        :param source_image: Glance image object to retrofit
+        :type source_image: Glance image object
+        :param uca_pocket: Ubuntu Cloud Archive pocket to add to the image
+        :type uca_pocket: Optional[str]
+        :param disk_format: Disk format chosen for the region the image is
+                            uploaded to, see ``disk_format``
+        :type disk_format: Optional[str]
+        :returns: Hex digest
+        :rtype: str
+        """
+        return precheck.retrofit_fingerprint(
+            source_image, uca_pocket, self.config, self.get_snap_revision(),
+            disk_format=disk_format)
+
+    def retrofit_fingerprints(self, source_image, uca_pocket, disk_formats):
+        """Build fingerprint of the retrofit inputs for each region.
+
+        :param source_image: Glance image object to retrofit
+        :type source_image: Glance image object
+        :param uca_pocket: Ubuntu Cloud Archive pocket to add to the image
+        :type uca_pocket: Optional[str]
+        :param disk_formats: Disk format keyed by region
+        :type disk_formats: Dict[Optional[str], str]
+        :returns: Hex digest keyed by region
+        :rtype: Dict[Optional[str], str]
+        """
+        return {region: self.retrofit_fingerprint(source_image, uca_pocket,
+                                                  disk_format)
+                for region, disk_format in disk_formats.items()}
+
+    def candidate_releases(self):
+        """Determine Ubuntu releases to look for source images of.
+
+        When no specifc series is configured we fall back to looking for an
+        image with series matching the series of the unit the charm runs on
+        if most recent LTS image is not available.
+
+        :returns: Ubuntu release numbers in order of preference
+        :rtype: Tuple[str, ...]
+        """
+        ubuntu_release = self.get_ubuntu_release(
+            series=self.config['retrofit-series'])
+        if self.config['retrofit-series']:
+            return (ubuntu_release,)
+        return (
+            ubuntu_release,
+            self.get_ubuntu_release(
+                series=ch_core.host.get_distrib_codename()))
+
+    def update_precheck_state(self, keystone_endpoint):
+        """Provide cron precheck with credentials and configuration.
+
+        :param keystone_endpoint: Keystone Credentials endpoint
+        :type keystone_endpoint: keystone-credentials RelationBase
+        """
+        state = {
+            'credentials': (
+                glance_retrofitter.credentials_from_identity_credentials(
+                    keystone_endpoint)),
+            'region': self.regions()[0],
+            'regions': self.regions(),
+            'endpoint-type': self.endpoint_type(),
+            'releases': list(self.candidate_releases()),
+            'batch': [[release, arch]
+                      for _, release, arch in self.batch_matrix()],
+            'config': {key: self.config[key]
+                       for key in precheck.FINGERPRINT_CONFIG +
+                       ('retrofit-uca-pocket', 'import-stores')},
+        }
+        if precheck.write_state(state):
+            ch_core.hookenv.log('Updated precheck state',
+                                level=ch_core.hookenv.DEBUG)
+
     def request_credentials(self, keystone_endpoint):
         keystone_endpoint.request_credentials(
             self.name,
@@ -96,7 +230,8 @@ class OctaviaDiskimageRetrofitCharm(charms_openstack.charm.OpenStackCharm):
 
         Depending on the current values of ``auto-retrofit`` and ``frequency``
         config options, the cron job with the specified frequency will be
-        added or removed.
+        added or removed.  With ``notification-transport-url`` set the
+        notification listener is run instead of the cron job.
 
         :raises:OSError
         """
@@ -116,6 +251,10 @@ class OctaviaDiskimageRetrofitCharm(charms_openstack.charm.OpenStackCharm):
 
         # Setup cron job only on the leader
         if self.config['auto-retrofit'] and ch_core.hookenv.is_leader():
+            if self.config['notification-transport-url']:
+                self.render_shell_wrapper()
+                self.start_notification_listener()
+                return
             try:
                 self.render_shell_wrapper()
                 ch_core.hookenv.log('Creating symlink: "{}" -> "{}"'
@@ -128,6 +267,61 @@ class OctaviaDiskimageRetrofitCharm(charms_openstack.charm.OpenStackCharm):
                                         level=ch_core.hookenv.INFO)
                 else:
                     raise ex
+        self.stop_notification_listener()
+
+    def start_notification_listener(self):
+        """Configure and (re)start the notification listener service.
+
+        The listener runs the shell wrapper rendered by
+        ``render_shell_wrapper`` on Glance notifications about new cloud
+        images, and every ``frequency`` while the notification bus is
+        unreachable.
+        """
+        charm_dir = ch_core.hookenv.charm_dir()
+        notifications.write_config({
+            'url': self.config['notification-transport-url'],
+            'command': [os.path.join(charm_dir, 'files',
+                                     SCRIPT_WRAPPER_NAME)],
+            'exchange': (self.config['notification-exchange'] or
+                         notifications.DEFAULT_EXCHANGE),
+            'topic': (self.config['notification-topic'] or
+                      notifications.DEFAULT_TOPIC),
+            'debounce': self.config['notification-debounce'] or 0,
+            'poll_interval': notifications.POLL_INTERVALS.get(
+                self.config['frequency'], notifications.POLL_INTERVALS[
+                    'daily']),
+            'cwd': charm_dir,
+        }, notifications.CONFIG_FILE)
+        ch_core.templating.render(
+            source=notifications.UNIT_TEMPLATE_NAME,
+            target=notifications.UNIT_FILE,
+            perms=0o644,
+            context={
+                'charm_dir': charm_dir,
+                'config_file': notifications.CONFIG_FILE,
+            },
+            templates_dir='files'
+        )
+        subprocess.check_call(['systemctl', 'daemon-reload'])
+        ch_core.host.service('enable', notifications.SERVICE_NAME)
+        ch_core.host.service_restart(notifications.SERVICE_NAME)
+        ch_core.hookenv.log('Notification listener started',
+                            level=ch_core.hookenv.INFO)
+
+    def stop_notification_listener(self):
+        """Stop and remove the notification listener service if present."""
+        if not os.path.exists(notifications.UNIT_FILE):
+            return
+        ch_core.host.service_stop(notifications.SERVICE_NAME)
+        ch_core.host.service('disable', notifications.SERVICE_NAME)
+        for path in (notifications.UNIT_FILE, notifications.CONFIG_FILE):
+            try:
+                os.unlink(path)
+            except FileNotFoundError:
+                pass
+        subprocess.check_call(['systemctl', 'daemon-reload'])
+        ch_core.hookenv.log('Notification listener stopped',
+                            level=ch_core.hookenv.INFO)
 
     def remove_cron_job(self, linkname):
         """Remove existing cron job for auto retrofitting
@@ -150,115 +344,376 @@ class OctaviaDiskimageRetrofitCharm(charms_openstack.charm.OpenStackCharm):
 
     def render_shell_wrapper(self):
         """Render shell script that will be run by cron
+
+        The script is rendered on every call so that it is updated on
+        upgrade of the charm.
         """
         target_script = os.path.join("files", SCRIPT_WRAPPER_NAME)
-        if not os.path.exists(target_script):
-            unit_name = ch_core.hookenv.local_unit()
-            ch_core.templating.render(
-                source=SCRIPT_WRAPPER_TEMPLATE_NAME,
-                target=target_script,
-                perms=0o755,
-                context={
-                    'unit_name': unit_name,
-                },
-                templates_dir='files'
-            )
-
-    def retrofit(self, keystone_endpoint, force=False, image_id=''):
-        """Use ``octavia-diskimage-retrofit`` tool to retrofit an image.
+        unit_name = ch_core.hookenv.local_unit()
+        ch_core.templating.render(
+            source=SCRIPT_WRAPPER_TEMPLATE_NAME,
+            target=target_script,
+            perms=0o755,
+            context={
+                'unit_name': unit_name,
+                'charm_dir': ch_core.hookenv.charm_dir(),
+            },
+            templates_dir='files'
+        )
+
+    def appliance_sizing(self, workers=1):
+        """Size the libguestfs appliance for the host and configuration.
+
+        :param workers: Number of appliances run concurrently
+        :type workers: int
+        :returns: Sizing with 'memsize', 'smp' and 'backend' keys
+        :rtype: Dict[str, Any]
+        """
+        return sizing.host_plan(
+            workers=workers,
+            memsize=self.config['retrofit-memsize'] or None,
+            smp=self.config['retrofit-smp'] or None,
+            backend=self.config['retrofit-backend'] or None)
+
+    def limit_resources(self, cmd):
+        """Wrap command to run with the configured CPU and I/O priority.
+
+        :param cmd: Command to run
+        :type cmd: List[str]
+        :returns: Wrapped command
+        :rtype: List[str]
+        """
+        ionice_class = self.config['retrofit-ionice-class'] or None
+        if ionice_class and ionice_class not in supervisor.IONICE_CLASSES:
+            ch_core.hookenv.log('Ignoring invalid retrofit-ionice-class '
+                                '"{}"'.format(ionice_class),
+                                level=ch_core.hookenv.WARNING)
+            ionice_class = None
+        return supervisor.limit_resources(
+            cmd,
+            niceness=self.config['retrofit-nice'] or 0,
+            ionice_class=ionice_class,
+            cpu_weight=self.config['retrofit-cpu-weight'] or 0,
+            io_weight=self.config['retrofit-io-weight'] or 0)
+
+    def regions(self):
+        """Get regions to publish retrofitted images to.
+
+        Source images are taken from the first region.
+
+        :returns: Regions, ``[None]`` when no region is configured
+        :rtype: List[Optional[str]]
+        """
+        return (self.config['region'] or '').replace(',', ' ').split() or [
+            None]
+
+    def transfer_timeout(self):
+        """Get timeout for requests to OpenStack APIs.
+
+        When stalled transfers are detected, a connection on which no data
+        moves at all fails after ``transfer-stall-timeout`` as well.
+
+        :returns: Seconds or None to wait forever
+        :rtype: Optional[int]
+        """
+        if not self.config['transfer-min-rate']:
+            return None
+        return self.config['transfer-stall-timeout'] or None
+
+    def transfer_meter(self, description, total=0):
+        """Get meter reporting progress of a transfer in workload status.
+
+        :param description: Description of transfer, prefixed to reports
+        :type description: str
+        :param total: Size of transfer in bytes, 0 when not known
+        :type total: int
+        :rtype: progress.ProgressMeter
+        """
+        return progress.ProgressMeter(
+            description, total=total,
+            report=lambda message: ch_core.hookenv.status_set(
+                'maintenance', message),
+            min_rate=self.config['transfer-min-rate'] or 0,
+            stall_timeout=self.config['transfer-stall-timeout'] or 0)
+
+    def glance_clients(self, keystone_endpoint, regions=None):
+        """Get Glance clients using credentials from the Keystone relation.
+
+        A single Keystone session is shared by the clients.
 
         :param keystone_endpoint: Keystone Credentials endpoint
         :type keystone_endpoint: keystone-credentials RelationBase
-        :param force: Force retrofitting of image despite presence of
-                      apparently up to date target image
-        :type force: bool
-        :param image_id: Use specific source image for retrofitting
-        :type image_id: str
-        :raises:SourceImageNotFound,DestinationImageExists,
-                subprocess.CalledProcessError
+        :param regions: Regions to get clients for, default is all regions
+        :type regions: Optional[List[Optional[str]]]
+        :returns: Glance client keyed by region, in order of ``regions``
+        :rtype: Dict[Optional[str], glanceclient.Client]
         """
+        keystone_cache = token_cache.TokenCache()
         session = glance_retrofitter.session_from_identity_credentials(
-            keystone_endpoint)
-        region = self.config["region"] or None
-        glance = glance_retrofitter.get_glance_client(
-            session, endpoint_type=self.endpoint_type(),
-            region=region)
+            keystone_endpoint, token_cache=keystone_cache,
+            timeout=self.transfer_timeout())
+        return {
+            region: glance_retrofitter.get_glance_client(
+                session, endpoint_type=self.endpoint_type(),
+                region=region, token_cache=keystone_cache)
+            for region in (regions or self.regions())}
 
-        ubuntu_release = self.get_ubuntu_release(
-            series=self.config['retrofit-series'])
+    def glance_client(self, keystone_endpoint):
+        """Get Glance client of the first region.
 
-        if image_id:
-            source_image = next(glance.images.list(filters={'id': image_id}))
-        else:
-            source_image = None
-            if not self.config['retrofit-series']:
-                # When no specifc series is configured we fall back to looking
-                # for an image with series matching the series of the unit the
-                # charm runs on if most recent LTS image is not available
-                candidate_releases = (
-                    ubuntu_release,
-                    self.get_ubuntu_release(
-                        series=ch_core.host.get_distrib_codename()))
-            else:
-                candidate_releases = (ubuntu_release,)
-            for release in candidate_releases:
-                source_image = glance_retrofitter.find_source_image(
-                    glance,
-                    release=release)
-                if source_image:
-                    ubuntu_release = release
-                    break
-            else:
-                raise SourceImageNotFound(
-                    'unable to find suitable source image')
+        :param keystone_endpoint: Keystone Credentials endpoint
+        :type keystone_endpoint: keystone-credentials RelationBase
+        :returns: Glance client
+        :rtype: glanceclient.Client
+        """
+        region = self.regions()[0]
+        return self.glance_clients(keystone_endpoint,
+                                   regions=[region])[region]
 
-        if not image_id:
-            for image in glance_retrofitter.find_destination_image(
-                    glance,
-                    source_image.product_name,
-                    source_image.version_name):
-                if not force:
-                    raise DestinationImageExists(
-                        'image with product_name "{}" and '
-                        'version_name "{}" already exists: "{}"'
-                        .format(source_image.product_name,
-                                source_image.version_name, image.id))
-
-        input_file = tempfile.NamedTemporaryFile(delete=False, dir=TMPDIR)
-        ch_core.hookenv.atexit(os.unlink, input_file.name)
+    def published_images(self, glances, source_image, fingerprints):
+        """Find images previously retrofitted from source image.
+
+        :param glances: Glance client keyed by region
+        :type glances: Dict[Optional[str], glanceclient.Client]
+        :param source_image: Glance image object to retrofit
+        :type source_image: Glance image object
+        :param fingerprints: Fingerprint of the retrofit inputs keyed by
+                             region
+        :type fingerprints: Dict[Optional[str], str]
+        :returns: Glance image object or None keyed by region
+        :rtype: Dict[Optional[str], Optional[Glance image object]]
+        """
+        return {
+            region: next(iter(glance_retrofitter.find_destination_image(
+                glance,
+                source_image.product_name,
+                source_image.version_name,
+                fingerprint=fingerprints[region])), None)
+            for region, glance in glances.items()}
+
+    def source_image_cache(self):
+        """Get cache of downloaded source images.
+
+        :rtype: image_cache.ImageCache
+        """
+        return image_cache.ImageCache(
+            image_cache.CACHE_DIR,
+            (self.config['image-cache-size'] or 0) * MIB)
+
+    def fetch_source_image(self, glance, source_image):
+        """Get local copy of source image, from cache or Glance.
+
+        :param glance: Glance client
+        :type glance: glanceclient.Client
+        :param source_image: Glance image object to retrofit
+        :type source_image: Glance image object
+        :returns: Path to local copy and its digests
+        :rtype: Tuple[str, Dict[str, str]]
+        :raises: glance_retrofitter.TransferError, progress.TransferStalled
+        """
+        cache = self.source_image_cache()
+        cache_key = image_cache.cache_key(source_image)
+        input_path = cache.lookup(cache_key)
+        if input_path:
+            ch_core.hookenv.log('Using cached copy of "{}": "{}"'
+                                .format(source_image.name, input_path),
+                                level=ch_core.hookenv.INFO)
+            # Entries are only inserted with the digest of their key
+            # verified, so the cached data need not be hashed again.
+            return input_path, image_cache.key_digests(cache_key)
+        # The partial download is named after the image and kept when the
+        # download fails, so that the next run can resume it.
+        input_path = os.path.join(
+            TMPDIR, DOWNLOAD_FILE_NAME.format(source_image.id))
+        scratch_space = self.scratch_space()
+        scratch_space.track(input_path, resumable=True)
+        journal = glance_retrofitter.DownloadJournal(input_path)
+        description = 'Downloading {}'.format(source_image.name)
+        ch_core.hookenv.status_set('maintenance', description)
+        try:
+            source_digests = glance_retrofitter.download_image(
+                glance, source_image, journal.open(),
+                connections=self.config['download-connections'],
+                segment_size=(self.config['download-segment-size'] or 0) *
+                MIB,
+                journal=journal,
+                throttle=ratelimit.shared_bucket(
+                    ratelimit.DOWNLOAD, self.config['download-rate-limit']),
+                meter=self.transfer_meter(
+                    description,
+                    total=getattr(source_image, 'size', None) or 0))
+        except glance_retrofitter.ChecksumMismatch:
+            scratch_space.release(input_path)
+            raise
+        journal.remove()
+        scratch_space.track(input_path)
+        ch_core.hookenv.atexit(scratch_space.release, input_path)
+        cache.insert(cache_key, input_path, digests=source_digests)
+        return input_path, source_digests
+
+    @contextlib.contextmanager
+    def caching_package_proxy(self, envvars):
+        """Serve apt traffic of the retrofit tool from a local cache.
+
+        When ``package-cache-size`` is set a caching proxy is run for the
+        duration of the context.  Requests the cache can not answer are
+        forwarded to the proxy set in ``envvars``, if any.
+
+        The proxy listens on the host's loopback interface, which the
+        libguestfs appliance only reaches at
+        ``package_proxy.GUEST_HOST_ADDRESS`` when it runs with user mode
+        networking.  With other backends the cache is not used.
+        virt-customize passes the lower case proxy variables on to the
+        commands it runs in the guest, so the environment returned for the
+        retrofit tool only differs from ``envvars`` in ``http_proxy``, and
+        ``envvars`` itself is left alone.
+
+        :param envvars: Environment for the retrofit tool
+        :type envvars: Dict[str, str]
+        :returns: Environment to run the retrofit tool with
+        :rtype: Iterator[Dict[str, str]]
+        """
+        cache = image_cache.ImageCache(
+            package_proxy.CACHE_DIR,
+            (self.config['package-cache-size'] or 0) * MIB)
+        if not cache.enabled:
+            yield envvars
+            return
+        if not package_proxy.guest_reaches_host(envvars):
+            ch_core.hookenv.log('Package cache not used, the libguestfs '
+                                'backend "{}" does not use user mode '
+                                'networking'
+                                .format(envvars.get('LIBGUESTFS_BACKEND')),
+                                level=ch_core.hookenv.WARNING)
+            yield envvars
+            return
+        proxy = package_proxy.PackageProxy(
+            cache,
+            upstream=envvars.get('http_proxy') or envvars.get('HTTP_PROXY'),
+            no_proxy=envvars.get('no_proxy') or envvars.get('NO_PROXY'))
+        with package_proxy.serve(proxy) as port:
+            tool_envvars = dict(envvars)
+            tool_envvars['http_proxy'] = proxy.url(
+                package_proxy.GUEST_HOST_ADDRESS, port)
+            yield tool_envvars
+        ch_core.hookenv.log('Package cache: {}'.format(dict(proxy.stats)),
+                            level=ch_core.hookenv.INFO)
+
+    def disk_format(self, glance, source_image=None):
+        """Choose disk format of images to upload to a Glance.
+
+        See ``precheck.disk_format``.
+
+        :param glance: Glance client
+        :type glance: glanceclient.Client
+        :param source_image: Glance image object kept in the same Glance
+        :type source_image: Optional[Glance image object]
+        :returns: Disk format
+        :rtype: str
+        """
+        return precheck.disk_format(glance, self.config, source_image)
+
+    def disk_formats(self, glances, source_image):
+        """Choose disk format of images to upload to each region.
+
+        :param glances: Glance client keyed by region, source images are
+                        kept in the first region
+        :type glances: Dict[Optional[str], glanceclient.Client]
+        :param source_image: Glance image object to retrofit
+        :type source_image: Glance image object
+        :returns: Disk format keyed by region
+        :rtype: Dict[Optional[str], str]
+        """
+        disk_formats = {}
+        for region, glance in glances.items():
+            disk_formats[region] = self.disk_format(
+                glance, source_image if not disk_formats else None)
+            ch_core.hookenv.log('Using disk format "{}" for region "{}"'
+                                .format(disk_formats[region], region),
+                                level=ch_core.hookenv.DEBUG)
+        return disk_formats
+
+    def convert_image(self, path, source_format, disk_format):
+        """Convert retrofitted image to another disk format.
+
+        The converted image is written sparsely, with out of order writes
+        so that ``qemu-img`` can convert several ranges at once.
+
+        :param path: Path to retrofitted image
+        :type path: str
+        :param source_format: Disk format of retrofitted image
+        :type source_format: str
+        :param disk_format: Disk format to convert to
+        :type disk_format: str
+        :returns: Path to converted image
+        :rtype: str
+        :raises: subprocess.CalledProcessError, subprocess.TimeoutExpired
+        """
+        scratch_space = self.scratch_space()
+        output_path = scratch_space.allocate()
+        ch_core.hookenv.atexit(scratch_space.release, output_path)
         ch_core.hookenv.status_set('maintenance',
-                                   'Downloading {}'
-                                   .format(source_image.name))
-        glance_retrofitter.download_image(glance, source_image, input_file)
+                                   'Converting image to {}'
+                                   .format(disk_format))
+        cmd = ['qemu-img', 'convert', '-W', '-f', source_format,
+               '-O', disk_format, path, output_path]
+        try:
+            supervisor.run(self.limit_resources(cmd),
+                           name='qemu-img',
+                           timeout=self.config['retrofit-timeout'] or None)
+        except (subprocess.CalledProcessError, subprocess.TimeoutExpired):
+            scratch_space.release(output_path)
+            raise
+        return output_path
+
+    def build_image(self, source_image, uca_pocket, input_path,
+                    appliance_sizing=None, image_format=None):
+        """Run the ``octavia-diskimage-retrofit`` tool on a local image.
 
-        output_file = tempfile.NamedTemporaryFile(delete=False, dir=TMPDIR)
-        ch_core.hookenv.atexit(os.unlink, output_file.name)
-        output_file.close()
+        :param source_image: Glance image object to retrofit
+        :type source_image: Glance image object
+        :param uca_pocket: Ubuntu Cloud Archive pocket to add to the image
+        :type uca_pocket: Optional[str]
+        :param input_path: Path to local copy of source image
+        :type input_path: str
+        :param appliance_sizing: Sizing of libguestfs appliance, default is
+                                 to size it for a single appliance
+        :type appliance_sizing: Optional[Dict[str, Any]]
+        :param image_format: Disk format to write, default is
+                             ``image-format``
+        :type image_format: Optional[str]
+        :returns: Path to retrofitted image
+        :rtype: str
+        :raises: subprocess.CalledProcessError, subprocess.TimeoutExpired
+        """
+        scratch_space = self.scratch_space()
+        output_path = scratch_space.allocate()
+        ch_core.hookenv.atexit(scratch_space.release, output_path)
         ch_core.hookenv.status_set('maintenance',
                                    'Retrofitting {}'
                                    .format(source_image.name))
         cmd = ['octavia-diskimage-retrofit']
-        if self.config['retrofit-uca-pocket']:
-            cmd.extend(['-u', self.config['retrofit-uca-pocket']])
-        elif ubuntu_release == '18.04':
-            # Conditional default depending on ubuntu release used for amphora
-            cmd.extend(['-u', 'ussuri'])
+        if uca_pocket:
+            cmd.extend(['-u', uca_pocket])
 
         if self.config['debug']:
             cmd.append('-d')
         if self.config['ubuntu-mirror']:
             cmd.append('-m')
             cmd.append(self.config['ubuntu-mirror'])
-        if self.config['image-format']:
+        if not image_format and self.config['image-format'] != FORMAT_AUTO:
+            image_format = self.config['image-format']
+        if image_format:
             cmd.append('-O')
-            cmd.append(self.config['image-format'])
+            cmd.append(image_format)
         if self.config['uca-mirror']:
             uca_mirror = self.config['uca-mirror']
             if '|' in uca_mirror:
                 uca_mirror = uca_mirror.split('|')[0].strip()
             cmd.append('-c')
             cmd.append(uca_mirror)
-        cmd.extend([input_file.name, output_file.name])
+        cmd.extend([input_path, output_path])
+        cmd = self.limit_resources(cmd)
         try:
             # We want to pass the [juju-]{http,https,ftp,no}-proxy model
             # configs as envvars (http_proxy, HTTP_PROXY, https_proxy, etc.) to
@@ -276,65 +731,751 @@ class OctaviaDiskimageRetrofitCharm(charms_openstack.charm.OpenStackCharm):
             envvars = os.environ.copy()
             if proxy_envvars is not None:
                 envvars.update(proxy_envvars)
-            output = subprocess.check_output(
-                cmd, stderr=subprocess.STDOUT, universal_newlines=True,
-                env=envvars)
-            ch_core.hookenv.log('Output from "{}": "{}"'.format(cmd, output),
+            envvars.update(appliance.environment(self.get_snap_revision()))
+            envvars.update(sizing.environment(
+                appliance_sizing or self.appliance_sizing()))
+            warm = appliance.is_warm(envvars['LIBGUESTFS_CACHEDIR'])
+            start = time.monotonic()
+            with self.caching_package_proxy(envvars) as tool_envvars:
+                output = supervisor.run(
+                    cmd, env=tool_envvars, name=source_image.name,
+                    timeout=self.config['retrofit-timeout'] or None,
+                    on_progress=progress.ProgressReporter(
+                        lambda msg: ch_core.hookenv.status_set(
+                            'maintenance', 'Retrofitting {}: {}'
+                            .format(source_image.name, msg))))
+            ch_core.hookenv.log('Tail of output from "{}": "{}"'
+                                .format(cmd, output),
                                 level=ch_core.hookenv.DEBUG)
+            ch_core.hookenv.log('Retrofitting {} took {:.1f}s with {} '
+                                'appliance cache'
+                                .format(source_image.name,
+                                        time.monotonic() - start,
+                                        'warm' if warm else 'cold'),
+                                level=ch_core.hookenv.INFO)
         except subprocess.CalledProcessError as e:
-            ch_core.hookenv.log('Call to "{}" failed, output: "{}"'
+            ch_core.hookenv.log('Call to "{}" failed, tail of output: "{}"'
                                 .format(cmd, e.output),
                                 level=ch_core.hookenv.ERROR)
+            scratch_space.release(output_path)
+            raise
+        except subprocess.TimeoutExpired as e:
+            ch_core.hookenv.log('Call to "{}" timed out after {}s, tail of '
+                                'output: "{}"'
+                                .format(cmd, e.timeout, e.output),
+                                level=ch_core.hookenv.ERROR)
+            scratch_space.release(output_path)
             raise
 
         # NOTE(fnordahl) the manifest is stored within the image itself in
         # ``/etc/dib-manifests``.  A copy of the manifest is saved on the host
         # by the ``octavia-diskimage-retrofit`` tool.  With the lack of a place
         # to store the copy, remove it.  (it does not fit in a Glance image
-        # property)
-        manifest_file = output_file.name + '.manifest'
-        ch_core.hookenv.atexit(os.unlink, manifest_file)
+        # property)  The scratch space removes it along with the image.
+        return output_path
+
+    def image_name(self, source_image):
+        """Build an informative name for image retrofitted from source image.
 
+        :param source_image: Glance image object that was retrofitted
+        :type source_image: Glance image object
+        :rtype: str
+        """
         dest_name = 'amphora-haproxy'
         for image_property in (source_image.architecture,
                                source_image.os_distro,
                                source_image.os_version,
                                source_image.version_name):
-            # build a informative image name
             dest_name += '-' + str(image_property)
-        dest_arch = source_image.architecture
-        img_format = self.config['image-format'] or "qcow2"
-        dest_image = glance.images.create(container_format='bare',
-                                          disk_format=img_format,
-                                          name=dest_name,
-                                          architecture=dest_arch)
-        ch_core.hookenv.status_set('maintenance',
-                                   'Uploading {}'
-                                   .format(dest_image.name))
-        with open(output_file.name, 'rb') as fin:
-            glance.images.upload(dest_image.id, fin)
+        return dest_name
+
+    def import_options(self, glance):
+        """Decide whether to use image import to get data into Glance.
+
+        With ``upload-method`` set to 'auto' image import is used when
+        Glance advertises the ``glance-direct`` import method.
+
+        :param glance: Glance client
+        :type glance: glanceclient.Client
+        :returns: Keyword arguments for ``glance_retrofitter.import_image``
+                  or None to upload through the API
+        :rtype: Optional[Dict[str, Any]]
+        """
+        method = self.config['upload-method'] or 'auto'
+        if method == 'upload':
+            return None
+        if (method == 'auto' and glance_retrofitter.IMPORT_METHOD not in
+                glance_retrofitter.import_methods(glance)):
+            return None
+        stores = (self.config['import-stores'] or '').replace(
+            ',', ' ').split()
+        if stores == ['all']:
+            return {'all_stores': True}
+        if stores:
+            return {'stores': stores}
+        return {}
+
+    def publish_image(self, glances, source_image, output_path, fingerprints,
+                      hash_algo=None, output_format=None, disk_formats=None):
+        """Upload retrofitted image to Glance in each region.
 
+        The image is uploaded to all regions concurrently from a single read
+        of ``output_path``, regions wanting another disk format from a
+        single read of a converted copy of it.  Uploads to regions that
+        failed are retried up to ``UPLOAD_ATTEMPTS`` times in total, each
+        attempt with a new image.  Regions where image import is used fall
+        back to uploading through the API on retry unless ``upload-method``
+        is 'import'.
+
+        :param glances: Glance client keyed by region
+        :type glances: Dict[Optional[str], glanceclient.Client]
+        :param source_image: Glance image object that was retrofitted
+        :type source_image: Glance image object
+        :param output_path: Path to retrofitted image
+        :type output_path: str
+        :param fingerprints: Fingerprint of the retrofit inputs keyed by
+                             region
+        :type fingerprints: Dict[Optional[str], str]
+        :param hash_algo: Hash algorithm to verify the upload with
+        :type hash_algo: Optional[str]
+        :param output_format: Disk format of retrofitted image, default is
+                              ``image-format``
+        :type output_format: Optional[str]
+        :param disk_formats: Disk format to upload keyed by region, default
+                             is ``output_format`` for all regions
+        :type disk_formats: Optional[Dict[Optional[str], str]]
+        :returns: Result of upload keyed by region
+        :rtype: Dict[Optional[str], fanout.UploadResult]
+        :raises: subprocess.CalledProcessError, subprocess.TimeoutExpired
+        """
+        dest_name = self.image_name(source_image)
+        if not output_format:
+            output_format = self.config['image-format'] or FORMAT_QCOW2
+            if output_format == FORMAT_AUTO:
+                output_format = FORMAT_QCOW2
+        disk_formats = disk_formats or {
+            region: output_format for region in glances}
+        paths = {output_format: output_path}
+        scratch_space = self.scratch_space()
+        try:
+            for disk_format in sorted(set(disk_formats.values())):
+                if disk_format not in paths:
+                    paths[disk_format] = self.convert_image(
+                        output_path, output_format, disk_format)
+        except (subprocess.CalledProcessError, subprocess.TimeoutExpired):
+            for path in paths.values():
+                if path != output_path:
+                    scratch_space.release(path)
+            raise
         tags = [self.name]
         custom_tag = self.config['amp-image-tag']
         if custom_tag:
             tags.append(custom_tag)
-        glance.images.update(
-            dest_image.id,
-            source_product_name=source_image.product_name or 'custom',
-            source_version_name=source_image.version_name or 'custom',
-            tags=tags)
+        results = {}
+        pending = list(glances)
+        imports = {}
+        for region, glance in glances.items():
+            options = self.import_options(glance)
+            if options is not None:
+                imports[region] = options
+        throttle = ratelimit.shared_bucket(ratelimit.UPLOAD,
+                                           self.config['upload-rate-limit'])
+        meters = {
+            disk_format: self.transfer_meter(
+                'Uploading {} ({})'.format(dest_name, disk_format)
+                if len(paths) > 1 else 'Uploading {}'.format(dest_name))
+            for disk_format in paths}
+        for attempt in range(1, UPLOAD_ATTEMPTS + 1):
+            targets = {}
+            for region in pending:
+                try:
+                    dest_image = glances[region].images.create(
+                        container_format='bare',
+                        disk_format=disk_formats[region],
+                        name=dest_name,
+                        architecture=source_image.architecture)
+                    targets[region] = (glances[region], dest_image.id)
+                except Exception as e:
+                    results[region] = fanout.UploadResult(error=e)
+            ch_core.hookenv.status_set('maintenance',
+                                       'Uploading {}'.format(dest_name))
+            for disk_format, path in paths.items():
+                results.update(fanout.upload(
+                    {region: target for region, target in targets.items()
+                     if disk_formats[region] == disk_format},
+                    path, hash_algo=hash_algo, imports=imports,
+                    throttle=throttle, meter=meters[disk_format]))
+            for region in pending:
+                result = results[region]
+                result.attempts = attempt
+                glance = glances[region]
+                if not result.error:
+                    try:
+                        glance.images.update(
+                            result.image_id,
+                            source_product_name=(
+                                source_image.product_name or 'custom'),
+                            source_version_name=(
+                                source_image.version_name or 'custom'),
+                            retrofit_fingerprint=fingerprints[region],
+                            tags=tags)
+                        continue
+                    except Exception as e:
+                        result.error = e
+                ch_core.hookenv.log('Uploading "{}" to region "{}" failed '
+                                    '(attempt {} of {}): {}'
+                                    .format(dest_name, region, attempt,
+                                            UPLOAD_ATTEMPTS,
+                                            str(result.error)),
+                                    level=ch_core.hookenv.WARNING)
+                if result.image_id:
+                    ch_core.hookenv.log('Removing incomplete image "{}"'
+                                        .format(result.image_id),
+                                        level=ch_core.hookenv.ERROR)
+                    try:
+                        glance.images.delete(result.image_id)
+                    except Exception as e:
+                        ch_core.hookenv.log('Removing image "{}" failed: {}'
+                                            .format(result.image_id, str(e)),
+                                            level=ch_core.hookenv.ERROR)
+            pending = [region for region in pending if results[region].error]
+            if not pending:
+                break
+            if self.config['upload-method'] != 'import':
+                for region in pending:
+                    imports.pop(region, None)
+        for region, result in results.items():
+            if result.error:
+                ch_core.hookenv.log('Upload of "{}" to region "{}" failed: {}'
+                                    .format(dest_name, region,
+                                            str(result.error)),
+                                    level=ch_core.hookenv.ERROR)
+            else:
+                ch_core.hookenv.log('Uploaded "{}" to region "{}" as "{}": '
+                                    '{:.1f} MiB in {:.1f}s ({:.1f} MiB/s)'
+                                    .format(dest_name, region,
+                                            result.image_id, result.size / MIB,
+                                            result.seconds, result.throughput),
+                                    level=ch_core.hookenv.INFO)
+        for path in paths.values():
+            if path != output_path:
+                scratch_space.release(path)
+        return results
+
+    def record_last_run(self, image_id, digests):
+        """Store result of last successful run for status reporting.
+
+        :param image_id: ID of created image
+        :type image_id: str
+        :param digests: Source and upload digests
+        :type digests: Dict[str, Dict[str, str]]
+        """
         ts = time.strftime("%x %X")
-        self.db.set(KEY_LAST_RUN_IMAGE_ID, dest_image.id)
+        self.db.set(KEY_LAST_RUN_IMAGE_ID, image_id)
         self.db.set(KEY_LAST_RUN_TIME, ts)
+        self.db.set(KEY_LAST_RUN_DIGESTS, digests)
         self.db.flush()
-        ch_core.hookenv.log('Successfully created image "{}" with id "{}"'
-                            .format(dest_image.name, dest_image.id),
+
+    def record_run_metrics(self, run):
+        """Store metrics of a run and export them to Prometheus.
+
+        The run is added to the history of runs.  The metrics are written
+        for the node_exporter textfile collector when
+        ``prometheus-textfile-dir`` exists.
+
+        Runs that find all images up to date, such as most runs from cron,
+        keep the phase metrics and time of last success of the last run
+        that did work, they only update the ``up-to-date`` fields.
+
+        :param run: Metrics of the run
+        :type run: metrics.RunMetrics
+        """
+        run_data = run.to_dict()
+        previous = self.db.get(KEY_LAST_RUN_METRICS) or {}
+        if run_data['up-to-date']:
+            data = dict(previous or run_data)
+            data['up-to-date'] = True
+            data['last-up-to-date'] = run_data['finished']
+            outcome = 'found all images up to date'
+        else:
+            data = dict(run_data)
+            data['last-up-to-date'] = previous.get('last-up-to-date')
+            data['last-success'] = (data['finished'] if data['success']
+                                    else previous.get('last-success'))
+            outcome = 'succeeded' if data['success'] else 'failed'
+        self.db.set(KEY_LAST_RUN_METRICS, data)
+        self.db.set(KEY_RUN_HISTORY,
+                    history.append(self.run_history(),
+                                   history.entry(run_data)))
+        self.db.flush()
+        ch_core.hookenv.log('Retrofit run {}: {}'
+                            .format(outcome, metrics.summary(run_data)),
                             level=ch_core.hookenv.INFO)
+        directory = self.config['prometheus-textfile-dir']
+        if not (directory and os.path.isdir(directory)):
+            return
+        try:
+            metrics.write_textfile(
+                os.path.join(directory, metrics.TEXTFILE_NAME), data,
+                last_success=data.get('last-success'))
+        except OSError as e:
+            ch_core.hookenv.log('Unable to write metrics to "{}": {}'
+                                .format(directory, str(e)),
+                                level=ch_core.hookenv.WARNING)
+
+    def run_history(self):
+        """Get history of runs.
+
+        :returns: History entries, oldest first
+        :rtype: List[Dict[str, Any]]
+        """
+        return self.db.get(KEY_RUN_HISTORY) or []
+
+    @contextlib.contextmanager
+    def run_metrics(self):
+        """Collect metrics of a run and record them when it ends.
+
+        A run that finds all images up to date succeeds, and is marked up
+        to date when it neither created an image nor failed to.
+
+        :returns: Metrics of the run
+        :rtype: metrics.RunMetrics
+        """
+        run = metrics.RunMetrics()
+        success = False
+        try:
+            yield run
+            success = True
+        except DestinationImageExists:
+            success = True
+            raise
+        except Exception as e:
+            run.error = str(e) or type(e).__name__
+            raise
+        finally:
+            run.finish(success)
+            run.up_to_date = bool(run.success and run.images) and not any(
+                image['status'] in (batch.STATUS_CREATED, batch.STATUS_FAILED)
+                for image in run.images)
+            self.record_run_metrics(run)
+
+    @contextlib.contextmanager
+    def profiled(self, name, enabled=True):
+        """Profile a run and write the profile to ``profiling.PROFILE_DIR``.
+
+        Only the most recent ``profiling.MAX_PROFILES`` profiles are kept.
+        Failing to write the profile does not fail the run.
+
+        :param name: Name of the run, part of the profile file names
+        :type name: str
+        :param enabled: Whether to profile the run at all
+        :type enabled: bool
+        """
+        if not enabled:
+            yield
+            return
+        profile = profiling.Profile(name)
+        profile.start()
+        try:
+            yield
+        finally:
+            profile.stop()
+            try:
+                path = profile.dump(profiling.PROFILE_DIR)
+                profiling.prune(profiling.PROFILE_DIR)
+                ch_core.hookenv.log('Profile of {} run written to "{}", '
+                                    'peak memory {:.1f} MiB'
+                                    .format(name, path,
+                                            profile.peak_memory / MIB),
+                                    level=ch_core.hookenv.INFO)
+            except OSError as e:
+                ch_core.hookenv.log('Unable to write profile to "{}": {}'
+                                    .format(profiling.PROFILE_DIR, str(e)),
+                                    level=ch_core.hookenv.WARNING)
+
+    def retrofit(self, keystone_endpoint, force=False, image_id='',
+                 appliance_sizing=None, profile=False):
+        """Use ``octavia-diskimage-retrofit`` tool to retrofit an image.
+
+        The image is retrofitted once and uploaded to every region that does
+        not have an up to date image yet, or to every region when forced.
+        The duration and data volume of each phase of the run are recorded
+        with ``record_run_metrics``.
+
+        :param keystone_endpoint: Keystone Credentials endpoint
+        :type keystone_endpoint: keystone-credentials RelationBase
+        :param force: Force retrofitting of image despite presence of
+                      apparently up to date target image
+        :type force: bool
+        :param image_id: Use specific source image for retrofitting
+        :type image_id: str
+        :param appliance_sizing: Sizing of libguestfs appliance, default is
+                                 to size it for the host
+        :type appliance_sizing: Optional[Dict[str, Any]]
+        :param profile: Profile the run, see ``profiled``
+        :type profile: bool
+        :returns: Result of upload keyed by region
+        :rtype: Dict[Optional[str], fanout.UploadResult]
+        :raises:SourceImageNotFound,DestinationImageExists,
+                subprocess.CalledProcessError,subprocess.TimeoutExpired,
+                glance_retrofitter.TransferError, progress.TransferStalled,
+                scratch.ScratchSpaceExhausted
+        """
+        with self.profiled('retrofit', profile), self.run_metrics() as run:
+            scratch_space = self.scratch_space()
+            scratch_space.sweep()
+            with run.phase(metrics.AUTH):
+                glances = self.glance_clients(keystone_endpoint)
+            glance = next(iter(glances.values()))
+
+            with run.phase(metrics.DISCOVERY):
+                candidate_releases = self.candidate_releases()
+                ubuntu_release = candidate_releases[0]
+
+                if image_id:
+                    source_image = next(
+                        glance.images.list(filters={'id': image_id}))
+                else:
+                    source_image = None
+                    index = glance_retrofitter.discover_source_images(
+                        glance, candidate_releases)
+                    for release in candidate_releases:
+                        source_image = glance_retrofitter.find_source_image(
+                            index,
+                            release=release)
+                        if source_image:
+                            ubuntu_release = release
+                            break
+                    else:
+                        raise SourceImageNotFound(
+                            'unable to find suitable source image')
+
+                uca_pocket = precheck.uca_pocket_for_release(
+                    self.config['retrofit-uca-pocket'], ubuntu_release)
+                disk_formats = self.disk_formats(glances, source_image)
+                fingerprints = self.retrofit_fingerprints(
+                    source_image, uca_pocket, disk_formats)
+
+                if not image_id and not force:
+                    published = self.published_images(glances, source_image,
+                                                      fingerprints)
+                    for region, image in published.items():
+                        if image:
+                            run.add_image(source_image.id,
+                                          batch.STATUS_UP_TO_DATE,
+                                          image_id=image.id, label=region)
+                    if all(published.values()):
+                        raise DestinationImageExists(
+                            'image with product_name "{}", '
+                            'version_name "{}" and unchanged retrofit inputs '
+                            'already exists: "{}"'
+                            .format(source_image.product_name,
+                                    source_image.version_name,
+                                    '", "'.join(
+                                        image.id
+                                        for image in published.values())))
+                    glances = {region: client
+                               for region, client in glances.items()
+                               if not published[region]}
+                    disk_formats = {region: disk_formats[region]
+                                    for region in glances}
+                    fingerprints = {region: fingerprints[region]
+                                    for region in glances}
+            output_format = next(iter(disk_formats.values()))
+            scratch_space.admit(
+                self.scratch_space_needed(source_image, disk_formats),
+                keep=[os.path.join(
+                    TMPDIR, DOWNLOAD_FILE_NAME.format(source_image.id))])
+            with run.phase(metrics.DOWNLOAD) as phase:
+                input_path, source_digests = self.fetch_source_image(
+                    glance, source_image)
+                # Images served from the cache were not transferred.
+                if os.path.dirname(input_path) == TMPDIR:
+                    phase.bytes = getattr(source_image, 'size', None) or 0
+            with run.phase(metrics.RETROFIT) as phase:
+                output_path = self.build_image(
+                    source_image, uca_pocket, input_path,
+                    appliance_sizing=appliance_sizing,
+                    image_format=output_format)
+                with contextlib.suppress(OSError):
+                    phase.bytes = os.stat(output_path).st_size
+            with run.phase(metrics.UPLOAD) as phase:
+                uploads = self.publish_image(
+                    glances, source_image, output_path, fingerprints,
+                    hash_algo=glance_retrofitter.upload_hash_algo(
+                        source_digests),
+                    output_format=output_format, disk_formats=disk_formats)
+                phase.bytes = sum(result.size for result in uploads.values()
+                                  if not result.error)
+            for region, result in uploads.items():
+                run.add_image(source_image.id,
+                              batch.STATUS_FAILED if result.error
+                              else batch.STATUS_CREATED,
+                              image_id=result.image_id, label=region)
+            for result in uploads.values():
+                if result.error:
+                    continue
+                self.record_last_run(result.image_id,
+                                     {'source': source_digests,
+                                      'upload': result.digests})
+                ch_core.hookenv.log('Successfully created image "{}" with id '
+                                    '"{}" (source digests: {}, upload '
+                                    'digests: {})'
+                                    .format(self.image_name(source_image),
+                                            result.image_id, source_digests,
+                                            result.digests),
+                                    level=ch_core.hookenv.INFO)
+                break
+            if any(result.error for result in uploads.values()):
+                run.success = False
+        return uploads
+
+    def batch_matrix(self):
+        """Determine series and architectures to retrofit in batch mode.
+
+        :returns: (series, release, arch) tuples, empty when batch mode is
+                  not configured
+        :rtype: List[Tuple[str, str, str]]
+        """
+        series = (self.config['batch-series'] or '').split()
+        if not series:
+            return []
+        architectures = ((self.config['batch-architectures'] or '').split() or
+                         [glance_retrofitter.get_architecture()])
+        matrix = []
+        for codename in series:
+            release = self.get_ubuntu_release(series=codename)
+            for arch in architectures:
+                matrix.append((codename, release, arch))
+        return matrix
+
+    def scratch_space(self):
+        """Get scratch space for the files of a retrofit in ``TMPDIR``.
+
+        :rtype: scratch.ScratchSpace
+        """
+        return scratch.ScratchSpace(
+            TMPDIR, quota=(self.config['scratch-space-quota'] or 0) * MIB)
+
+    def scratch_space_needed(self, source_image, disk_formats=None):
+        """Estimate space in ``TMPDIR`` needed to retrofit an image.
+
+        Source images in the image cache are used from there and need no
+        room for a download.  Looking them up marks them recently used, so
+        they are not the first to be evicted before they are fetched.
+
+        :param source_image: Glance image object to retrofit
+        :type source_image: Glance image object
+        :param disk_formats: Disk format to upload keyed by region
+        :type disk_formats: Optional[Dict[Optional[str], str]]
+        :returns: Space in bytes
+        :rtype: int
+        """
+        cached = self.source_image_cache().lookup(
+            image_cache.cache_key(source_image))
+        return scratch.space_needed(
+            source_image, (disk_formats or {}).values(),
+            cached=bool(cached))
+
+    def retrofit_batch(self, keystone_endpoint, force=False,
+                       appliance_sizing=None, profile=False):
+        """Retrofit images for all configured series and architectures.
+
+        Images are pipelined, an image is downloaded while another is
+        retrofitted and a third is uploaded.  Downloads and uploads run with
+        up to ``batch-network-workers`` at a time, runs of the retrofit tool
+        with up to ``batch-build-workers`` at a time.  New images are only
+        started when their estimated scratch space is free in ``TMPDIR``,
+        and the files of an image are removed as soon as the stages using
+        them are done, or when it fails.  Metrics of the run are recorded
+        as for ``retrofit``, summed over all images.
+
+        :param keystone_endpoint: Keystone Credentials endpoint
+        :type keystone_endpoint: keystone-credentials RelationBase
+        :param force: Force retrofitting of images despite presence of
+                      apparently up to date target images
+        :type force: bool
+        :param appliance_sizing: Sizing of each libguestfs appliance,
+                                 default is to share the host between
+                                 ``batch-build-workers`` appliances
+        :type appliance_sizing: Optional[Dict[str, Any]]
+        :param profile: Profile the run, see ``profiled``
+        :type profile: bool
+        :returns: Items of the batch with their results
+        :rtype: List[batch.BatchItem]
+        :raises: BatchNotConfigured
+        """
+        matrix = self.batch_matrix()
+        if not matrix:
+            raise BatchNotConfigured('batch-series is not configured')
+        items = [batch.BatchItem(series, release, arch)
+                 for series, release, arch in matrix]
+        with self.profiled('retrofit-batch', profile), \
+                self.run_metrics() as run:
+            scratch_space = self.scratch_space()
+            scratch_space.sweep()
+            appliance_sizing = appliance_sizing or self.appliance_sizing(
+                workers=self.config['batch-build-workers'])
+            with run.phase(metrics.AUTH):
+                glances = self.glance_clients(keystone_endpoint)
+            glance = next(iter(glances.values()))
+            with run.phase(metrics.DISCOVERY):
+                index = glance_retrofitter.discover_source_images(
+                    glance,
+                    sorted(set(item.release for item in items)),
+                    architectures=sorted(set(item.arch for item in items)))
+                for item in items:
+                    item.source_image = glance_retrofitter.find_source_image(
+                        index, item.release, arch=item.arch)
+                    if not item.source_image:
+                        item.status = batch.STATUS_NOT_FOUND
+                        item.message = 'unable to find suitable source image'
+                        continue
+                    item.uca_pocket = precheck.uca_pocket_for_release(
+                        self.config['retrofit-uca-pocket'], item.release)
+                    item.disk_formats = self.disk_formats(
+                        glances, item.source_image)
+                    item.fingerprints = self.retrofit_fingerprints(
+                        item.source_image, item.uca_pocket, item.disk_formats)
+                    item.regions = list(glances)
+                    if not force:
+                        published = self.published_images(
+                            glances, item.source_image, item.fingerprints)
+                        if all(published.values()):
+                            item.status = batch.STATUS_UP_TO_DATE
+                            item.image_id = next(iter(published.values())).id
+                            continue
+                        item.regions = [region
+                                        for region, image in published.items()
+                                        if not image]
+                        item.disk_formats = {
+                            region: item.disk_formats[region]
+                            for region in item.regions}
+                        item.fingerprints = {
+                            region: item.fingerprints[region]
+                            for region in item.regions}
+
+            def fetch(item):
+                with run.phase(metrics.DOWNLOAD) as phase:
+                    item.input_path, item.source_digests = (
+                        self.fetch_source_image(glance, item.source_image))
+                    # Images served from the cache were not transferred.
+                    if os.path.dirname(item.input_path) == TMPDIR:
+                        phase.bytes = getattr(
+                            item.source_image, 'size', None) or 0
+
+            def build(item):
+                with run.phase(metrics.RETROFIT) as phase:
+                    item.output_path = self.build_image(
+                        item.source_image, item.uca_pocket, item.input_path,
+                        appliance_sizing=appliance_sizing,
+                        image_format=next(iter(item.disk_formats.values())))
+                    with contextlib.suppress(OSError):
+                        phase.bytes = os.stat(item.output_path).st_size
+                scratch_space.release(item.input_path)
+
+            def publish(item):
+                try:
+                    with run.phase(metrics.UPLOAD) as phase:
+                        uploads = self.publish_image(
+                            {region: glances[region]
+                             for region in item.regions},
+                            item.source_image, item.output_path,
+                            item.fingerprints,
+                            hash_algo=glance_retrofitter.upload_hash_algo(
+                                item.source_digests),
+                            output_format=next(
+                                iter(item.disk_formats.values())),
+                            disk_formats=item.disk_formats)
+                        phase.bytes = sum(result.size
+                                          for result in uploads.values()
+                                          if not result.error)
+                finally:
+                    scratch_space.release(item.output_path)
+                failed = [str(region) for region, result in uploads.items()
+                          if result.error]
+                for result in uploads.values():
+                    if not result.error:
+                        item.image_id = result.image_id
+                        item.upload_digests = result.digests
+                        break
+                if failed:
+                    raise RegionUploadFailed('upload failed for regions: {}'
+                                             .format(', '.join(failed)))
+
+            def cleanup(item):
+                for path in (item.input_path, item.output_path):
+                    if path:
+                        scratch_space.release(path)
+                # A partial download is kept for the next run to resume.
+                try:
+                    return os.stat(os.path.join(
+                        TMPDIR, DOWNLOAD_FILE_NAME.format(
+                            item.source_image.id))).st_blocks * 512
+                except FileNotFoundError:
+                    return 0
+
+            scheduler = batch.BatchScheduler(
+                network_workers=self.config['batch-network-workers'],
+                build_workers=self.config['batch-build-workers'],
+                scratch_dir=TMPDIR,
+                space_available=scratch_space.available)
+            scheduler.run(items,
+                          ((batch.NETWORK, fetch),
+                           (batch.BUILD, build),
+                           (batch.NETWORK, publish)),
+                          space_needed=lambda item: self.scratch_space_needed(
+                              item.source_image, item.disk_formats),
+                          cleanup=cleanup)
+            for item in items:
+                ch_core.hookenv.log('Batch retrofit of "{}": {}'
+                                    .format(item.key, item.result()),
+                                    level=ch_core.hookenv.INFO)
+                run.add_image(getattr(item.source_image, 'id', None),
+                              item.status, image_id=item.image_id,
+                              label=item.key)
+                if item.status == batch.STATUS_CREATED:
+                    # the unit database must not be used from worker threads
+                    self.record_last_run(item.image_id,
+                                         {'source': item.source_digests,
+                                          'upload': item.upload_digests})
+            if any(item.status == batch.STATUS_FAILED for item in items):
+                run.success = False
+        return items
+
+    def custom_assess_status_check(self):
+        """Check that rate limited transfers are not taken for stalls.
+
+        Concurrent transfers share the rate limits, each of them must be
+        able to reach ``transfer-min-rate`` within its share.
+
+        :returns: Workload status and message or (None, None)
+        :rtype: Tuple[Optional[str], Optional[str]]
+        """
+        min_rate = self.config['transfer-min-rate']
+        if not min_rate:
+            return None, None
+        transfers = 1
+        if (self.config['batch-series'] or '').split():
+            transfers = max(self.config['batch-network-workers'] or 1, 1)
+        for option in ('download-rate-limit', 'upload-rate-limit'):
+            limit = self.config[option]
+            if limit and min_rate * transfers >= limit:
+                return 'blocked', (
+                    'transfer-min-rate of {} concurrent transfers must be '
+                    'below {}'.format(transfers, option))
+        return None, None
 
     def custom_assess_status_last_check(self):
         image_id = self.db.get(KEY_LAST_RUN_IMAGE_ID)
         last_run_time = self.db.get(KEY_LAST_RUN_TIME)
         if image_id and last_run_time:
+            duration = (self.db.get(KEY_LAST_RUN_METRICS) or {}).get(
+                'duration')
+            if duration is not None:
+                return 'active', 'Unit is ready (Image {} retrofitting ' \
+                       'completed at {}, last run took {:.0f}s)'.format(
+                           image_id, last_run_time, duration)
             return 'active', 'Unit is ready (Image {} retrofitting ' \
                    'completed at {})'.format(image_id, last_run_time)
         else:
@@ -0,0 +1,388 @@
+# Copyright 2022 Canonical Ltd
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#  http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import base64
+import collections
+import contextlib
+import hashlib
+import hmac
+import http.server
+import json
+import os
+import re
+import secrets
+import shutil
+import tempfile
+import threading
+import urllib.error
+import urllib.parse
+import urllib.request
+
+import charmhelpers.core as ch_core
+
+CACHE_DIR = '/var/snap/octavia-diskimage-retrofit/common/package-cache'
+# Address of the host as seen from the user mode network of the libguestfs
+# appliance, connections to it reach the host's loopback interface.
+GUEST_HOST_ADDRESS = '10.0.2.2'
+# libguestfs backends that run the appliance with user mode networking,
+# the libvirt backend attaches it to a network of its own.
+USER_NETWORK_BACKENDS = ('direct',)
+DEFAULT_BACKEND = 'direct'
+# User name clients authenticate to the proxy with, the password is a
+# token generated for each proxy.
+PROXY_USER = 'retrofit'
+UPSTREAM_TIMEOUT = 60
+CHUNK_SIZE = 64 * 1024
+# Validators of a response are cached as an entry of their own, keyed like
+# the response with this algorithm name, so they count towards the size of
+# the cache and are evicted like any other entry.
+META_ALGO = 'meta'
+# Packages and by-hash indexes never change content under the same URL.
+IMMUTABLE_RE = re.compile(r'(\.u?deb|/by-hash/[^/]+/[0-9a-fA-F]+)$')
+INDEX_RE = re.compile(
+    r'/(InRelease|Release(\.gpg)?|(Packages|Sources|Translation-[^/]+)'
+    r'(\.(gz|bz2|xz|lz4|zst))?)$')
+HEADERS = ('Content-Type', 'ETag', 'Last-Modified')
+
+
+def url_key(url):
+    """Build cache key for URL.
+
+    :param url: URL
+    :type url: str
+    :returns: Key usable with ``image_cache.ImageCache``
+    :rtype: str
+    """
+    return 'sha256-' + hashlib.sha256(url.encode()).hexdigest()
+
+
+def meta_key(key):
+    """Build cache key for the validators of a cached response.
+
+    :param key: Cache key of response as returned by ``url_key``
+    :type key: str
+    :rtype: str
+    """
+    return '{}-{}'.format(META_ALGO, key.split('-', 1)[1])
+
+
+def guest_reaches_host(env):
+    """Whether the libguestfs appliance can reach the proxy on the host.
+
+    :param env: Environment the retrofit tool is run with
+    :type env: Mapping[str, str]
+    :rtype: bool
+    """
+    backend = env.get('LIBGUESTFS_BACKEND') or DEFAULT_BACKEND
+    return backend.split(':', 1)[0] in USER_NETWORK_BACKENDS
+
+
+def is_cacheable(url):
+    """Whether URL refers to a package or an archive index.
+
+    :param url: URL
+    :type url: str
+    :rtype: bool
+    """
+    path = urllib.parse.urlsplit(url).path
+    return bool(IMMUTABLE_RE.search(path) or INDEX_RE.search(path))
+
+
+def is_immutable(url):
+    """Whether cached content for URL can be served without revalidation.
+
+    :param url: URL
+    :type url: str
+    :rtype: bool
+    """
+    return bool(IMMUTABLE_RE.search(urllib.parse.urlsplit(url).path))
+
+
+class PackageProxy(object):
+    """Caching forward proxy for apt traffic of the retrofit tool.
+
+    Packages are served from the cache without contacting the mirror,
+    archive indexes are revalidated with the mirror using the ``ETag`` and
+    ``Last-Modified`` validators stored along with them.  Entries are kept
+    in an ``image_cache.ImageCache`` which caps their total size and evicts
+    the least recently used ones.  A response whose validators were evicted
+    is fetched again.
+
+    Clients must authenticate with ``PROXY_USER`` and the token of the
+    proxy, so other local users can not use it to reach the mirror or the
+    upstream proxy.
+    """
+
+    def __init__(self, cache, upstream=None, no_proxy=None, token=None):
+        """Initialize proxy.
+
+        :param cache: Store for cached responses
+        :type cache: image_cache.ImageCache
+        :param upstream: URL of proxy to forward requests to
+        :type upstream: Optional[str]
+        :param no_proxy: Hosts to not use the upstream proxy for
+        :type no_proxy: Optional[str]
+        :param token: Password clients authenticate with, default is a
+                      random token
+        :type token: Optional[str]
+        """
+        self.cache = cache
+        self.upstream = upstream
+        self.no_proxy = no_proxy
+        self.token = token or secrets.token_hex(16)
+        self.stats = collections.Counter()
+        self.stats_lock = threading.Lock()
+
+    def count(self, stat):
+        with self.stats_lock:
+            self.stats[stat] += 1
+
+    def url(self, host, port):
+        """Build proxy URL carrying the credentials of the proxy.
+
+        :param host: Address clients reach the proxy at
+        :type host: str
+        :param port: Port the proxy listens on
+        :type port: int
+        :rtype: str
+        """
+        return 'http://{}:{}@{}:{}'.format(PROXY_USER, self.token, host, port)
+
+    def authorized(self, handler):
+        """Whether request carries the credentials of the proxy.
+
+        :param handler: Request handler
+        :type handler: http.server.BaseHTTPRequestHandler
+        :rtype: bool
+        """
+        expected = 'Basic ' + base64.b64encode(
+            '{}:{}'.format(PROXY_USER, self.token).encode()).decode()
+        return hmac.compare_digest(
+            (handler.headers.get('Proxy-Authorization') or '').encode(),
+            expected.encode())
+
+    def open_upstream(self, url, headers):
+        """Request URL from mirror, through upstream proxy if configured.
+
+        :param url: URL
+        :type url: str
+        :param headers: Request headers
+        :type headers: Dict[str, str]
+        :returns: Response
+        :rtype: http.client.HTTPResponse
+        :raises: urllib.error.URLError, OSError
+        """
+        proxies = {}
+        host = urllib.parse.urlsplit(url).hostname or ''
+        if self.upstream and not urllib.request.proxy_bypass_environment(
+                host, {'no': self.no_proxy or ''}):
+            proxies['http'] = self.upstream
+        opener = urllib.request.build_opener(
+            urllib.request.ProxyHandler(proxies))
+        return opener.open(urllib.request.Request(url, headers=headers),
+                           timeout=UPSTREAM_TIMEOUT)
+
+    def read_meta(self, key):
+        entry = self.cache.lookup(meta_key(key))
+        if not entry:
+            return None
+        try:
+            with open(entry) as f:
+                return json.load(f)
+        except (OSError, ValueError):
+            return None
+
+    def store(self, key, url, path, headers):
+        """Add downloaded response to cache along with its validators.
+
+        :param key: Cache key
+        :type key: str
+        :param url: URL of response
+        :type url: str
+        :param path: Path to file holding response body
+        :type path: str
+        :param headers: Response headers
+        :type headers: email.message.Message
+        """
+        # a changed index replaces the previously cached one
+        self.cache.remove(meta_key(key))
+        self.cache.remove(key)
+        if not self.cache.insert(key, path):
+            return
+        meta = {'url': url}
+        for header in HEADERS:
+            if headers.get(header):
+                meta[header] = headers[header]
+        with tempfile.NamedTemporaryFile(
+                'w', dir=self.cache.path, prefix='.partial-',
+                delete=False) as f:
+            json.dump(meta, f)
+        try:
+            self.cache.insert(meta_key(key), f.name)
+        finally:
+            os.unlink(f.name)
+
+    def send_cached(self, handler, entry, meta, head=False):
+        with open(entry, 'rb') as f:
+            handler.send_response(200)
+            for header in HEADERS:
+                if meta.get(header):
+                    handler.send_header(header, meta[header])
+            handler.send_header('Content-Length',
+                                str(os.fstat(f.fileno()).st_size))
+            handler.end_headers()
+            if not head:
+                shutil.copyfileobj(f, handler.wfile, CHUNK_SIZE)
+
+    def handle(self, handler, head=False):
+        """Serve a proxy request.
+
+        :param handler: Request handler
+        :type handler: http.server.BaseHTTPRequestHandler
+        :param head: Whether the request is a HEAD request
+        :type head: bool
+        """
+        if not self.authorized(handler):
+            self.count('denied')
+            handler.send_response(407)
+            handler.send_header('Proxy-Authenticate',
+                                'Basic realm="package-cache"')
+            handler.send_header('Content-Length', '0')
+            handler.end_headers()
+            return
+        url = handler.path
+        if not url.startswith('http://'):
+            handler.send_error(400, 'Only absolute http URLs are supported')
+            return
+        key = url_key(url) if is_cacheable(url) else None
+        entry = self.cache.lookup(key) if key else None
+        meta = self.read_meta(key) if entry else None
+        if meta and meta.get('url') != url:
+            meta = None
+        if meta and is_immutable(url):
+            self.count('hit')
+            self.send_cached(handler, entry, meta, head)
+            return
+        headers = {'User-Agent': handler.headers.get('User-Agent', '')}
+        if meta and meta.get('ETag'):
+            headers['If-None-Match'] = meta['ETag']
+        if meta and meta.get('Last-Modified'):
+            headers['If-Modified-Since'] = meta['Last-Modified']
+        try:
+            resp = self.open_upstream(url, headers)
+        except urllib.error.HTTPError as e:
+            if e.code == 304 and meta:
+                self.count('revalidated')
+                self.send_cached(handler, entry, meta, head)
+            else:
+                self.count('error')
+                handler.send_error(e.code, e.reason)
+            e.close()
+            return
+        except (urllib.error.URLError, OSError) as e:
+            if meta:
+                ch_core.hookenv.log('Serving stale "{}" from package cache: '
+                                    '{}'.format(url, str(e)),
+                                    level=ch_core.hookenv.WARNING)
+                self.count('stale')
+                self.send_cached(handler, entry, meta, head)
+            else:
+                self.count('error')
+                handler.send_error(502, str(e))
+            return
+        self.count('miss')
+        with resp:
+            self.relay(handler, resp, key if not head else None, url, head)
+
+    def relay(self, handler, resp, key, url, head=False):
+        """Stream upstream response to client, storing it when cacheable.
+
+        :param handler: Request handler
+        :type handler: http.server.BaseHTTPRequestHandler
+        :param resp: Upstream response
+        :type resp: http.client.HTTPResponse
+        :param key: Cache key or None if response is not to be cached
+        :type key: Optional[str]
+        :param url: Requested URL
+        :type url: str
+        :param head: Whether the request is a HEAD request
+        :type head: bool
+        """
+        handler.send_response(resp.status)
+        length = resp.headers.get('Content-Length')
+        for header in HEADERS:
+            if resp.headers.get(header):
+                handler.send_header(header, resp.headers[header])
+        if length:
+            handler.send_header('Content-Length', length)
+        handler.end_headers()
+        if head:
+            return
+        spool = None
+        if key and resp.status == 200 and self.cache.enabled:
+            os.makedirs(self.cache.path, mode=0o700, exist_ok=True)
+            spool = tempfile.NamedTemporaryFile(
+                dir=self.cache.path, prefix='.partial-', delete=False)
+        received = 0
+        try:
+            for chunk in iter(lambda: resp.read(CHUNK_SIZE), b''):
+                received += len(chunk)
+                if spool:
+                    spool.write(chunk)
+                handler.wfile.write(chunk)
+            if spool:
+                spool.close()
+                if length is None or int(length) == received:
+                    self.store(key, url, spool.name, resp.headers)
+        finally:
+            if spool:
+                spool.close()
+                os.unlink(spool.name)
+
+
+class ProxyRequestHandler(http.server.BaseHTTPRequestHandler):
+
+    def log_message(self, *args):
+        pass
+
+    def do_GET(self):
+        self.server.proxy.handle(self)
+
+    def do_HEAD(self):
+        self.server.proxy.handle(self, head=True)
+
+
+@contextlib.contextmanager
+def serve(proxy, address='127.0.0.1'):
+    """Run proxy in background threads for the duration of the context.
+
+    :param proxy: Proxy to serve
+    :type proxy: PackageProxy
+    :param address: Address to listen on
+    :type address: str
+    :returns: Port the proxy listens on
+    :rtype: Iterator[int]
+    """
+    server = http.server.ThreadingHTTPServer((address, 0),
+                                             ProxyRequestHandler)
+    server.daemon_threads = True
+    server.proxy = proxy
+    thread = threading.Thread(target=server.serve_forever)
+    thread.daemon = True
+    thread.start()
+    try:
+        yield server.server_address[1]
+    finally:
+        server.shutdown()
+        server.server_close()
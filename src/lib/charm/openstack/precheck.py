@@ -0,0 +1,257 @@
+# Copyright 2022 Canonical Ltd
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#  http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Cheap check for pending retrofit work, run by cron outside of Juju.
+
+Must remain importable without the reactive framework or charms_openstack.
+"""
+
+import hashlib
+import json
+import os
+import sys
+
+import charm.openstack.glance_retrofitter as glance_retrofitter
+import charm.openstack.token_cache as token_cache
+
+STATE_FILE = '/var/snap/octavia-diskimage-retrofit/common/precheck.json'
+SNAP_CURRENT = '/snap/octavia-diskimage-retrofit/current'
+FINGERPRINT_CONFIG = ('ubuntu-mirror', 'uca-mirror', 'image-format')
+EXIT_NO_WORK, EXIT_WORK_PENDING = 0, 1
+FORMAT_AUTO = 'auto'
+FORMAT_RAW, FORMAT_QCOW2 = 'raw', 'qcow2'
+RBD_STORE_TYPE = 'rbd'
+
+
+def get_snap_revision():
+    """Determine revision of installed ``octavia-diskimage-retrofit`` snap.
+
+    :returns: Snap revision or None if the snap is not installed
+    :rtype: Optional[str]
+    """
+    try:
+        return os.readlink(SNAP_CURRENT)
+    except OSError:
+        return None
+
+
+def uca_pocket_for_release(uca_pocket, release):
+    """Determine Ubuntu Cloud Archive pocket to add to the image.
+
+    :param uca_pocket: Configured pocket
+    :type uca_pocket: Optional[str]
+    :param release: Ubuntu release number of source image
+    :type release: str
+    :returns: Pocket or None
+    :rtype: Optional[str]
+    """
+    if not uca_pocket and release == '18.04':
+        # Conditional default depending on ubuntu release used for amphora
+        return 'ussuri'
+    return uca_pocket or None
+
+
+def disk_format(glance, config, source_image=None):
+    """Choose disk format of images to upload to a Glance.
+
+    With ``image-format`` set to 'auto' raw is chosen when images end up in
+    Ceph RBD, where Nova and Cinder clone them without conversion, and qcow2
+    otherwise.  The stores images are put in are looked up in Glance, when
+    it does not tell their type the location of the source image in the
+    same Glance is used.
+
+    :param glance: Glance client
+    :type glance: glanceclient.Client
+    :param config: Charm configuration
+    :type config: Mapping[str, Any]
+    :param source_image: Glance image object kept in the same Glance
+    :type source_image: Optional[Glance image object]
+    :returns: Disk format
+    :rtype: str
+    """
+    disk_format = config['image-format'] or FORMAT_QCOW2
+    if disk_format != FORMAT_AUTO:
+        return disk_format
+    stores = glance_retrofitter.get_stores(glance)
+    wanted = (config['import-stores'] or '').replace(',', ' ').split()
+    if wanted == ['all']:
+        selected = list(stores.values())
+    elif wanted:
+        selected = [stores[store] for store in wanted if store in stores]
+    else:
+        selected = [store for store in stores.values()
+                    if store.get('default')]
+    if any('type' in store for store in selected):
+        rbd = any(store.get('type') == RBD_STORE_TYPE for store in selected)
+    else:
+        rbd = (getattr(source_image, 'direct_url', None) or '').startswith(
+            RBD_STORE_TYPE + '://')
+    return FORMAT_RAW if rbd else FORMAT_QCOW2
+
+
+def retrofit_fingerprint(source_image, uca_pocket, config, snap_revision,
+                         disk_format=None):
+    """Build fingerprint of all inputs to the retrofitting process.
+
+    An image retrofitted with the same fingerprint does not need to be
+    rebuilt.  With ``image-format`` set to 'auto' the fingerprint depends
+    on the disk format chosen for the Glance the image is uploaded to.
+
+    :param source_image: Glance image object to retrofit
+    :type source_image: Glance image object
+    :param uca_pocket: Ubuntu Cloud Archive pocket to add to the image
+    :type uca_pocket: Optional[str]
+    :param config: Charm configuration
+    :type config: Mapping[str, Any]
+    :param snap_revision: Revision of ``octavia-diskimage-retrofit`` snap
+    :type snap_revision: Optional[str]
+    :param disk_format: Disk format of the image as chosen by
+                        ``disk_format``, default is ``image-format``
+    :type disk_format: Optional[str]
+    :returns: Hex digest
+    :rtype: str
+    """
+    inputs = {
+        'source': (glance_retrofitter.image_digests(source_image) or
+                   source_image.id),
+        'retrofit-uca-pocket': uca_pocket or '',
+        'ubuntu-mirror': config['ubuntu-mirror'] or '',
+        'uca-mirror': config['uca-mirror'] or '',
+        'image-format': (disk_format or config['image-format'] or
+                         FORMAT_QCOW2),
+        'snap-revision': snap_revision,
+    }
+    return hashlib.sha256(
+        json.dumps(inputs, sort_keys=True).encode()).hexdigest()
+
+
+def read_state(path=STATE_FILE):
+    """Read state written by the charm.
+
+    :param path: Path to state file
+    :type path: str
+    :returns: State or None if no valid state is available
+    :rtype: Optional[Dict[str, Any]]
+    """
+    try:
+        with open(path) as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return None
+
+
+def write_state(state, path=STATE_FILE):
+    """Atomically write state readable only by root.
+
+    The state holds credentials, it is only rewritten when it changes.
+
+    :param state: State to write
+    :type state: Dict[str, Any]
+    :param path: Path to state file
+    :type path: str
+    :returns: Whether the file was changed
+    :rtype: bool
+    """
+    if read_state(path) == state:
+        return False
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    tmp_path = path + '.new'
+    fd = os.open(tmp_path, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o600)
+    with os.fdopen(fd, 'w') as f:
+        json.dump(state, f, sort_keys=True)
+    os.replace(tmp_path, path)
+    return True
+
+
+def work_pending(state):
+    """Query Glance for source images that have not been retrofitted.
+
+    :param state: State written by the charm
+    :type state: Dict[str, Any]
+    :returns: Whether a retrofit run would produce a new image
+    :rtype: bool
+    """
+    keystone_cache = token_cache.TokenCache()
+    session = glance_retrofitter.session_from_credentials(
+        state['credentials'], token_cache=keystone_cache)
+    glances = [
+        glance_retrofitter.get_glance_client(
+            session, endpoint_type=state['endpoint-type'],
+            region=region, token_cache=keystone_cache)
+        for region in state.get('regions') or [state['region']]]
+    glance = glances[0]
+    batch = state.get('batch')
+    if batch:
+        index = glance_retrofitter.discover_source_images(
+            glance,
+            sorted(set(release for release, _ in batch)),
+            architectures=sorted(set(arch for _, arch in batch)))
+        candidates = [
+            (release,
+             glance_retrofitter.find_source_image(index, release, arch=arch))
+            for release, arch in batch]
+    else:
+        releases = state['releases']
+        index = glance_retrofitter.discover_source_images(glance, releases)
+        candidates = []
+        for release in releases:
+            source_image = glance_retrofitter.find_source_image(index,
+                                                                release)
+            if source_image:
+                candidates.append((release, source_image))
+                break
+    config = state['config']
+    for release, source_image in candidates:
+        if not source_image:
+            continue
+        uca_pocket = uca_pocket_for_release(config['retrofit-uca-pocket'],
+                                            release)
+        for dest_glance in glances:
+            fingerprint = retrofit_fingerprint(
+                source_image, uca_pocket, config, get_snap_revision(),
+                disk_format=disk_format(
+                    dest_glance, config,
+                    source_image if dest_glance is glance else None))
+            for _ in glance_retrofitter.find_destination_image(
+                    dest_glance, source_image.product_name,
+                    source_image.version_name, fingerprint=fingerprint):
+                break
+            else:
+                return True
+    return False
+
+
+def main(args):
+    """Decide whether the full retrofit needs to run.
+
+    Any failure to decide, for example missing state or an unreachable
+    cloud, is reported as pending work so that the full path can deal with
+    it.
+
+    :param args: Command line arguments
+    :type args: List[str]
+    :returns: Exit code, ``EXIT_NO_WORK`` or ``EXIT_WORK_PENDING``
+    :rtype: int
+    """
+    state = read_state()
+    if not state:
+        print('No precheck state available', file=sys.stderr)
+        return EXIT_WORK_PENDING
+    try:
+        if work_pending(state):
+            return EXIT_WORK_PENDING
+    except Exception as e:
+        print('Precheck failed: {}'.format(str(e)), file=sys.stderr)
+        return EXIT_WORK_PENDING
+    return EXIT_NO_WORK
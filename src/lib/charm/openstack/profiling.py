@@ -0,0 +1,256 @@
+# Copyright 2022 Canonical Ltd
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#  http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import cProfile
+import json
+import os
+import pstats
+import time
+import tracemalloc
+
+PROFILE_DIR = '/var/snap/octavia-diskimage-retrofit/common/profiles'
+# Number of profiled runs kept, the files of older runs are removed.
+MAX_PROFILES = 10
+TOP_ALLOCATIONS = 25
+PSTATS_SUFFIX = '.pstats'
+ALLOCATIONS_SUFFIX = '.allocations.txt'
+SUMMARY_SUFFIX = '.json'
+SUFFIXES = (PSTATS_SUFFIX, ALLOCATIONS_SUFFIX, SUMMARY_SUFFIX)
+SORT_CUMULATIVE, SORT_TOTTIME = 'cumulative', 'tottime'
+SORT_KEYS = (SORT_CUMULATIVE, SORT_TOTTIME)
+MIB = 1024 * 1024
+
+
+class Profile(object):
+    """CPU and memory profile of a run.
+
+    Function calls are profiled with ``cProfile`` and memory allocations
+    traced with ``tracemalloc`` between ``start`` and ``stop``.  Only the
+    thread calling ``start`` is profiled, the work of download segment and
+    upload threads shows up as time waiting for them.  Allocations are
+    traced in all threads.
+    """
+
+    def __init__(self, name):
+        """Initialize profile.
+
+        :param name: Name of the profiled run, part of the file names
+        :type name: str
+        """
+        self.name = name
+        self.started = None
+        self.duration = 0.0
+        self.peak_memory = 0
+        self.profiler = cProfile.Profile()
+        self.snapshot = None
+        self._start = None
+        self._tracing = False
+
+    def start(self):
+        """Start profiling."""
+        self._tracing = tracemalloc.is_tracing()
+        if self._tracing:
+            tracemalloc.reset_peak()
+        else:
+            tracemalloc.start()
+        self.started = time.time()
+        self._start = time.monotonic()
+        self.profiler.enable()
+
+    def stop(self):
+        """Stop profiling and take snapshot of traced memory."""
+        self.profiler.disable()
+        self.duration = time.monotonic() - self._start
+        _, self.peak_memory = tracemalloc.get_traced_memory()
+        self.snapshot = tracemalloc.take_snapshot().filter_traces((
+            tracemalloc.Filter(False, tracemalloc.__file__),
+            tracemalloc.Filter(False, '<frozen importlib._bootstrap>'),
+            tracemalloc.Filter(False, '<unknown>'),
+        ))
+        if not self._tracing:
+            tracemalloc.stop()
+
+    def allocations(self, limit=TOP_ALLOCATIONS):
+        """Get the source lines holding the most memory at end of run.
+
+        :param limit: Maximum number of lines
+        :type limit: int
+        :returns: Location, bytes and number of blocks of each line,
+                  largest first
+        :rtype: List[Tuple[str, int, int]]
+        """
+        if not self.snapshot:
+            return []
+        return [(str(stat.traceback), stat.size, stat.count)
+                for stat in self.snapshot.statistics('lineno')[:limit]]
+
+    def dump(self, directory=PROFILE_DIR):
+        """Write profile to directory.
+
+        The ``.pstats`` file can be loaded with the ``pstats`` module or
+        tools like snakeviz.  The summary is written last so profiles with
+        a summary are complete.
+
+        :param directory: Directory to write files to, created if missing
+        :type directory: str
+        :returns: Path to summary file
+        :rtype: str
+        :raises: OSError
+        """
+        os.makedirs(directory, exist_ok=True)
+        # Microseconds tell apart runs of the same name started in the
+        # same second.
+        seconds, fraction = divmod(self.started, 1)
+        base = os.path.join(directory, '{}-{:06d}-{}'.format(
+            time.strftime('%Y%m%d-%H%M%S', time.gmtime(seconds)),
+            min(int(round(fraction * 1000000)), 999999), self.name))
+        self.profiler.dump_stats(base + PSTATS_SUFFIX)
+        allocations = self.allocations()
+        with open(base + ALLOCATIONS_SUFFIX, 'w') as f:
+            for site, size, count in allocations:
+                f.write('{:>12d} B {:>8d} blocks  {}\n'.format(
+                    size, count, site))
+        summary = {
+            'name': self.name,
+            'started': self.started,
+            'duration': self.duration,
+            'peak-memory': self.peak_memory,
+            'pstats': base + PSTATS_SUFFIX,
+            'allocations': [list(allocation) for allocation in allocations],
+        }
+        with open(base + SUMMARY_SUFFIX, 'w') as f:
+            json.dump(summary, f)
+        return base + SUMMARY_SUFFIX
+
+
+def _stems(directory):
+    """Get sorted base names of the profiles in directory."""
+    stems = set()
+    for name in os.listdir(directory):
+        for suffix in SUFFIXES:
+            if name.endswith(suffix):
+                stems.add(name[:-len(suffix)])
+                break
+    return sorted(stems)
+
+
+def prune(directory=PROFILE_DIR, keep=MAX_PROFILES):
+    """Remove all but the most recent profiles.
+
+    Files of incomplete profiles count as a profile, so they are removed
+    eventually too.
+
+    :param directory: Directory holding profiles
+    :type directory: str
+    :param keep: Number of profiles to keep
+    :type keep: int
+    :returns: Base names of removed profiles
+    :rtype: List[str]
+    """
+    try:
+        stems = _stems(directory)
+    except FileNotFoundError:
+        return []
+    removed = stems[:-keep] if keep else stems
+    for stem in removed:
+        for suffix in SUFFIXES:
+            try:
+                os.unlink(os.path.join(directory, stem + suffix))
+            except FileNotFoundError:
+                pass
+    return removed
+
+
+def last_profile(directory=PROFILE_DIR):
+    """Get summary of the most recent complete profile.
+
+    :param directory: Directory holding profiles
+    :type directory: str
+    :returns: Summary as written by ``Profile.dump``, None when there is
+              no profile
+    :rtype: Optional[Dict[str, Any]]
+    """
+    try:
+        stems = _stems(directory)
+    except FileNotFoundError:
+        return None
+    for stem in reversed(stems):
+        try:
+            with open(os.path.join(directory, stem + SUMMARY_SUFFIX)) as f:
+                return json.load(f)
+        except (OSError, ValueError):
+            continue
+    return None
+
+
+def hottest_functions(path, sort=SORT_CUMULATIVE, limit=20):
+    """Get the functions the most time was spent in.
+
+    :param path: Path to ``.pstats`` file
+    :type path: str
+    :param sort: Sort by time spent in function including (cumulative) or
+                 excluding (tottime) the functions it called
+    :type sort: str
+    :param limit: Maximum number of functions
+    :type limit: int
+    :returns: Function, number of calls, own and cumulative time in
+              seconds of each function
+    :rtype: List[Tuple[str, int, float, float]]
+    :raises: OSError, ValueError
+    """
+    if sort not in SORT_KEYS:
+        raise ValueError('sort must be one of: {}'.format(
+            ', '.join(SORT_KEYS)))
+    stats = pstats.Stats(path)
+    stats.sort_stats(sort)
+    functions = []
+    for function in stats.fcn_list[:limit]:
+        _, calls, tottime, cumtime, _ = stats.stats[function]
+        functions.append(
+            (pstats.func_std_string(function), calls, tottime, cumtime))
+    return functions
+
+
+def action_results(summary, functions, limit=None):
+    """Profile as keys for ``action_set``.
+
+    :param summary: Summary as returned by ``last_profile``
+    :type summary: Dict[str, Any]
+    :param functions: Functions as returned by ``hottest_functions``
+    :type functions: List[Tuple[str, int, float, float]]
+    :param limit: Maximum number of allocation sites to list, all when 0
+                  or None
+    :type limit: Optional[int]
+    :rtype: Dict[str, str]
+    """
+    results = {
+        'profile.name': summary['name'],
+        'profile.started': time.strftime(
+            '%Y-%m-%d %H:%M:%S', time.gmtime(summary['started'])),
+        'profile.duration': '{:.1f}s'.format(summary['duration']),
+        'profile.peak-memory': '{:.1f} MiB'.format(
+            summary['peak-memory'] / MIB),
+        'profile.pstats': summary['pstats'],
+    }
+    # Ranks are zero padded so keys sort in order in the action output.
+    for rank, (function, calls, tottime, cumtime) in enumerate(
+            functions, start=1):
+        results['functions.{:02d}'.format(rank)] = (
+            '{:.3f}s cumulative, {:.3f}s own, {} calls: {}'.format(
+                cumtime, tottime, calls, function))
+    allocations = summary['allocations'][:limit or None]
+    for rank, (site, size, count) in enumerate(allocations, start=1):
+        results['allocations.{:02d}'.format(rank)] = (
+            '{:.1f} MiB in {} blocks: {}'.format(size / MIB, count, site))
+    return results
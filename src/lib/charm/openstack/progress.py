@@ -0,0 +1,191 @@
+# Copyright 2022 Canonical Ltd
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#  http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import threading
+import time
+
+# Minimum seconds between progress reports, each report is a status-set
+# call to the Juju controller.
+REPORT_INTERVAL = 15
+MIB = 1024 * 1024
+
+
+class TransferStalled(Exception):
+    pass
+
+
+def format_duration(seconds):
+    """Format duration for status messages.
+
+    :param seconds: Duration
+    :type seconds: float
+    :returns: Duration like '1h02m', '3m05s' or '42s'
+    :rtype: str
+    """
+    seconds = int(round(seconds))
+    if seconds >= 3600:
+        return '{}h{:02d}m'.format(seconds // 3600, seconds % 3600 // 60)
+    if seconds >= 60:
+        return '{}m{:02d}s'.format(seconds // 60, seconds % 60)
+    return '{}s'.format(seconds)
+
+
+class ProgressMeter(object):
+    """Track progress of a transfer, report it and detect stalls.
+
+    The code doing the transfer calls ``update`` with the size of each
+    chunk, which may happen from several threads.  Progress is reported at
+    most every ``interval`` seconds with the throughput since the previous
+    report and the estimated time left.
+
+    With ``min_rate`` set the transfer is aborted, by raising
+    ``TransferStalled`` from ``update``, when less than ``min_rate`` bytes
+    per second were transferred over ``stall_timeout`` seconds.
+    """
+
+    def __init__(self, description, total=0, report=None,
+                 interval=REPORT_INTERVAL, min_rate=0, stall_timeout=0):
+        """Initialize progress meter.
+
+        :param description: Description of transfer, prefixed to reports
+        :type description: str
+        :param total: Size of transfer in bytes, 0 when not known
+        :type total: int
+        :param report: Called with progress message
+        :type report: Optional[Callable[[str], None]]
+        :param interval: Minimum seconds between reports
+        :type interval: float
+        :param min_rate: Bytes per second below which the transfer stalls,
+                         0 to not detect stalls
+        :type min_rate: int
+        :param stall_timeout: Seconds throughput must stay below
+                              ``min_rate`` for the transfer to stall
+        :type stall_timeout: float
+        """
+        self.description = description
+        self.total = total or 0
+        self.report = report
+        self.interval = interval
+        self.min_rate = min_rate or 0
+        self.stall_timeout = stall_timeout or 0
+        self.lock = threading.Lock()
+        self.restart()
+
+    def restart(self, position=0):
+        """Start new attempt of the transfer.
+
+        :param position: Bytes already transferred by earlier attempts
+        :type position: int
+        """
+        with self.lock:
+            now = time.monotonic()
+            self.position = position
+            self.reported_at = self.window_start = now
+            self.reported_position = self.window_position = position
+
+    def update(self, size):
+        """Record transfer of data.
+
+        :param size: Number of bytes transferred
+        :type size: int
+        :raises: TransferStalled
+        """
+        message = None
+        with self.lock:
+            now = time.monotonic()
+            self.position += size
+            elapsed = now - self.window_start
+            if (self.min_rate and self.stall_timeout and
+                    elapsed >= self.stall_timeout):
+                rate = (self.position - self.window_position) / elapsed
+                if rate < self.min_rate:
+                    raise TransferStalled(
+                        '{}: {:.0f} bytes/s over {:.0f}s, below minimum of '
+                        '{} bytes/s'.format(self.description, rate, elapsed,
+                                            self.min_rate))
+                self.window_start, self.window_position = now, self.position
+            elapsed = now - self.reported_at
+            if self.report and elapsed >= self.interval and elapsed > 0:
+                message = self.message(
+                    (self.position - self.reported_position) / elapsed)
+                self.reported_at, self.reported_position = now, self.position
+        if message:
+            self.report(message)
+
+    def message(self, rate):
+        """Describe progress.
+
+        :param rate: Throughput in bytes per second
+        :type rate: float
+        :returns: Message like 'Downloading x: 42% at 12.3 MiB/s, 3m05s
+                  left'
+        :rtype: str
+        """
+        if not self.total:
+            return '{}: {:.0f} MiB at {:.1f} MiB/s'.format(
+                self.description, self.position / MIB, rate / MIB)
+        remaining = max(self.total - self.position, 0)
+        return '{}: {:.0f}% at {:.1f} MiB/s, {} left'.format(
+            self.description,
+            min(100.0, 100.0 * self.position / self.total),
+            rate / MIB,
+            format_duration(remaining / rate) if rate else 'unknown time')
+
+
+class ProgressReporter(object):
+    """Pass progress messages on at most every ``interval`` seconds.
+
+    The first message is passed on right away, messages arriving sooner
+    than ``interval`` seconds after the last one passed on are dropped.
+    """
+
+    def __init__(self, report, interval=REPORT_INTERVAL):
+        """Initialize progress reporter.
+
+        :param report: Called with progress message
+        :type report: Callable[[str], None]
+        :param interval: Minimum seconds between reports
+        :type interval: float
+        """
+        self.report = report
+        self.interval = interval
+        self.lock = threading.Lock()
+        self.reported_at = None
+
+    def __call__(self, message):
+        """Report message unless the previous report was too recent.
+
+        :param message: Progress message
+        :type message: str
+        """
+        with self.lock:
+            now = time.monotonic()
+            if (self.reported_at is not None and
+                    now - self.reported_at < self.interval):
+                return
+            self.reported_at = now
+        self.report(message)
+
+
+class MeteredReader(object):
+    """File object wrapper updating a progress meter with the data read."""
+
+    def __init__(self, fileobj, meter):
+        self.fileobj = fileobj
+        self.meter = meter
+
+    def read(self, size=-1):
+        data = self.fileobj.read(size)
+        self.meter.update(len(data))
+        return data
@@ -0,0 +1,101 @@
+# Copyright 2022 Canonical Ltd
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#  http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import threading
+import time
+
+DOWNLOAD, UPLOAD = 'download', 'upload'
+
+_buckets = {}
+_buckets_lock = threading.Lock()
+
+
+class TokenBucket(object):
+    """Limit the rate of data flowing through one or more threads.
+
+    The bucket holds up to ``burst`` bytes worth of tokens and is refilled
+    at ``rate`` bytes per second.  Taking more tokens than the bucket holds
+    puts it in debt, the caller then sleeps until the debt is paid off.
+    Threads sharing a bucket queue up behind each other's debt, so their
+    combined rate does not exceed ``rate``.
+    """
+
+    def __init__(self, rate, burst=None):
+        """Initialize bucket, starting full.
+
+        :param rate: Bytes per second
+        :type rate: int
+        :param burst: Bytes that may pass without delay after the bucket
+                      has been idle, default is one second worth of data
+        :type burst: Optional[int]
+        """
+        self.rate = rate
+        self.burst = burst or rate
+        self.tokens = self.burst
+        self.updated = time.monotonic()
+        self.lock = threading.Lock()
+
+    def consume(self, size):
+        """Take tokens for size bytes, sleeping while the bucket is in debt.
+
+        :param size: Number of bytes
+        :type size: int
+        :returns: Seconds slept
+        :rtype: float
+        """
+        with self.lock:
+            now = time.monotonic()
+            self.tokens = min(
+                self.burst, self.tokens + (now - self.updated) * self.rate)
+            self.updated = now
+            self.tokens -= size
+            delay = -self.tokens / self.rate if self.tokens < 0 else 0.0
+        if delay:
+            time.sleep(delay)
+        return delay
+
+
+class ThrottledReader(object):
+    """File object wrapper limiting the rate data is read at."""
+
+    def __init__(self, fileobj, bucket):
+        self.fileobj = fileobj
+        self.bucket = bucket
+
+    def read(self, size=-1):
+        data = self.fileobj.read(size)
+        self.bucket.consume(len(data))
+        return data
+
+
+def shared_bucket(name, rate):
+    """Get token bucket shared by all transfers of a kind in this process.
+
+    Concurrent transfers, for example in batch mode, draw from the same
+    bucket and are limited to ``rate`` together.
+
+    :param name: Kind of transfer, ``DOWNLOAD`` or ``UPLOAD``
+    :type name: str
+    :param rate: Bytes per second, 0 or None for no limit
+    :type rate: Optional[int]
+    :returns: Token bucket or None when there is no limit
+    :rtype: Optional[TokenBucket]
+    """
+    if not rate or rate < 0:
+        return None
+    with _buckets_lock:
+        bucket = _buckets.get(name)
+        if bucket is None or bucket.rate != rate:
+            bucket = _buckets[name] = TokenBucket(rate)
+        return bucket
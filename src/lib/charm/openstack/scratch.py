@@ -0,0 +1,298 @@
+# Copyright 2022 Canonical Ltd
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#  http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import contextlib
+import fcntl
+import json
+import os
+import tempfile
+import threading
+import time
+
+import charmhelpers.core as ch_core
+
+import charm.openstack.batch as batch
+
+MANIFEST_FILE = '.scratch-manifest.json'
+LOCK_FILE = '.scratch.lock'
+# Resumable files are swept when they have not been touched for this long.
+RESUMABLE_MAX_AGE = 7 * 24 * 3600
+# Scratch space needed for a retrofitted image in each disk format, per
+# byte of source image.  Raw images are at most the virtual size of the
+# source image, which is used when Glance reports it.
+FORMAT_FACTORS = {'qcow2': 2, 'raw': 4}
+DEFAULT_FORMAT_FACTOR = 2
+
+# The manifest is shared by the threads of a batch retrofit as well as by
+# concurrent processes, which are serialized by a lock file.
+_lock = threading.Lock()
+
+
+class ScratchSpaceExhausted(Exception):
+    pass
+
+
+def space_needed(source_image, disk_formats=None, cached=False):
+    """Estimate scratch space needed to retrofit an image.
+
+    Room is needed for the downloaded source image, unless it is served
+    from the image cache, and the retrofitted image in each disk format it
+    is uploaded in.
+
+    :param source_image: Glance image object to retrofit
+    :type source_image: Glance image object
+    :param disk_formats: Disk formats of the retrofitted image, default is
+                         a single qcow2 image
+    :type disk_formats: Optional[Iterable[str]]
+    :param cached: Source image is in the image cache
+    :type cached: bool
+    :returns: Space in bytes
+    :rtype: int
+    """
+    size = getattr(source_image, 'size', None) or 0
+    virtual_size = getattr(source_image, 'virtual_size', None) or 0
+    needed = 0 if cached else size
+    for disk_format in sorted(set(disk_formats or ('qcow2',))):
+        estimate = FORMAT_FACTORS.get(disk_format,
+                                      DEFAULT_FORMAT_FACTOR) * size
+        if disk_format == 'raw' and virtual_size:
+            estimate = virtual_size
+        needed += estimate
+    return needed
+
+
+def _process_alive(pid):
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        pass
+    return True
+
+
+class ScratchSpace(object):
+    """Files in a scratch directory, tracked across runs.
+
+    Files are recorded in a manifest in the directory, along with the
+    process that allocated them, before they are created.  Files whose
+    process is gone, for example because a run was killed, are swept by
+    the next run.  Files marked resumable, such as partial downloads, are
+    kept for a later run to continue until they are ``RESUMABLE_MAX_AGE``
+    old or their space is needed.  Files named after a tracked file with
+    an additional suffix, such as the manifest the retrofit tool writes
+    next to its output, belong to that file.
+    """
+
+    def __init__(self, path, quota=0):
+        """Initialize scratch space.
+
+        :param path: Path to scratch directory
+        :type path: str
+        :param quota: Maximum space in bytes used by files in the
+                      directory, 0 for no limit besides the file system
+        :type quota: int
+        """
+        self.path = path
+        self.quota = quota or 0
+
+    @contextlib.contextmanager
+    def _manifest(self):
+        with _lock:
+            os.makedirs(self.path, mode=0o700, exist_ok=True)
+            with open(os.path.join(self.path, LOCK_FILE), 'a') as lock:
+                fcntl.flock(lock, fcntl.LOCK_EX)
+                manifest_path = os.path.join(self.path, MANIFEST_FILE)
+                try:
+                    with open(manifest_path) as f:
+                        manifest = json.load(f)
+                except (OSError, ValueError):
+                    manifest = {}
+                if not isinstance(manifest, dict):
+                    manifest = {}
+                yield manifest
+                tmp_path = manifest_path + '.new'
+                with open(tmp_path, 'w') as f:
+                    json.dump(manifest, f, sort_keys=True)
+                os.replace(tmp_path, manifest_path)
+
+    @staticmethod
+    def _owner(manifest, name):
+        """Get name of tracked file the file of name belongs to."""
+        while name:
+            if name in manifest:
+                return name
+            name = name.rpartition('.')[0]
+        return None
+
+    def _remove(self, manifest, name):
+        for entry in os.listdir(self.path):
+            if entry == name or entry.startswith(name + '.'):
+                with contextlib.suppress(FileNotFoundError):
+                    os.unlink(os.path.join(self.path, entry))
+        manifest.pop(name, None)
+
+    def allocate(self, suffix=''):
+        """Create an empty file owned by this process.
+
+        :param suffix: Suffix of file name
+        :type suffix: str
+        :returns: Path to file
+        :rtype: str
+        """
+        with self._manifest() as manifest:
+            fd, path = tempfile.mkstemp(suffix=suffix, dir=self.path)
+            os.close(fd)
+            manifest[os.path.basename(path)] = {'pid': os.getpid()}
+        return path
+
+    def track(self, path, resumable=False):
+        """Record a file in the scratch directory as owned by this process.
+
+        :param path: Path to file, which need not exist yet
+        :type path: str
+        :param resumable: Keep file for later runs when this process exits
+                          without releasing it
+        :type resumable: bool
+        """
+        with self._manifest() as manifest:
+            manifest[os.path.basename(path)] = {'pid': os.getpid(),
+                                                'resumable': resumable}
+
+    def release(self, path):
+        """Remove a tracked file and the files belonging to it.
+
+        Paths that are not tracked, for example images in the image cache,
+        are left alone, as are files that are already gone.
+
+        :param path: Path to file
+        :type path: str
+        """
+        name = os.path.basename(path)
+        if os.path.dirname(os.path.abspath(path)) != os.path.abspath(
+                self.path):
+            return
+        with self._manifest() as manifest:
+            if name in manifest:
+                self._remove(manifest, name)
+
+    def sweep(self):
+        """Remove files left behind by processes that are gone.
+
+        :returns: Names of removed files
+        :rtype: List[str]
+        """
+        removed = []
+        now = time.time()
+        with self._manifest() as manifest:
+            for entry in sorted(os.scandir(self.path), key=lambda e: e.name):
+                # The manifest and its lock, directories are left alone.
+                if entry.name.startswith('.scratch') or entry.is_dir(
+                        follow_symlinks=False):
+                    continue
+                owner = self._owner(manifest, entry.name)
+                info = manifest.get(owner) or {}
+                if info.get('resumable'):
+                    with contextlib.suppress(FileNotFoundError):
+                        age = now - entry.stat(
+                            follow_symlinks=False).st_mtime
+                        if age < RESUMABLE_MAX_AGE:
+                            continue
+                elif owner and _process_alive(info.get('pid') or 0):
+                    continue
+                with contextlib.suppress(FileNotFoundError):
+                    os.unlink(entry.path)
+                removed.append(entry.name)
+            remaining = os.listdir(self.path)
+            for name in list(manifest):
+                if not any(self._owner({name: None}, entry)
+                           for entry in remaining):
+                    del manifest[name]
+        if removed:
+            ch_core.hookenv.log('Removed scratch files left behind by '
+                                'earlier runs: {}'.format(removed),
+                                level=ch_core.hookenv.INFO)
+        return removed
+
+    def usage(self):
+        """Get space allocated by files in the scratch directory.
+
+        :returns: Space in bytes
+        :rtype: int
+        """
+        used = 0
+        with contextlib.suppress(FileNotFoundError):
+            for entry in os.scandir(self.path):
+                with contextlib.suppress(FileNotFoundError):
+                    if entry.is_file(follow_symlinks=False):
+                        used += entry.stat().st_blocks * 512
+        return used
+
+    def available(self):
+        """Get space available for new files.
+
+        :returns: Space in bytes or None if it can not be determined
+        :rtype: Optional[int]
+        """
+        os.makedirs(self.path, mode=0o700, exist_ok=True)
+        available = batch.free_space(self.path)
+        if self.quota:
+            remaining = max(self.quota - self.usage(), 0)
+            if available is None or remaining < available:
+                available = remaining
+        return available
+
+    def admit(self, needed, keep=()):
+        """Ensure space is available before starting work that needs it.
+
+        Resumable files of other work are removed, least recently
+        modified first, when their space is needed.  Data already in the
+        kept files, such as a partial download that is resumed, is part of
+        the space needed and is not asked for again.
+
+        :param needed: Space in bytes
+        :type needed: int
+        :param keep: Paths of resumable files not to remove
+        :type keep: Iterable[str]
+        :raises: ScratchSpaceExhausted
+        """
+        keep = set(os.path.basename(path) for path in keep)
+        for name in keep:
+            with contextlib.suppress(FileNotFoundError):
+                needed -= os.stat(os.path.join(self.path, name)).st_size
+        needed = max(needed, 0)
+        available = self.available()
+        if available is None or needed <= available:
+            return
+        with self._manifest() as manifest:
+            candidates = []
+            for name, entry in manifest.items():
+                if not entry.get('resumable') or name in keep:
+                    continue
+                try:
+                    mtime = os.stat(os.path.join(self.path, name)).st_mtime
+                except FileNotFoundError:
+                    mtime = 0
+                candidates.append((mtime, name))
+            for _, name in sorted(candidates):
+                ch_core.hookenv.log('Removing resumable scratch file "{}" '
+                                    'to make room'.format(name),
+                                    level=ch_core.hookenv.INFO)
+                self._remove(manifest, name)
+                available = self.available()
+                if needed <= available:
+                    return
+        raise ScratchSpaceExhausted(
+            '{} bytes of scratch space needed in "{}", {} bytes available'
+            .format(needed, self.path, available))
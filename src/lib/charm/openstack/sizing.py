@@ -0,0 +1,158 @@
+# Copyright 2022 Canonical Ltd
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#  http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import os
+
+MEMINFO = '/proc/meminfo'
+CGROUP_CPU_MAX = '/sys/fs/cgroup/cpu.max'
+CGROUP_MEMORY_MAX = '/sys/fs/cgroup/memory.max'
+CGROUP_MEMORY_CURRENT = '/sys/fs/cgroup/memory.current'
+KVM_DEVICE = '/dev/kvm'
+BACKEND_KVM, BACKEND_TCG = 'kvm', 'tcg'
+MIN_MEMSIZE, MAX_MEMSIZE = 768, 4096
+MAX_SMP = 8
+MIB = 1024 * 1024
+
+
+def _read(path):
+    try:
+        with open(path) as f:
+            return f.read()
+    except OSError:
+        return None
+
+
+def host_cpus():
+    """Number of CPUs available to the unit, honouring cgroup limits.
+
+    :rtype: int
+    """
+    cpus = len(os.sched_getaffinity(0))
+    cpu_max = (_read(CGROUP_CPU_MAX) or '').split()
+    if len(cpu_max) == 2 and cpu_max[0] != 'max':
+        try:
+            cpus = min(cpus, max(int(cpu_max[0]) // int(cpu_max[1]), 1))
+        except (ValueError, ZeroDivisionError):
+            pass
+    return cpus
+
+
+def available_memory():
+    """Memory in MiB available to the unit, honouring cgroup limits.
+
+    :returns: Available memory or None if it can not be determined
+    :rtype: Optional[int]
+    """
+    available = None
+    for line in (_read(MEMINFO) or '').splitlines():
+        if line.startswith('MemAvailable:'):
+            available = int(line.split()[1]) // 1024
+            break
+    limit = (_read(CGROUP_MEMORY_MAX) or '').strip()
+    current = (_read(CGROUP_MEMORY_CURRENT) or '').strip()
+    if limit.isdigit() and current.isdigit():
+        cgroup_available = max(int(limit) - int(current), 0) // MIB
+        if available is None or cgroup_available < available:
+            available = cgroup_available
+    return available
+
+
+def kvm_available():
+    """Whether hardware virtualization is usable by the unit.
+
+    :rtype: bool
+    """
+    return os.access(KVM_DEVICE, os.R_OK | os.W_OK)
+
+
+def plan(cpus, memory, kvm, workers=1, memsize=None, smp=None,
+         backend=None):
+    """Size the libguestfs appliance for the host.
+
+    The host is shared between ``workers`` concurrent appliances, each of
+    which gets at most half of its share of the available memory.
+
+    :param cpus: Number of CPUs available
+    :type cpus: int
+    :param memory: Available memory in MiB
+    :type memory: Optional[int]
+    :param kvm: Whether KVM is available
+    :type kvm: bool
+    :param workers: Number of appliances run concurrently
+    :type workers: int
+    :param memsize: Memory in MiB to use instead of automatic sizing
+    :type memsize: Optional[int]
+    :param smp: Number of vCPUs to use instead of automatic sizing
+    :type smp: Optional[int]
+    :param backend: Backend to use instead of automatic selection
+    :type backend: Optional[str]
+    :returns: Sizing with 'memsize', 'smp' and 'backend' keys
+    :rtype: Dict[str, Any]
+    """
+    workers = max(workers or 1, 1)
+    if not memsize:
+        memsize = MAX_MEMSIZE
+        if memory is not None:
+            memsize = min(max(memory // workers // 2, MIN_MEMSIZE),
+                          MAX_MEMSIZE)
+    if not smp:
+        smp = min(max(cpus // workers, 1), MAX_SMP)
+    if not backend:
+        backend = BACKEND_KVM if kvm else BACKEND_TCG
+    return {'memsize': memsize, 'smp': smp, 'backend': backend}
+
+
+def host_plan(workers=1, memsize=None, smp=None, backend=None):
+    """Size the libguestfs appliance for the host the charm runs on.
+
+    :param workers: Number of appliances run concurrently
+    :type workers: int
+    :param memsize: Memory in MiB to use instead of automatic sizing
+    :type memsize: Optional[int]
+    :param smp: Number of vCPUs to use instead of automatic sizing
+    :type smp: Optional[int]
+    :param backend: Backend to use instead of automatic selection
+    :type backend: Optional[str]
+    :returns: Sizing with 'memsize', 'smp' and 'backend' keys
+    :rtype: Dict[str, Any]
+    """
+    return plan(host_cpus(), available_memory(), kvm_available(),
+                workers=workers, memsize=memsize, smp=smp, backend=backend)
+
+
+def environment(sizing):
+    """Environment variables applying sizing to libguestfs.
+
+    libguestfs has no environment variable for the number of vCPUs, the
+    ``smp`` of the sizing is not applied here.
+
+    :param sizing: Sizing as returned by ``plan``
+    :type sizing: Dict[str, Any]
+    :rtype: Dict[str, str]
+    """
+    env = {'LIBGUESTFS_MEMSIZE': str(sizing['memsize'])}
+    if sizing['backend'] == BACKEND_TCG:
+        env['LIBGUESTFS_BACKEND_SETTINGS'] = 'force_tcg'
+    return env
+
+
+def action_results(sizing):
+    """Sizing as keys for ``action_set``.
+
+    :param sizing: Sizing as returned by ``plan``
+    :type sizing: Dict[str, Any]
+    :rtype: Dict[str, str]
+    """
+    return {'appliance.{}'.format(key): str(value)
+            for key, value in sizing.items()}
@@ -0,0 +1,128 @@
+# Copyright 2022 Canonical Ltd
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#  http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import errno
+import os
+
+BLOCK_SIZE = 4096
+ZERO_BLOCK = bytes(BLOCK_SIZE)
+
+
+def data_runs(data):
+    """Split buffer into alternating runs of data and zero blocks.
+
+    :param data: Buffer to split
+    :type data: bytes
+    :returns: Generator of (offset, length, is_zero) tuples
+    :rtype: Iterator[Tuple[int, int, bool]]
+    """
+    size = len(data)
+    start = 0
+    zero = None
+    for offset in range(0, size, BLOCK_SIZE):
+        block_zero = (size - offset >= BLOCK_SIZE and
+                      data.startswith(ZERO_BLOCK, offset))
+        if zero is None:
+            zero = block_zero
+        elif block_zero != zero:
+            yield start, offset - start, zero
+            start, zero = offset, block_zero
+    if size:
+        yield start, size - start, zero
+
+
+def write_sparse(fd, data, offset):
+    """Write buffer at offset skipping blocks of zeros.
+
+    The skipped ranges must already read as zeros, which is the case for a
+    newly created file or one extended with ``ftruncate``.  No space is
+    allocated for them, so the file should not be preallocated.
+
+    :param fd: File descriptor
+    :type fd: int
+    :param data: Data to write
+    :type data: bytes
+    :param offset: Offset in file to write data at
+    :type offset: int
+    :returns: Number of bytes skipped
+    :rtype: int
+    """
+    skipped = 0
+    view = memoryview(data)
+    for start, length, zero in data_runs(data):
+        if zero:
+            skipped += length
+            continue
+        written = 0
+        while written < length:
+            written += os.pwrite(
+                fd, view[start + written:start + length],
+                offset + start + written)
+    return skipped
+
+
+class SparseReader(object):
+    """Read-only file object that does not read holes from disk.
+
+    Holes are located with ``SEEK_DATA``/``SEEK_HOLE`` and returned as
+    zeros without touching the disk.  On file systems without support for
+    these the whole file is treated as data.
+    """
+
+    def __init__(self, fileobj):
+        self.fd = fileobj.fileno()
+        self.size = os.fstat(self.fd).st_size
+        self.pos = 0
+        self.data_end = 0
+        self.hole_end = 0
+
+    def _locate(self):
+        """Find extent at current position.
+
+        Updates ``data_end`` when the position is within data or
+        ``hole_end`` when it is within a hole.
+        """
+        try:
+            data = os.lseek(self.fd, self.pos, os.SEEK_DATA)
+        except OSError as ex:
+            if ex.errno == errno.ENXIO:
+                # no more data after position
+                self.hole_end = self.size
+                return
+            self.data_end = self.size
+            return
+        if data > self.pos:
+            self.hole_end = data
+            return
+        try:
+            self.data_end = os.lseek(self.fd, self.pos, os.SEEK_HOLE)
+        except OSError:
+            self.data_end = self.size
+
+    def read(self, size=-1):
+        if size is None or size < 0:
+            size = self.size - self.pos
+        size = min(size, self.size - self.pos)
+        if size <= 0:
+            return b''
+        if self.pos >= self.data_end and self.pos >= self.hole_end:
+            self._locate()
+        if self.pos < self.hole_end:
+            size = min(size, self.hole_end - self.pos)
+            self.pos += size
+            return bytes(size)
+        size = min(size, self.data_end - self.pos)
+        data = os.pread(self.fd, size, self.pos)
+        self.pos += len(data)
+        return data
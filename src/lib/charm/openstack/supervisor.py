@@ -0,0 +1,214 @@
+# Copyright 2022 Canonical Ltd
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#  http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import collections
+import logging
+import logging.handlers
+import os
+import re
+import signal
+import subprocess
+import threading
+
+LOG_FILE = ('/var/snap/octavia-diskimage-retrofit/common/log/'
+            'octavia-diskimage-retrofit.log')
+LOG_MAX_BYTES = 10 * 1024 * 1024
+LOG_BACKUP_COUNT = 5
+TAIL_LINES = 100
+KILL_GRACE_PERIOD = 10
+SYSTEMD_RUN = 'systemd-run'
+IONICE_CLASSES = {'best-effort': '2', 'idle': '3'}
+# virt-customize and friends prefix progress messages with the elapsed
+# time, eg. ``[  12.3] Installing packages: haproxy``
+PROGRESS_RE = re.compile(r'^\[\s*(\d+\.\d+)\]\s+(\S.*)$')
+
+_handlers = {}
+_handlers_lock = threading.Lock()
+
+
+def get_log_handler(path):
+    """Get rotating log handler for path shared by concurrent runs.
+
+    :param path: Path to log file
+    :type path: str
+    :rtype: logging.handlers.RotatingFileHandler
+    """
+    with _handlers_lock:
+        if path not in _handlers:
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            handler = logging.handlers.RotatingFileHandler(
+                path, maxBytes=LOG_MAX_BYTES, backupCount=LOG_BACKUP_COUNT)
+            handler.setFormatter(logging.Formatter(
+                '%(asctime)s %(name)s: %(message)s'))
+            _handlers[path] = handler
+        return _handlers[path]
+
+
+def log(name, msg, log_file=LOG_FILE):
+    """Write message to the rotating log file.
+
+    :param name: Name to tag message with
+    :type name: str
+    :param msg: Message
+    :type msg: str
+    :param log_file: Path to log file
+    :type log_file: str
+    """
+    get_log_handler(log_file).handle(logging.makeLogRecord({
+        'name': name, 'msg': msg,
+        'levelno': logging.INFO, 'levelname': 'INFO'}))
+
+
+def parse_progress(line):
+    """Extract progress message from a line of tool output.
+
+    :param line: Line of output
+    :type line: str
+    :returns: Progress message or None
+    :rtype: Optional[str]
+    """
+    match = PROGRESS_RE.match(line)
+    if match:
+        return match.group(2).rstrip()
+    return None
+
+
+def _terminate(proc):
+    """Terminate process group of proc, forcefully if it does not exit.
+
+    :param proc: Process started in its own session
+    :type proc: subprocess.Popen
+    """
+    for sig in (signal.SIGTERM, signal.SIGKILL):
+        try:
+            os.killpg(proc.pid, sig)
+        except ProcessLookupError:
+            return
+        try:
+            proc.wait(KILL_GRACE_PERIOD)
+            return
+        except subprocess.TimeoutExpired:
+            pass
+
+
+def limit_resources(cmd, niceness=0, ionice_class=None, cpu_weight=0,
+                    io_weight=0):
+    """Wrap command to run with lower CPU and I/O priority.
+
+    Niceness and I/O scheduling class are inherited by the children of the
+    command.  CPU and I/O weights are applied by running the command in a
+    transient systemd scope, a cgroup of its own that also holds its
+    children, for example the libguestfs appliance.
+
+    :param cmd: Command to run
+    :type cmd: List[str]
+    :param niceness: Niceness to add, between 0 and 19
+    :type niceness: int
+    :param ionice_class: I/O scheduling class, one of ``IONICE_CLASSES``
+    :type ionice_class: Optional[str]
+    :param cpu_weight: CPU weight of scope, between 1 and 10000
+    :type cpu_weight: int
+    :param io_weight: I/O weight of scope, between 1 and 10000
+    :type io_weight: int
+    :returns: Wrapped command
+    :rtype: List[str]
+    """
+    prefix = []
+    properties = []
+    if cpu_weight:
+        properties.append('CPUWeight={}'.format(cpu_weight))
+    if io_weight:
+        properties.append('IOWeight={}'.format(io_weight))
+    if properties:
+        # systemd-run executes the command itself once the scope is set up,
+        # so it remains the leader of the process group run() terminates.
+        prefix.extend([SYSTEMD_RUN, '--scope', '--quiet', '--collect'])
+        for prop in properties:
+            prefix.extend(['--property', prop])
+    if ionice_class:
+        prefix.extend(['ionice', '-c', IONICE_CLASSES[ionice_class]])
+    if niceness:
+        prefix.extend(['nice', '-n', str(niceness)])
+    return prefix + list(cmd)
+
+
+def run(cmd, env=None, name=None, timeout=None, on_progress=None,
+        log_file=LOG_FILE, tail_lines=TAIL_LINES):
+    """Run command streaming its output to a rotating log file.
+
+    Only a bounded tail of the output is kept in memory for error reports.
+    The command is run in its own process group so that it can be
+    terminated along with any children, for example the libguestfs
+    appliance, when the timeout expires.
+
+    :param cmd: Command to run
+    :type cmd: List[str]
+    :param env: Environment for command
+    :type env: Optional[Dict[str, str]]
+    :param name: Name to tag lines in the log file with
+    :type name: Optional[str]
+    :param timeout: Wall clock timeout in seconds
+    :type timeout: Optional[float]
+    :param on_progress: Called with each progress message of the command,
+                        wrap in ``progress.ProgressReporter`` to limit
+                        the rate of calls
+    :type on_progress: Optional[Callable[[str], None]]
+    :param log_file: Path to log file
+    :type log_file: str
+    :param tail_lines: Number of lines of output to keep
+    :type tail_lines: int
+    :returns: Tail of output
+    :rtype: str
+    :raises: subprocess.CalledProcessError, subprocess.TimeoutExpired
+    """
+    name = name or os.path.basename(cmd[0])
+    tail = collections.deque(maxlen=tail_lines)
+    timed_out = threading.Event()
+    proc = subprocess.Popen(cmd, stdout=subprocess.PIPE,
+                            stderr=subprocess.STDOUT, env=env,
+                            universal_newlines=True, errors='replace',
+                            start_new_session=True)
+
+    def expire():
+        timed_out.set()
+        _terminate(proc)
+
+    timer = None
+    if timeout:
+        timer = threading.Timer(timeout, expire)
+        timer.daemon = True
+        timer.start()
+    try:
+        log(name, 'Running: {}'.format(cmd), log_file)
+        with proc.stdout:
+            for line in proc.stdout:
+                line = line.rstrip('\n')
+                tail.append(line)
+                log(name, line, log_file)
+                progress = parse_progress(line)
+                if progress and on_progress:
+                    on_progress(progress)
+        returncode = proc.wait()
+    finally:
+        if timer:
+            timer.cancel()
+        if proc.poll() is None:
+            _terminate(proc)
+    log(name, 'Exited with {}'.format(proc.returncode), log_file)
+    output = '\n'.join(tail)
+    if timed_out.is_set():
+        raise subprocess.TimeoutExpired(cmd, timeout, output=output)
+    if returncode:
+        raise subprocess.CalledProcessError(returncode, cmd, output=output)
+    return output
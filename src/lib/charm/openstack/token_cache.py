@@ -0,0 +1,131 @@
+# Copyright 2022 Canonical Ltd
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#  http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import datetime
+import hashlib
+import json
+import os
+
+CACHE_FILE = '/var/snap/octavia-diskimage-retrofit/common/token-cache.json'
+EXPIRY_MARGIN = datetime.timedelta(minutes=5)
+
+
+def credentials_key(credentials):
+    """Digest of credentials the cache entry was created with.
+
+    :param credentials: Options for the Keystone ``password`` auth plugin
+    :type credentials: Dict[str, str]
+    :rtype: str
+    """
+    return hashlib.sha256(
+        json.dumps(credentials, sort_keys=True).encode()).hexdigest()
+
+
+class TokenCache(object):
+    """Keystone token and Glance endpoints persisted across runs.
+
+    The cache is kept in a file readable only by root, it is discarded
+    when the credentials from the ``identity-credentials`` relation change.
+    """
+
+    def __init__(self, path=CACHE_FILE):
+        self.path = path
+        self.key = None
+        self.data = {}
+        self.restored = False
+
+    def _read(self):
+        try:
+            with open(self.path) as f:
+                return json.load(f)
+        except (OSError, ValueError):
+            return {}
+
+    def _write(self):
+        os.makedirs(os.path.dirname(self.path), exist_ok=True)
+        tmp_path = self.path + '.new'
+        fd = os.open(tmp_path, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o600)
+        with os.fdopen(fd, 'w') as f:
+            json.dump(self.data, f, sort_keys=True)
+        os.replace(tmp_path, self.path)
+
+    def restore(self, auth, credentials):
+        """Restore cached token into auth plugin if it is still valid.
+
+        :param auth: Keystone auth plugin
+        :type auth: keystoneauth1.identity.base.BaseIdentityPlugin
+        :param credentials: Options the auth plugin was created with
+        :type credentials: Dict[str, str]
+        :returns: Whether a token was restored
+        :rtype: bool
+        """
+        self.key = credentials_key(credentials)
+        data = self._read()
+        if data.get('key') != self.key:
+            self.data = {'key': self.key}
+            return False
+        self.data = data
+        try:
+            expires = datetime.datetime.fromisoformat(data['expires-at'])
+            state = data['auth-state']
+        except (KeyError, TypeError, ValueError):
+            return False
+        now = datetime.datetime.now(datetime.timezone.utc)
+        if expires - EXPIRY_MARGIN <= now:
+            return False
+        auth.set_auth_state(state)
+        self.restored = True
+        return True
+
+    def endpoint(self, region, interface):
+        """Get cached endpoint, only available along with a valid token.
+
+        :param region: The OpenStack region
+        :type region: Optional[str]
+        :param interface: Type of endpoint
+        :type interface: str
+        :returns: Endpoint URL or None
+        :rtype: Optional[str]
+        """
+        if not self.restored:
+            return None
+        return self.data.get('endpoints', {}).get(
+            '{}:{}'.format(region, interface))
+
+    def update(self, auth, region, interface, endpoint):
+        """Persist current token of auth plugin and resolved endpoint.
+
+        :param auth: Authenticated Keystone auth plugin
+        :type auth: keystoneauth1.identity.base.BaseIdentityPlugin
+        :param region: The OpenStack region
+        :type region: Optional[str]
+        :param interface: Type of endpoint
+        :type interface: str
+        :param endpoint: Endpoint URL
+        :type endpoint: str
+        """
+        if not self.key:
+            return
+        state = auth.get_auth_state()
+        if not state:
+            return
+        if not self.restored:
+            # New token, endpoints resolved with the old one may be stale.
+            self.data = {'key': self.key}
+        self.data['auth-state'] = state
+        self.data['expires-at'] = auth.auth_ref.expires.isoformat()
+        self.data.setdefault('endpoints', {})[
+            '{}:{}'.format(region, interface)] = endpoint
+        self._write()
+        self.restored = True
@@ -69,6 +69,20 @@ def snap_install():
         set_flag('snap.channel.invalid')
 
 
+@reactive.when('snap.installed.octavia-diskimage-retrofit')
+@reactive.when_not('octavia-diskimage-retrofit.appliance.prewarm')
+def prewarm_appliance():
+    with charm.provide_charm_instance() as instance:
+        instance.prewarm_appliance()
+    set_flag('octavia-diskimage-retrofit.appliance.prewarm')
+
+
+@reactive.hook('upgrade-charm')
+def snap_refreshed():
+    # the snap layer refreshes the snap on charm upgrade
+    clear_flag('octavia-diskimage-retrofit.appliance.prewarm')
+
+
 @reactive.when('identity-credentials.connected')
 @reactive.when_not('identity-credentials.available')
 def request_credentials():
@@ -80,13 +94,32 @@ def request_credentials():
 
 
 @reactive.when('identity-credentials.available')
+@reactive.when_not('octavia-diskimage-retrofit.precheck-state')
 def credentials_available():
+    keystone_endpoint = reactive.endpoint_from_flag(
+        'identity-credentials.available')
     with charm.provide_charm_instance() as instance:
+        instance.update_precheck_state(keystone_endpoint)
         instance.assess_status()
+    set_flag('octavia-diskimage-retrofit.precheck-state')
+
+
+@reactive.hook('identity-credentials-relation-changed', 'upgrade-charm')
+def precheck_state_changed():
+    clear_flag('octavia-diskimage-retrofit.precheck-state')
+
+
+@reactive.when('config.changed')
+def precheck_config_changed():
+    clear_flag('octavia-diskimage-retrofit.precheck-state')
 
 
 @reactive.when_any('config.changed.auto-retrofit',
-                   'config.changed.frequency')
+                   'config.changed.frequency',
+                   'config.changed.notification-transport-url',
+                   'config.changed.notification-exchange',
+                   'config.changed.notification-topic',
+                   'config.changed.notification-debounce')
 def retrofit_by_cron():
     with charm.provide_charm_instance() as instance:
         instance.handle_auto_retrofit()
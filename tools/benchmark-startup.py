@@ -0,0 +1,57 @@
+#!/usr/bin/env python3
+# Copyright 2022 Canonical Ltd
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#  http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+# Measure startup time of the full and the fast (precheck) cron entry
+# points of a deployed charm.
+#
+# Usage: benchmark-startup.py [CHARM_DIR [REPEAT]]
+#
+# Run on a unit as root, CHARM_DIR defaults to the current directory.  Time
+# spent by ``juju-run`` waiting for the unit's hook lock comes on top of the
+# full path and is not included.
+
+import subprocess
+import sys
+import time
+
+# Module level code of the entry points bootstraps the charm, their main is
+# not run when loaded under another name.
+FULL = """
+import runpy
+runpy.run_path('files/retrofit-image.py')
+"""
+FAST = """
+import runpy
+runpy.run_path('files/entry-points.py')
+import charm.openstack.precheck
+"""
+
+
+def benchmark(code, charm_dir, repeat):
+    """Get best wall clock time in seconds of running code."""
+    timings = []
+    for _ in range(repeat):
+        start = time.monotonic()
+        subprocess.check_call([sys.executable, '-c', code], cwd=charm_dir)
+        timings.append(time.monotonic() - start)
+    return min(timings)
+
+
+if __name__ == '__main__':
+    charm_dir = sys.argv[1] if len(sys.argv) > 1 else '.'
+    repeat = int(sys.argv[2]) if len(sys.argv) > 2 else 5
+    for name, code in (('full', FULL), ('fast', FAST)):
+        print('{} startup: {:.3f}s'.format(
+            name, benchmark(code, charm_dir, repeat)))
@@ -30,6 +30,7 @@ sys.modules['glanceclient'] = glanceclient
 sys.modules['keystoneauth1'] = keystoneauth1
 sys.modules['keystoneauth1.loading'] = keystoneauth1.loading
 sys.modules['keystoneauth1.session'] = keystoneauth1.session
+sys.modules['kombu'] = mock.MagicMock()
 
 # Mock out charms.layer modules
 charms_layer = mock.MagicMock()
@@ -0,0 +1,122 @@
+# Copyright 2022 Canonical Ltd
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#  http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+from unittest import mock
+import fcntl
+import os
+import tempfile
+
+import charms_openstack.test_utils as test_utils
+
+import charm.openstack.appliance as appliance
+
+
+class TestAppliance(test_utils.PatchHelper):
+
+    def setUp(self):
+        super().setUp()
+        self.tmpdir = tempfile.TemporaryDirectory()
+        self.addCleanup(self.tmpdir.cleanup)
+        self.root = self.tmpdir.name
+
+    def build_appliance(self, path):
+        guestfs_dir = os.path.join(path, '.guestfs-{}'.format(os.getuid()))
+        os.makedirs(os.path.join(guestfs_dir, 'appliance.d'), exist_ok=True)
+
+    def test_remove_stale(self):
+        old = appliance.prepare('41', self.root)
+        self.build_appliance(old)
+        self.assertTrue(appliance.is_warm(old))
+        self.assertEqual(appliance.prepare('41', self.root), old)
+        self.assertTrue(appliance.is_warm(old))
+        new = appliance.prepare('42', self.root)
+        self.assertEqual(new, os.path.join(self.root, '42'))
+        # a run may still be using the old cache until the pre-warm
+        self.assertTrue(appliance.is_warm(old))
+        self.assertFalse(appliance.is_warm(new))
+        appliance.remove_stale('42', self.root)
+        self.assertFalse(os.path.exists(old))
+        self.assertTrue(os.path.exists(new))
+        self.assertEqual(appliance.environment('42', self.root),
+                         {'LIBGUESTFS_CACHEDIR': new})
+
+    def test_prewarm(self):
+        self.patch_object(appliance.supervisor, 'run')
+        path = appliance.cache_dir('42', self.root)
+        self.run.side_effect = lambda *args, **kwargs: (
+            self.build_appliance(path))
+        stale = appliance.prepare('41', self.root)
+        self.assertFalse(appliance.is_prewarmed('42', self.root))
+        timings = appliance.prewarm('42', self.root)
+        self.assertEqual(sorted(timings), ['cold', 'warm'])
+        self.assertTrue(appliance.is_prewarmed('42', self.root))
+        self.assertFalse(os.path.exists(stale))
+        self.assertEqual(self.run.call_count, 2)
+        self.run.assert_called_with(
+            appliance.TEST_TOOL_CMD, env=mock.ANY, name='appliance-prewarm',
+            timeout=appliance.PREWARM_TIMEOUT)
+        self.assertEqual(self.run.call_args[1]['env']['LIBGUESTFS_CACHEDIR'],
+                         path)
+        self.assertEqual(appliance.read_timings('42', self.root), timings)
+        # an appliance already in the cache only needs a warm start
+        self.run.reset_mock()
+        self.run.side_effect = None
+        self.assertEqual(sorted(appliance.prewarm('42', self.root)),
+                         ['cold', 'warm'])
+        self.run.assert_called_once()
+
+    def test_prewarm_in_progress(self):
+        self.patch_object(appliance.supervisor, 'run')
+        path = appliance.prepare('42', self.root)
+        with open(os.path.join(path, appliance.LOCK_FILE), 'w') as lock:
+            fcntl.flock(lock, fcntl.LOCK_EX)
+            pid = os.fork()
+            if pid == 0:
+                # flock is per open file description, take it in a child
+                os._exit(0 if appliance.prewarm('42', self.root) is None
+                         else 1)
+            _, status = os.waitpid(pid, 0)
+        self.assertEqual(os.WEXITSTATUS(status), 0)
+        self.run.assert_not_called()
+        self.assertFalse(appliance.is_prewarmed('42', self.root))
+
+    def test_prewarm_failed(self):
+        self.patch_object(appliance.supervisor, 'run')
+        self.run.side_effect = appliance.subprocess.CalledProcessError(
+            1, appliance.TEST_TOOL_CMD)
+        with self.assertRaises(appliance.subprocess.CalledProcessError):
+            appliance.prewarm('42', self.root)
+        self.assertFalse(appliance.is_prewarmed('42', self.root))
+
+    def test_spawn_prewarm(self):
+        self.patch_object(appliance.subprocess, 'Popen')
+        appliance.spawn_prewarm('/charm', {'LIBGUESTFS_MEMSIZE': '2048'})
+        self.Popen.assert_called_once_with(
+            [appliance.PREWARM_SCRIPT], cwd='/charm', env=mock.ANY,
+            stdin=appliance.subprocess.DEVNULL,
+            stdout=appliance.subprocess.DEVNULL,
+            stderr=appliance.subprocess.DEVNULL, start_new_session=True)
+        self.assertEqual(
+            self.Popen.call_args[1]['env']['LIBGUESTFS_MEMSIZE'], '2048')
+
+    def test_main(self):
+        self.patch_object(appliance.precheck, 'get_snap_revision')
+        self.patch_object(appliance.supervisor, 'log')
+        self.patch_object(appliance, 'prewarm')
+        self.prewarm.return_value = {'cold': 60.0, 'warm': 3.0}
+        self.assertEqual(appliance.main([]), 0)
+        self.prewarm.side_effect = Exception('no kvm')
+        self.assertEqual(appliance.main([]), 1)
+        self.log.assert_called_with('appliance-prewarm',
+                                    'Pre-warming appliance failed: no kvm')
@@ -0,0 +1,367 @@
+# Copyright 2022 Canonical Ltd
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#  http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+from unittest import mock
+import hashlib
+import http.server
+import os
+import subprocess
+import tempfile
+import threading
+import time
+import urllib.request
+
+import charms_openstack.test_utils as test_utils
+
+import charm.openstack.batch as batch
+import charm.openstack.glance_retrofitter as glance_retrofitter
+
+
+class TestBatchItem(test_utils.PatchHelper):
+
+    def test_result(self):
+        item = batch.BatchItem('jammy', '22.04', 'arm64')
+        self.assertEqual(item.key, 'jammy-arm64')
+        self.assertEqual(item.result(), {'status': batch.STATUS_PENDING})
+        item.status = batch.STATUS_CREATED
+        item.image_id = 'aId'
+        self.assertEqual(item.result(),
+                         {'status': batch.STATUS_CREATED, 'image-id': 'aId'})
+
+    def test_action_key(self):
+        self.assertEqual(batch.action_key('RegionOne'), 'regionone')
+        self.assertEqual(batch.action_key('_Region 2_'), 'region-2')
+        self.assertEqual(batch.action_key('jammy-amd64'), 'jammy-amd64')
+        self.assertEqual(batch.action_key(None), 'default')
+        self.assertEqual(batch.action_key('--'), 'default')
+
+    def test_action_results(self):
+        created = batch.BatchItem('jammy', '22.04', 'amd64')
+        created.status = batch.STATUS_CREATED
+        created.image_id = 'aId'
+        failed = batch.BatchItem('noble', '24.04', 'arm64')
+        failed.status = batch.STATUS_FAILED
+        failed.message = 'boom'
+        self.assertEqual(batch.action_results([created, failed]), {
+            'results.jammy-amd64.status': 'created',
+            'results.jammy-amd64.image-id': 'aId',
+            'results.noble-arm64.status': 'failed',
+            'results.noble-arm64.message': 'boom',
+        })
+
+
+class TestBatchScheduler(test_utils.PatchHelper):
+
+    def setUp(self):
+        super().setUp()
+        self.patch_object(batch.ch_core.hookenv, 'log')
+
+    def test_run(self):
+        items = [batch.BatchItem('jammy', '22.04', arch)
+                 for arch in ('amd64', 'arm64', 's390x')]
+        items[2].status = batch.STATUS_UP_TO_DATE
+        calls = []
+
+        def stage(name):
+            def func(item):
+                calls.append((name, item.key))
+            return func
+
+        batch.BatchScheduler().run(items, ((batch.NETWORK, stage('fetch')),
+                                           (batch.BUILD, stage('build')),
+                                           (batch.NETWORK, stage('publish'))))
+        self.assertEqual([item.status for item in items],
+                         [batch.STATUS_CREATED, batch.STATUS_CREATED,
+                          batch.STATUS_UP_TO_DATE])
+        for key in ('jammy-amd64', 'jammy-arm64'):
+            self.assertEqual([name for name, k in calls if k == key],
+                             ['fetch', 'build', 'publish'])
+        self.assertNotIn('jammy-s390x', [k for _, k in calls])
+
+    def test_run_failure_is_per_item(self):
+        items = [batch.BatchItem('jammy', '22.04', arch)
+                 for arch in ('amd64', 'arm64')]
+        published = []
+
+        def build(item):
+            if item.arch == 'amd64':
+                raise Exception('retrofit failed')
+
+        batch.BatchScheduler(2, 2).run(
+            items, ((batch.BUILD, build),
+                    (batch.NETWORK, lambda item: published.append(item.key))))
+        self.assertEqual(items[0].status, batch.STATUS_FAILED)
+        self.assertEqual(items[0].message, 'retrofit failed')
+        self.assertEqual(items[1].status, batch.STATUS_CREATED)
+        self.assertEqual(published, ['jammy-arm64'])
+        self.log.assert_called_once()
+
+    def test_run_separate_pools(self):
+        # With a single worker per pool the build of the first item can
+        # only overlap with the download of the second item when network
+        # and build stages run on separate pools.
+        items = [batch.BatchItem('jammy', '22.04', arch)
+                 for arch in ('amd64', 'arm64')]
+        fetched = threading.Event()
+        overlapped = []
+
+        def fetch(item):
+            if item.arch == 'arm64':
+                fetched.set()
+
+        def build(item):
+            if item.arch == 'amd64':
+                overlapped.append(fetched.wait(5))
+
+        batch.BatchScheduler(network_workers=1, build_workers=1).run(
+            items, ((batch.NETWORK, fetch), (batch.BUILD, build)))
+        self.assertEqual(overlapped, [True])
+        self.assertEqual([item.status for item in items],
+                         [batch.STATUS_CREATED] * 2)
+
+    def test_run_bounded_in_flight(self):
+        items = [batch.BatchItem('jammy', '22.04', str(n)) for n in range(6)]
+        lock = threading.Lock()
+        state = {'in_flight': 0, 'max_in_flight': 0}
+
+        def fetch(item):
+            with lock:
+                state['in_flight'] += 1
+                state['max_in_flight'] = max(state['max_in_flight'],
+                                             state['in_flight'])
+
+        def publish(item):
+            time.sleep(0.01)
+            with lock:
+                state['in_flight'] -= 1
+
+        batch.BatchScheduler(network_workers=4, build_workers=4,
+                             max_in_flight=2).run(
+            items, ((batch.NETWORK, fetch), (batch.BUILD, publish)))
+        self.assertEqual(state['max_in_flight'], 2)
+        self.assertEqual(set(item.status for item in items),
+                         {batch.STATUS_CREATED})
+
+    def test_run_scratch_space_backpressure(self):
+        self.patch_object(batch, 'free_space')
+        self.free_space.return_value = 250
+        items = [batch.BatchItem('jammy', '22.04', str(n)) for n in range(3)]
+        order = []
+
+        def stage(name):
+            def func(item):
+                order.append((name, item.arch))
+            return func
+
+        batch.BatchScheduler(network_workers=4, build_workers=4,
+                             scratch_dir='/scratch').run(
+            items, ((batch.NETWORK, stage('fetch')),
+                    (batch.BUILD, stage('build'))),
+            space_needed=lambda item: 100)
+        self.free_space.assert_called_with('/scratch')
+        # room for two items at a time, the third is admitted when the
+        # first leaves the pipeline
+        self.assertLess(order.index(('build', '0')),
+                        order.index(('fetch', '2')))
+        self.assertEqual(set(item.status for item in items),
+                         {batch.STATUS_CREATED})
+        # an item that does not fit on its own is still run
+        self.free_space.return_value = 10
+        items = [batch.BatchItem('jammy', '22.04', 'amd64')]
+        batch.BatchScheduler(scratch_dir='/scratch').run(
+            items, ((batch.NETWORK, stage('fetch')),),
+            space_needed=lambda item: 100)
+        self.assertEqual(items[0].status, batch.STATUS_CREATED)
+
+    def test_run_space_available(self):
+        self.patch_object(batch, 'free_space')
+        items = [batch.BatchItem('jammy', '22.04', str(n)) for n in range(2)]
+        space_available = mock.MagicMock(return_value=150)
+        batch.BatchScheduler(scratch_dir='/scratch',
+                             space_available=space_available).run(
+            items, ((batch.NETWORK, lambda item: None),),
+            space_needed=lambda item: 100)
+        space_available.assert_called_with()
+        self.free_space.assert_not_called()
+        self.assertEqual(set(item.status for item in items),
+                         {batch.STATUS_CREATED})
+
+    def test_run_space_measured_once(self):
+        # Files written by items in the pipeline reduce free space, which
+        # must not count against their reservation a second time.
+        items = [batch.BatchItem('jammy', '22.04', str(n)) for n in range(2)]
+        free = [200]
+        fetched = threading.Event()
+        overlapped = []
+
+        def fetch(item):
+            free[0] -= 100
+            if item.arch == '1':
+                fetched.set()
+
+        def build(item):
+            if item.arch == '0':
+                overlapped.append(fetched.wait(5))
+
+        space_available = mock.MagicMock(side_effect=lambda: free[0])
+        batch.BatchScheduler(scratch_dir='/scratch',
+                             space_available=space_available).run(
+            items, ((batch.NETWORK, fetch), (batch.BUILD, build)),
+            space_needed=lambda item: 100)
+        space_available.assert_called_once_with()
+        self.assertEqual(overlapped, [True])
+
+    def test_run_cleanup(self):
+        # Space of files a failed item leaves behind stays reserved.
+        items = [batch.BatchItem('jammy', '22.04', str(n)) for n in range(3)]
+        order = []
+        cleaned = []
+        failed = threading.Event()
+
+        def fetch(item):
+            order.append(('fetch', item.arch))
+            if item.arch == '0':
+                raise Exception('download stalled')
+            failed.wait(5)
+
+        def build(item):
+            order.append(('build', item.arch))
+
+        def cleanup(item):
+            cleaned.append(item.arch)
+            failed.set()
+            return 100 if item.arch == '0' else 0
+
+        batch.BatchScheduler(network_workers=2, build_workers=2,
+                             scratch_dir='/scratch',
+                             space_available=lambda: 250).run(
+            items, ((batch.NETWORK, fetch), (batch.BUILD, build)),
+            space_needed=lambda item: 100, cleanup=cleanup)
+        self.assertEqual(sorted(cleaned), ['0', '1', '2'])
+        self.assertLess(order.index(('build', '1')),
+                        order.index(('fetch', '2')))
+        self.assertEqual([item.status for item in items],
+                         [batch.STATUS_FAILED, batch.STATUS_CREATED,
+                          batch.STATUS_CREATED])
+
+    def test_run_prefers_later_stages(self):
+        items = [batch.BatchItem('jammy', '22.04', str(n)) for n in range(3)]
+        order = []
+
+        def stage(name):
+            def func(item):
+                order.append((name, item.arch))
+            return func
+
+        batch.BatchScheduler(network_workers=1, build_workers=1).run(
+            items, ((batch.NETWORK, stage('fetch')),
+                    (batch.BUILD, stage('build')),
+                    (batch.NETWORK, stage('publish'))))
+        self.assertLess(order.index(('publish', '0')),
+                        order.index(('fetch', '2')))
+
+    def test_free_space(self):
+        with tempfile.TemporaryDirectory() as tmpdir:
+            self.assertGreater(batch.free_space(tmpdir), 0)
+            self.assertIsNone(batch.free_space(os.path.join(tmpdir, 'no')))
+
+
+class SlowGlanceHandler(http.server.BaseHTTPRequestHandler):
+
+    def log_message(self, *args):
+        pass
+
+    def do_GET(self):
+        time.sleep(self.server.latency)
+        data = self.server.image_data
+        self.send_response(200)
+        self.send_header('Content-Type', 'application/octet-stream')
+        self.send_header('Content-Length', str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+
+class TestPipeline(test_utils.PatchHelper):
+    """Run a batch through real downloads and retrofit tool processes.
+
+    Downloads come from a stub Glance with a fixed latency per request, the
+    retrofit tool is a command that sleeps and uploads are simulated.
+    """
+
+    STAGE_TIME = 0.1
+    IMAGES = 4
+
+    def setUp(self):
+        super().setUp()
+        self.patch_object(batch.ch_core.hookenv, 'log')
+        self.server = http.server.ThreadingHTTPServer(
+            ('127.0.0.1', 0), SlowGlanceHandler)
+        self.server.latency = self.STAGE_TIME
+        self.server.image_data = os.urandom(256 * 1024)
+        thread = threading.Thread(target=self.server.serve_forever)
+        thread.daemon = True
+        thread.start()
+        self.addCleanup(self.server.server_close)
+        self.addCleanup(self.server.shutdown)
+        base_url = 'http://127.0.0.1:{}'.format(self.server.server_address[1])
+
+        def data(image_id):
+            with urllib.request.urlopen(
+                    base_url + glance_retrofitter.IMAGE_DATA_URL.format(
+                        image_id)) as resp:
+                for chunk in iter(lambda: resp.read(65536), b''):
+                    yield chunk
+        self.glance = mock.MagicMock()
+        self.glance.images.data.side_effect = data
+        self.tmpdir = tempfile.TemporaryDirectory()
+        self.addCleanup(self.tmpdir.cleanup)
+
+    def test_pipelined(self):
+        items = [batch.BatchItem('jammy', '22.04', str(n))
+                 for n in range(self.IMAGES)]
+        fetched = {}
+        for item in items:
+            item.source_image = mock.MagicMock()
+            item.source_image.id = item.arch
+            item.source_image.size = len(self.server.image_data)
+            item.source_image.os_hash_algo = 'sha512'
+            item.source_image.os_hash_value = hashlib.sha512(
+                self.server.image_data).hexdigest()
+            fetched[item.arch] = threading.Event()
+        overlapped = []
+
+        def fetch(item):
+            item.input_path = os.path.join(self.tmpdir.name, item.arch)
+            with open(item.input_path, 'w+b') as f:
+                glance_retrofitter.download_image(
+                    self.glance, item.source_image, f)
+            fetched[item.arch].set()
+
+        def build(item):
+            # The next image is downloaded while this one is retrofitted.
+            following = str(int(item.arch) + 1)
+            if following in fetched:
+                overlapped.append(fetched[following].wait(5))
+            subprocess.check_call(['sleep', str(self.STAGE_TIME)])
+
+        def publish(item):
+            time.sleep(self.STAGE_TIME)
+
+        batch.BatchScheduler(network_workers=2, build_workers=1).run(
+            items, ((batch.NETWORK, fetch),
+                    (batch.BUILD, build),
+                    (batch.NETWORK, publish)))
+        self.assertEqual(overlapped, [True] * (self.IMAGES - 1))
+        self.assertEqual(set(item.status for item in items),
+                         {batch.STATUS_CREATED})
@@ -0,0 +1,226 @@
+# Copyright 2022 Canonical Ltd
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#  http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import hashlib
+import io
+import os
+import tempfile
+import threading
+import time
+
+import charms_openstack.test_utils as test_utils
+
+import charm.openstack.fanout as fanout
+import charm.openstack.glance_retrofitter as glance_retrofitter
+import charm.openstack.progress as progress
+
+
+class FakeImages(object):
+
+    def __init__(self, fail=False, delay=0, read_size=65536):
+        self.fail = fail
+        self.delay = delay
+        self.read_size = read_size
+        self.data = {}
+
+    def upload(self, image_id, reader):
+        data = []
+        for chunk in iter(lambda: reader.read(self.read_size), b''):
+            if self.fail:
+                raise Exception('connection reset')
+            time.sleep(self.delay)
+            data.append(chunk)
+        self.data[image_id] = b''.join(data)
+
+    stage = upload
+
+    def image_import(self, image_id, method, **kwargs):
+        self.imported = (image_id, method, kwargs)
+
+    def get(self, image_id):
+        image = type('FakeImage', (object,), {})()
+        image.status = 'active'
+        image.os_hash_algo = 'sha512'
+        image.os_hash_value = hashlib.sha512(
+            self.data[image_id]).hexdigest()
+        return image
+
+
+class FakeGlance(object):
+
+    def __init__(self, **kwargs):
+        self.images = FakeImages(**kwargs)
+
+
+class FailingFile(object):
+
+    def __init__(self, fail_after):
+        self.remaining = fail_after
+
+    def read(self, size):
+        if self.remaining <= 0:
+            raise OSError('I/O error')
+        self.remaining -= 1
+        return b'x' * size
+
+
+class TestFanOut(test_utils.PatchHelper):
+
+    def test_readers_see_all_data(self):
+        data = os.urandom(1000)
+        hasher = glance_retrofitter.MultiHasher(('sha256',))
+        target = fanout.FanOut(io.BytesIO(data), ('a', 'b'), hasher=hasher,
+                               chunk_size=64, window=2)
+        received = {}
+
+        def consume(name, read_size):
+            reader = target.readers[name]
+            received[name] = b''.join(
+                iter(lambda: reader.read(read_size), b''))
+        threads = [threading.Thread(target=consume, args=('a', 10)),
+                   threading.Thread(target=consume, args=('b', 100))]
+        for thread in threads:
+            thread.start()
+        self.assertEqual(target.pump(), 1000)
+        for thread in threads:
+            thread.join()
+        self.assertEqual(received, {'a': data, 'b': data})
+        self.assertEqual(hasher.hexdigests(),
+                         {'sha256': hashlib.sha256(data).hexdigest()})
+
+    def test_closed_reader_does_not_block(self):
+        target = fanout.FanOut(io.BytesIO(b'x' * 1000), ('a', 'b'),
+                               chunk_size=10, window=1)
+        target.readers['b'].close()
+        received = []
+        thread = threading.Thread(target=lambda: received.append(
+            target.readers['a'].read()))
+        thread.start()
+        self.assertEqual(target.pump(), 1000)
+        thread.join()
+        self.assertEqual(received, [b'x' * 1000])
+
+    def test_read_error(self):
+        target = fanout.FanOut(FailingFile(2), ('a',), chunk_size=10,
+                               window=4)
+        self.assertEqual(target.pump(), 20)
+        self.assertIsInstance(target.error, OSError)
+        reader = target.readers['a']
+        self.assertEqual(reader.read(10), b'x' * 10)
+        self.assertEqual(reader.read(10), b'x' * 10)
+        with self.assertRaises(glance_retrofitter.TransferError):
+            reader.read(10)
+        with self.assertRaises(glance_retrofitter.TransferError):
+            reader.read(10)
+
+
+class TestUpload(test_utils.PatchHelper):
+
+    def setUp(self):
+        super().setUp()
+        self.tmpdir = tempfile.TemporaryDirectory()
+        self.path = os.path.join(self.tmpdir.name, 'image')
+        self.data = os.urandom(3 * 1024 * 1024 + 17)
+        with open(self.path, 'wb') as f:
+            f.write(self.data)
+
+    def tearDown(self):
+        self.tmpdir.cleanup()
+        super().tearDown()
+
+    def test_upload(self):
+        glances = {'RegionOne': FakeGlance(),
+                   'RegionTwo': FakeGlance(delay=0.001, read_size=4096),
+                   'RegionThree': FakeGlance(fail=True)}
+        results = fanout.upload(
+            {region: (glance, 'id-' + region)
+             for region, glance in glances.items()},
+            self.path, hash_algo='sha512', window=2)
+        digests = {'sha512': hashlib.sha512(self.data).hexdigest()}
+        for region in ('RegionOne', 'RegionTwo'):
+            self.assertEqual(glances[region].images.data['id-' + region],
+                             self.data)
+            self.assertIsNone(results[region].error)
+            self.assertEqual(results[region].digests, digests)
+            self.assertEqual(results[region].size, len(self.data))
+            self.assertGreater(results[region].throughput, 0)
+        self.assertEqual(str(results['RegionThree'].error),
+                         'connection reset')
+        self.assertIsNone(results['RegionThree'].digests)
+
+    def test_upload_meter(self):
+        meter = progress.ProgressMeter('Uploading x')
+        meter.position = 10
+        results = fanout.upload({None: (FakeGlance(), 'aId')}, self.path,
+                                meter=meter)
+        self.assertIsNone(results[None].error)
+        self.assertEqual(meter.total, len(self.data))
+        self.assertEqual(meter.position, len(self.data))
+
+    def test_upload_stalled(self):
+        clock = iter(range(0, 10 ** 9, 1000))
+        self.patch_object(progress.time, 'monotonic',
+                          new=lambda: next(clock))
+        meter = progress.ProgressMeter('Uploading x', min_rate=10 ** 9,
+                                       stall_timeout=1)
+        glances = {'RegionOne': FakeGlance(), 'RegionTwo': FakeGlance()}
+        results = fanout.upload(
+            {region: (glance, 'id-' + region)
+             for region, glance in glances.items()},
+            self.path, meter=meter)
+        for result in results.values():
+            self.assertIsInstance(result.error,
+                                  glance_retrofitter.TransferError)
+
+    def test_upload_import(self):
+        glances = {'RegionOne': FakeGlance(), 'RegionTwo': FakeGlance()}
+        glances['RegionOne'].images.upload = None
+        results = fanout.upload(
+            {region: (glance, 'id-' + region)
+             for region, glance in glances.items()},
+            self.path, imports={'RegionOne': {'all_stores': True}})
+        self.assertEqual(results['RegionOne'].method, fanout.METHOD_IMPORT)
+        self.assertEqual(results['RegionTwo'].method, fanout.METHOD_UPLOAD)
+        for region in ('RegionOne', 'RegionTwo'):
+            self.assertIsNone(results[region].error)
+            self.assertEqual(glances[region].images.data['id-' + region],
+                             self.data)
+        self.assertEqual(glances['RegionOne'].images.imported, (
+            'id-RegionOne', 'glance-direct',
+            {'all_stores': True, 'allow_failure': False}))
+
+    def test_upload_checksum_mismatch(self):
+        glance = FakeGlance()
+        glance.images.get = lambda image_id: type(
+            'FakeImage', (object,),
+            {'os_hash_algo': 'sha512', 'os_hash_value': 'bad'})()
+        results = fanout.upload({None: (glance, 'aId')}, self.path)
+        self.assertIsInstance(results[None].error,
+                              glance_retrofitter.ChecksumMismatch)
+
+    def test_action_results(self):
+        ok = fanout.UploadResult('aId')
+        ok.size, ok.seconds, ok.attempts = 20 * fanout.MIB, 4.0, 1
+        failed = fanout.UploadResult(error=Exception('boom'))
+        failed.attempts = 3
+        self.assertEqual(
+            fanout.action_results({'RegionOne': ok, None: failed}), {
+                'regions.regionone.attempts': '1',
+                'regions.regionone.method': 'upload',
+                'regions.regionone.image-id': 'aId',
+                'regions.regionone.throughput': '5.0 MiB/s',
+                'regions.default.attempts': '3',
+                'regions.default.method': 'upload',
+                'regions.default.error': 'boom',
+            })
@@ -13,14 +13,274 @@
 # limitations under the License.
 
 from unittest import mock
+import hashlib
+import http.server
+import os
+import re
+import tempfile
+import threading
+import urllib.request
 
 import charms_openstack.test_utils as test_utils
 
 import charm.openstack.glance_retrofitter as glance_retrofitter
+import charm.openstack.progress as progress
+
+
+class StubGlanceHandler(http.server.BaseHTTPRequestHandler):
+
+    def log_message(self, *args):
+        pass
+
+    def do_GET(self):
+        data = self.server.image_data
+        match = re.match(r'bytes=(\d+)-(\d*)',
+                         self.headers.get('Range', ''))
+        if match and self.server.honour_range:
+            start = int(match.group(1))
+            end = int(match.group(2) or len(data) - 1)
+            self.send_response(206)
+            self.send_header('Content-Range', 'bytes {}-{}/{}'
+                             .format(start, end, len(data)))
+            data = data[start:end + 1]
+        else:
+            self.send_response(200)
+        self.send_header('Content-Type', 'application/octet-stream')
+        self.send_header('Content-Length', str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+        self.server.requests.append(self.headers.get('Range'))
+
+
+class StubGlanceHttpClient(object):
+    """Minimal stand-in for glanceclient's HTTP client."""
+
+    def __init__(self, base_url):
+        self.base_url = base_url
+
+    def get(self, url, headers=None):
+        request = urllib.request.Request(self.base_url + url,
+                                         headers=headers or {})
+        resp = urllib.request.urlopen(request)
+        resp.status_code = resp.status
+
+        def body():
+            with resp:
+                for chunk in iter(lambda: resp.read(1000), b''):
+                    yield chunk
+        return resp, body()
+
+
+class TestSegmentedDownload(test_utils.PatchHelper):
+
+    def setUp(self):
+        super().setUp()
+        self.server = http.server.ThreadingHTTPServer(
+            ('127.0.0.1', 0), StubGlanceHandler)
+        self.server.image_data = bytes(range(256)) * 100
+        self.server.honour_range = True
+        self.server.requests = []
+        thread = threading.Thread(target=self.server.serve_forever)
+        thread.daemon = True
+        thread.start()
+        self.glance = mock.MagicMock()
+        self.glance.http_client = StubGlanceHttpClient(
+            'http://127.0.0.1:{}'.format(self.server.server_address[1]))
+        self.image = mock.MagicMock()
+        self.image.id = 'aId'
+        self.image.size = len(self.server.image_data)
+        self.image.os_hash_algo = 'sha512'
+        self.image.os_hash_value = hashlib.sha512(
+            self.server.image_data).hexdigest()
+        self.tmpdir = tempfile.TemporaryDirectory()
+        self.path = os.path.join(self.tmpdir.name, 'image')
+
+    def tearDown(self):
+        self.server.shutdown()
+        self.server.server_close()
+        self.tmpdir.cleanup()
+        super().tearDown()
+
+    def test_download_image_segmented(self):
+        self.assertEqual(
+            glance_retrofitter.download_image(
+                self.glance, self.image, open(self.path, 'w+b'),
+                connections=4, segment_size=3000),
+            {'sha512': self.image.os_hash_value})
+        with open(self.path, 'rb') as fin:
+            self.assertEqual(fin.read(), self.server.image_data)
+        self.assertEqual(len(self.server.requests), 9)
+        self.assertIn('bytes=24000-25599', self.server.requests)
+        self.glance.images.data.assert_not_called()
+
+    def test_download_image_segmented_no_read_back(self):
+        self.patch_object(glance_retrofitter.os, 'pread',
+                          side_effect=AssertionError('read back'))
+        self.patch_object(glance_retrofitter, 'REORDER_BUFFER_SIZE',
+                          new=2000)
+        self.assertEqual(
+            glance_retrofitter.download_image(
+                self.glance, self.image, open(self.path, 'w+b'),
+                connections=4, segment_size=3000),
+            {'sha512': self.image.os_hash_value})
+
+    def test_download_image_range_not_supported(self):
+        self.server.honour_range = False
+        self.glance.images.data.return_value = [self.server.image_data]
+        glance_retrofitter.download_image(
+            self.glance, self.image, open(self.path, 'w+b'), connections=4,
+            segment_size=3000)
+        with open(self.path, 'rb') as fin:
+            self.assertEqual(fin.read(), self.server.image_data)
+        self.glance.images.data.assert_called_once_with('aId')
+
+    def test_download_image_segmented_checksum_mismatch(self):
+        self.image.os_hash_value = hashlib.sha512(b'other').hexdigest()
+        with self.assertRaises(glance_retrofitter.ChecksumMismatch):
+            glance_retrofitter.download_image(
+                self.glance, self.image, open(self.path, 'w+b'),
+                connections=4, segment_size=3000)
+
+    def test_download_image_short_segment(self):
+        self.image.size += 1
+        with self.assertRaises(glance_retrofitter.TransferError):
+            glance_retrofitter.download_image(
+                self.glance, self.image, open(self.path, 'w+b'),
+                connections=4, segment_size=3000, attempts=1)
+
+    def test_download_image_resume(self):
+        self.patch_object(glance_retrofitter.time, 'sleep')
+        self.patch_object(glance_retrofitter, 'JOURNAL_INTERVAL', new=1000)
+        data = self.server.image_data
+        failures = [Exception('connection reset')]
+
+        def body():
+            yield data[:10000]
+            raise failures.pop()
+        self.glance.images.data.side_effect = lambda image_id: body()
+        journal = glance_retrofitter.DownloadJournal(self.path)
+        with self.assertRaises(Exception):
+            glance_retrofitter.download_image(
+                self.glance, self.image, journal.open(), journal=journal,
+                attempts=1)
+        self.assertEqual(journal.load(self.image), 10000)
+        self.assertEqual(os.path.getsize(self.path), len(data))
+        # A new run continues where the failed one stopped.
+        self.assertEqual(
+            glance_retrofitter.download_image(
+                self.glance, self.image, journal.open(), journal=journal),
+            {'sha512': self.image.os_hash_value})
+        with open(self.path, 'rb') as fin:
+            self.assertEqual(fin.read(), data)
+        self.assertEqual(self.server.requests, ['bytes=10000-25599'])
+        self.sleep.assert_not_called()
+        # Within a run the failed transfer is retried with a range request.
+        journal.discard()
+        self.server.requests = []
+        failures.append(Exception('connection reset'))
+        glance_retrofitter.download_image(
+            self.glance, self.image, journal.open(), journal=journal)
+        with open(self.path, 'rb') as fin:
+            self.assertEqual(fin.read(), data)
+        self.assertEqual(self.server.requests, ['bytes=10000-25599'])
+        self.sleep.assert_called_once_with(
+            glance_retrofitter.DOWNLOAD_RETRY_INTERVAL)
+
+    def test_download_image_resume_unknown_size(self):
+        self.image.size = None
+        data = self.server.image_data
+
+        def body():
+            yield data[:10000]
+            raise Exception('connection reset')
+        self.glance.images.data.side_effect = lambda image_id: body()
+        journal = glance_retrofitter.DownloadJournal(self.path)
+        with self.assertRaises(Exception):
+            glance_retrofitter.download_image(
+                self.glance, self.image, journal.open(), journal=journal,
+                attempts=1)
+        glance_retrofitter.download_image(
+            self.glance, self.image, journal.open(), journal=journal)
+        with open(self.path, 'rb') as fin:
+            self.assertEqual(fin.read(), data)
+        self.assertEqual(self.server.requests, ['bytes=10000-'])
+
+    def test_download_image_stalled(self):
+        self.patch_object(glance_retrofitter.time, 'sleep')
+        stalls = [progress.TransferStalled('stalled')]
+
+        def update(size):
+            if stalls and meter.update.call_count > 3:
+                raise stalls.pop()
+        meter = mock.MagicMock()
+        meter.update.side_effect = update
+        glance_retrofitter.download_image(
+            self.glance, self.image, open(self.path, 'w+b'), connections=4,
+            segment_size=3000, meter=meter)
+        with open(self.path, 'rb') as fin:
+            self.assertEqual(fin.read(), self.server.image_data)
+        # The first segment is complete before the stall, concurrent
+        # segments may have completed as well.
+        self.assertEqual(meter.restart.call_count, 2)
+        self.assertEqual(meter.restart.call_args_list[0], mock.call(0))
+        resumed_at = meter.restart.call_args[0][0]
+        self.assertEqual(resumed_at % 3000, 0)
+        self.assertGreaterEqual(resumed_at, 3000)
+        self.assertLess(resumed_at, len(self.server.image_data))
+        self.sleep.assert_called_once_with(
+            glance_retrofitter.DOWNLOAD_RETRY_INTERVAL)
+
+    def test_download_image_resume_range_not_supported(self):
+        self.server.honour_range = False
+        self.glance.images.data.return_value = [self.server.image_data]
+        journal = glance_retrofitter.DownloadJournal(self.path)
+        with journal.open() as f:
+            f.write(b'x' * 5000)
+            journal.save(self.image, f.fileno(), 5000)
+        glance_retrofitter.download_image(
+            self.glance, self.image, journal.open(), connections=4,
+            segment_size=3000, journal=journal)
+        with open(self.path, 'rb') as fin:
+            self.assertEqual(fin.read(), self.server.image_data)
+        self.glance.images.data.assert_called_once_with('aId')
+
+    def test_download_journal(self):
+        journal = glance_retrofitter.DownloadJournal(self.path)
+        self.assertEqual(journal.load(self.image), 0)
+        with journal.open() as f:
+            f.write(b'x' * 100)
+            journal.save(self.image, f.fileno(), 100)
+        self.assertEqual(journal.load(self.image), 100)
+        other = mock.MagicMock()
+        other.id = 'otherId'
+        self.assertEqual(journal.load(other), 0)
+        with journal.open() as f:
+            f.truncate(50)
+        self.assertEqual(journal.load(self.image), 0)
+        journal.discard()
+        self.assertFalse(os.path.exists(self.path))
+        self.assertFalse(os.path.exists(self.path + '.journal'))
 
 
 class TestGlanceRetrofitter(test_utils.PatchHelper):
 
+    def test_credentials_from_identity_credentials(self):
+        endpoint = mock.MagicMock()
+        self.assertEqual(
+            glance_retrofitter.credentials_from_identity_credentials(
+                endpoint),
+            {
+                'auth_url': '{}://{}:{}/'.format(endpoint.auth_protocol(),
+                                                 endpoint.auth_host(),
+                                                 endpoint.auth_port()),
+                'user_domain_name': endpoint.credentials_user_domain_name(),
+                'project_domain_name': (
+                    endpoint.credentials_project_domain_name()),
+                'project_name': endpoint.credentials_project(),
+                'username': endpoint.credentials_username(),
+                'password': endpoint.credentials_password(),
+            })
+
     def test_session_from_identity_credentials(self):
         self.patch_object(
             glance_retrofitter.keystoneauth1.loading, 'get_plugin_loader')
@@ -43,7 +303,8 @@ class TestGlanceRetrofitter(test_utils.PatchHelper):
             password=endpoint.credentials_password())
         self.Session.assert_called_once_with(
             auth=loader.load_from_options(),
-            verify=glance_retrofitter.SYSTEM_CA_BUNDLE)
+            verify=glance_retrofitter.SYSTEM_CA_BUNDLE,
+            timeout=None)
         self.assertEqual(result, self.Session())
 
     def test_get_glance_client(self):
@@ -64,6 +325,41 @@ class TestGlanceRetrofitter(test_utils.PatchHelper):
             session, service_type='image', interface='publicURL',
             region_name=None)
 
+    def test_session_from_credentials_token_cache(self):
+        self.patch_object(
+            glance_retrofitter.keystoneauth1.loading, 'get_plugin_loader')
+        self.patch_object(
+            glance_retrofitter.keystoneauth1.session, 'Session')
+        loader = self.get_plugin_loader.return_value
+        token_cache = mock.MagicMock()
+        glance_retrofitter.session_from_credentials(
+            {'username': 'aUser'}, token_cache=token_cache)
+        token_cache.restore.assert_called_once_with(
+            loader.load_from_options(), {'username': 'aUser'})
+
+    def test_get_glance_client_token_cache(self):
+        self.patch_object(glance_retrofitter.glanceclient, 'Client')
+        session = mock.MagicMock()
+        token_cache = mock.MagicMock()
+        token_cache.endpoint.return_value = 'https://cached:9292'
+        glance_retrofitter.get_glance_client(
+            session, region='aRegion', token_cache=token_cache)
+        token_cache.endpoint.assert_called_once_with('aRegion', 'publicURL')
+        session.auth.get_endpoint.assert_not_called()
+        token_cache.update.assert_not_called()
+        self.Client.assert_called_once_with(
+            '2', session=session, endpoint='https://cached:9292')
+        token_cache.endpoint.return_value = None
+        glance_retrofitter.get_glance_client(
+            session, endpoint_type='internalURL', region='aRegion',
+            token_cache=token_cache)
+        session.auth.get_endpoint.assert_called_once_with(
+            session, service_type='image', interface='internalURL',
+            region_name='aRegion')
+        token_cache.update.assert_called_once_with(
+            session.auth, 'aRegion', 'internalURL',
+            session.auth.get_endpoint())
+
     def test_get_product_name(self):
         self.patch_object(glance_retrofitter.subprocess, 'check_output')
         self.check_output.return_value = 'aArchitecture'
@@ -101,34 +397,263 @@ class TestGlanceRetrofitter(test_utils.PatchHelper):
             filters={'source_product_name': 'aProduct',
                      'source_version_name': 'aVersion'})
         self.assertEqual(result, glance.images.list())
+        glance.images.list.reset_mock()
+        glance_retrofitter.find_destination_image(
+            glance, 'aProduct', 'aVersion', fingerprint='aFingerprint')
+        glance.images.list.assert_called_once_with(
+            filters={'source_product_name': 'aProduct',
+                     'source_version_name': 'aVersion',
+                     'retrofit_fingerprint': 'aFingerprint'})
+
+    def test_discover_source_images(self):
+        self.patch_object(glance_retrofitter, 'get_architecture')
+        self.get_architecture.return_value = 'amd64'
+        glance = mock.MagicMock()
+
+        def _image(product_name, version_name):
+            image = mock.MagicMock()
+            image.product_name = product_name
+            image.version_name = version_name
+            return image
+        daily = _image('com.ubuntu.cloud.daily:server:22.04:amd64', '2')
+        daily_old = _image('com.ubuntu.cloud.daily:server:22.04:amd64', '1')
+        released = _image('com.ubuntu.cloud:minimal:20.04:amd64', '3')
+        other = _image('com.ubuntu.cloud:server:20.04:arm64', '4')
+        glance.images.list.return_value = [daily_old, daily, released,
+                                           other]
+        self.assertEqual(
+            glance_retrofitter.discover_source_images(
+                glance, ('22.04', '20.04')),
+            {('daily', 'server', '22.04', 'amd64'): daily,
+             ('released', 'minimal', '20.04', 'amd64'): released})
+        glance.images.list.assert_called_once_with(
+            filters={'product_name': (
+                'in:com.ubuntu.cloud.daily:minimal:20.04:amd64,'
+                'com.ubuntu.cloud.daily:minimal:22.04:amd64,'
+                'com.ubuntu.cloud.daily:server:20.04:amd64,'
+                'com.ubuntu.cloud.daily:server:22.04:amd64,'
+                'com.ubuntu.cloud:minimal:20.04:amd64,'
+                'com.ubuntu.cloud:minimal:22.04:amd64,'
+                'com.ubuntu.cloud:server:20.04:amd64,'
+                'com.ubuntu.cloud:server:22.04:amd64')},
+            sort_key='created_at',
+            sort_dir='desc')
+        glance.images.list.reset_mock()
+        glance.images.list.side_effect = [[], [daily, other]]
+        self.assertEqual(
+            glance_retrofitter.discover_source_images(
+                glance, ('22.04',), architectures=('arm64', 'amd64')),
+            {('daily', 'server', '22.04', 'amd64'): daily})
+        glance.images.list.assert_called_with(
+            filters={'os_distro': 'ubuntu'},
+            sort_key='created_at',
+            sort_dir='desc')
+        self.assertEqual(glance.images.list.call_count, 2)
 
     def test_find_source_image(self):
-        self.patch_object(glance_retrofitter, 'get_product_name')
-        self.patch_object(glance_retrofitter, 'find_image')
-        self.get_product_name.return_value = 'aProduct'
-        self.find_image.side_effect = [None, None, None, 'aImage']
+        self.patch_object(glance_retrofitter, 'get_architecture')
+        self.get_architecture.return_value = 'amd64'
+        index = {
+            ('released', 'server', '42.04', 'amd64'): 'aReleasedServer',
+            ('released', 'minimal', '42.04', 'amd64'): 'aReleasedMinimal',
+            ('daily', 'minimal', '42.04', 'amd64'): 'aDailyMinimal',
+            ('daily', 'server', '42.04', 'arm64'): 'aArmDailyServer',
+        }
         self.assertEqual(
-            glance_retrofitter.find_source_image('aGlance', '42.04'),
-            'aImage')
-        self.get_product_name.assert_has_calls([
-            mock.call(stream='daily', variant='server', release='42.04'),
-            mock.call(stream='daily', variant='minimal', release='42.04'),
-            mock.call(stream='released', variant='server', release='42.04'),
-            mock.call(stream='released', variant='minimal', release='42.04'),
-        ])
-        self.find_image.assert_called_with(
-            'aGlance', filters={'product_name': 'aProduct'})
+            glance_retrofitter.find_source_image(index, '42.04'),
+            'aDailyMinimal')
+        self.assertEqual(
+            glance_retrofitter.find_source_image(index, '42.04',
+                                                 arch='arm64'),
+            'aArmDailyServer')
+        del index[('daily', 'minimal', '42.04', 'amd64')]
+        self.assertEqual(
+            glance_retrofitter.find_source_image(index, '42.04'),
+            'aReleasedServer')
+        self.assertIsNone(
+            glance_retrofitter.find_source_image(index, '43.04'))
 
     def test_download_image(self):
         glance = mock.MagicMock()
-        glance.images.data.return_value = ['two', 'Chunks']
+        glance.images.data.return_value = [b'two', b'Chunks']
+        image = mock.MagicMock()
+        image.os_hash_algo = None
+        image.os_hash_value = None
+        image.checksum = hashlib.md5(b'twoChunks').hexdigest()
+        image.size = 9
+        with tempfile.NamedTemporaryFile() as f:
+            self.assertEqual(
+                glance_retrofitter.download_image(
+                    glance, image, open(f.name, 'w+b')),
+                {'md5': image.checksum})
+            glance.images.data.assert_called_once_with(image.id)
+            self.assertEqual(f.read(), b'twoChunks')
+            image.checksum = hashlib.md5(b'oneChunk').hexdigest()
+            with self.assertRaises(glance_retrofitter.ChecksumMismatch):
+                glance_retrofitter.download_image(
+                    glance, image, open(f.name, 'w+b'))
+
+    def test_download_image_sparse(self):
+        glance = mock.MagicMock()
+        chunks = [b'a' * 4096, bytes(65536), bytes(65536), b'b' * 10,
+                  bytes(4096)]
+        glance.images.data.return_value = chunks
+        data = b''.join(chunks)
+        image = mock.MagicMock()
+        image.os_hash_algo = 'sha512'
+        image.os_hash_value = hashlib.sha512(data).hexdigest()
+        image.size = len(data)
+        throttle = mock.MagicMock()
+        with tempfile.NamedTemporaryFile() as f:
+            glance_retrofitter.download_image(
+                glance, image, open(f.name, 'w+b'), throttle=throttle)
+            self.assertEqual(f.read(), data)
+        throttle.consume.assert_has_calls(
+            [mock.call(len(chunk)) for chunk in chunks])
+
+    def test_image_digests(self):
         image = mock.MagicMock()
-        file_object = mock.MagicMock()
-        file_handle = mock.MagicMock()
-        file_object.__enter__.return_value = file_handle
-        glance_retrofitter.download_image(glance, image, file_object)
-        glance.images.data.assert_called_once_with(image.id)
-        file_handle.write.assert_has_calls([
-            mock.call('two'),
-            mock.call('Chunks'),
-        ])
+        image.os_hash_algo = 'sha512'
+        image.os_hash_value = 'ABC'
+        image.checksum = 'def'
+        self.assertEqual(glance_retrofitter.image_digests(image),
+                         {'sha512': 'abc'})
+        image.os_hash_value = None
+        self.assertEqual(glance_retrofitter.image_digests(image),
+                         {'md5': 'def'})
+        image.checksum = None
+        self.assertEqual(glance_retrofitter.image_digests(image), {})
+
+    def test_verify_digests(self):
+        self.patch_object(glance_retrofitter.ch_core.hookenv, 'log')
+        glance_retrofitter.verify_digests({'sha512': 'ABC'},
+                                          {'sha512': 'abc'}, 'x')
+        self.log.assert_not_called()
+        with self.assertRaises(glance_retrofitter.ChecksumMismatch):
+            glance_retrofitter.verify_digests({'sha512': 'abc'},
+                                              {'sha512': 'def'}, 'x')
+        glance_retrofitter.verify_digests({'sha512': 'abc'},
+                                          {'md5': 'def'}, 'x')
+        self.log.assert_called_once_with(
+            'Not verifying x: checksum reported by Glance (sha512) was not '
+            'computed (md5)', level=mock.ANY)
+
+    def test_upload_hash_algo(self):
+        self.assertEqual(
+            glance_retrofitter.upload_hash_algo({'sha256': 'abc'}), 'sha256')
+        self.assertEqual(
+            glance_retrofitter.upload_hash_algo({'md5': 'abc'}), 'sha512')
+        self.assertEqual(glance_retrofitter.upload_hash_algo({}), 'sha512')
+
+    def test_ordered_hasher(self):
+        hasher = glance_retrofitter.MultiHasher(('sha256',))
+        downloaded = mock.MagicMock()
+        ordered = glance_retrofitter.OrderedHasher(
+            hasher, offset=2, max_buffered=4, progress=downloaded)
+        ordered.update(6, b'gh')
+        ordered.update(4, b'ef')
+        self.assertEqual((ordered.offset, ordered.buffered), (2, 4))
+        downloaded.advance.assert_not_called()
+        # Writers ahead wait for buffer space, until data at the hashed
+        # offset arrives.
+        waiter = threading.Thread(target=ordered.update, args=(10, b'kl'))
+        waiter.start()
+        waiter.join(0.3)
+        self.assertTrue(waiter.is_alive())
+        ordered.update(2, b'cd')
+        waiter.join(5)
+        self.assertFalse(waiter.is_alive())
+        self.assertEqual((ordered.offset, ordered.buffered), (8, 2))
+        downloaded.advance.assert_called_once_with(8)
+        self.assertEqual(ordered.pending, {10: b'kl'})
+        ordered.abort()
+        with self.assertRaises(glance_retrofitter.TransferError):
+            ordered.update(20, b'x')
+        self.assertEqual(hasher.hexdigests(), {
+            'sha256': hashlib.sha256(b'cdefgh').hexdigest()})
+
+    def test_multi_hasher(self):
+        hasher = glance_retrofitter.MultiHasher(('md5', 'sha256', 'bogus'))
+        hasher.update(b'some')
+        hasher.update(b'Data')
+        self.assertEqual(hasher.hexdigests(), {
+            'md5': hashlib.md5(b'someData').hexdigest(),
+            'sha256': hashlib.sha256(b'someData').hexdigest(),
+        })
+
+    def test_import_methods(self):
+        glance = mock.MagicMock()
+        glance.images.get_import_info.return_value = {
+            'import-methods': {'type': 'array',
+                               'value': ['glance-direct', 'web-download']}}
+        self.assertEqual(glance_retrofitter.import_methods(glance),
+                         ['glance-direct', 'web-download'])
+        glance.images.get_import_info.side_effect = Exception('404')
+        self.assertEqual(glance_retrofitter.import_methods(glance), [])
+
+    def test_wait_for_import(self):
+        self.patch_object(glance_retrofitter.time, 'sleep')
+        glance = mock.MagicMock()
+        states = [
+            {'status': 'importing'},
+            {'status': 'active', 'os_glance_importing_to_stores': 'ceph'},
+            {'status': 'active', 'os_glance_importing_to_stores': ''},
+        ]
+        glance.images.get.side_effect = [
+            mock.MagicMock(os_glance_failed_import='', **state)
+            for state in states]
+        self.assertEqual(
+            glance_retrofitter.wait_for_import(glance, 'aId', interval=2,
+                                               max_interval=3).status,
+            'active')
+        self.sleep.assert_has_calls([mock.call(2), mock.call(3)])
+        glance.images.get.side_effect = None
+        glance.images.get.return_value = mock.MagicMock(
+            status='importing', os_glance_failed_import='ceph')
+        with self.assertRaises(glance_retrofitter.ImportFailed):
+            glance_retrofitter.wait_for_import(glance, 'aId')
+        glance.images.get.return_value = mock.MagicMock(
+            status='killed', os_glance_failed_import='')
+        with self.assertRaises(glance_retrofitter.ImportFailed):
+            glance_retrofitter.wait_for_import(glance, 'aId')
+        glance.images.get.return_value = mock.MagicMock(
+            status='importing', os_glance_failed_import='')
+        with self.assertRaises(glance_retrofitter.ImportFailed):
+            glance_retrofitter.wait_for_import(glance, 'aId', timeout=5)
+
+    def test_import_image(self):
+        self.patch_object(glance_retrofitter, 'wait_for_import')
+        glance = mock.MagicMock()
+        self.assertEqual(
+            glance_retrofitter.import_image(glance, 'aId', 'aFile'),
+            self.wait_for_import.return_value)
+        glance.images.stage.assert_called_once_with('aId', 'aFile')
+        glance.images.image_import.assert_called_once_with(
+            'aId', method='glance-direct')
+        self.wait_for_import.assert_called_once_with(glance, 'aId')
+        glance_retrofitter.import_image(glance, 'aId', 'aFile',
+                                        stores=('ceph', 'ceph-ssd'))
+        glance.images.image_import.assert_called_with(
+            'aId', method='glance-direct', stores=['ceph', 'ceph-ssd'],
+            allow_failure=False)
+        glance_retrofitter.import_image(glance, 'aId', 'aFile',
+                                        all_stores=True)
+        glance.images.image_import.assert_called_with(
+            'aId', method='glance-direct', all_stores=True,
+            allow_failure=False)
+
+    def test_get_stores(self):
+        glance = mock.MagicMock()
+        glance.images.get_stores_info_detail.return_value = {'stores': [
+            {'id': 'ceph', 'type': 'rbd', 'default': True},
+            {'id': 'local', 'type': 'file'}]}
+        self.assertEqual(glance_retrofitter.get_stores(glance), {
+            'ceph': {'id': 'ceph', 'type': 'rbd', 'default': True},
+            'local': {'id': 'local', 'type': 'file'}})
+        glance.images.get_stores_info_detail.side_effect = Exception('403')
+        glance.images.get_stores_info.return_value = {'stores': [
+            {'id': 'ceph', 'default': True}]}
+        self.assertEqual(glance_retrofitter.get_stores(glance), {
+            'ceph': {'id': 'ceph', 'default': True}})
+        glance.images.get_stores_info.side_effect = Exception('404')
+        self.assertEqual(glance_retrofitter.get_stores(glance), {})
@@ -0,0 +1,124 @@
+# Copyright 2022 Canonical Ltd
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#  http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import charms_openstack.test_utils as test_utils
+
+import charm.openstack.history as history
+
+MIB = 1024 * 1024
+
+
+def record(started, outcome='succeeded', download=10.0, status='created'):
+    return {'started': started, 'duration': download + 5.0,
+            'outcome': outcome,
+            'phases': {'auth': [0.5, 0], 'download': [download, 100 * MIB]},
+            'images': [['RegionOne', 'srcId', status, 'anId']]}
+
+
+class TestHistory(test_utils.PatchHelper):
+
+    def test_entry(self):
+        self.assertEqual(
+            history.entry({
+                'started': 1700000000.7, 'duration': 12.345,
+                'success': False, 'error': 'boom',
+                'phases': {'auth': {'seconds': 0.26, 'bytes': 0,
+                                    'count': 1}},
+                'images': [{'source': 'srcId', 'status': 'failed',
+                            'image-id': None, 'label': 'RegionOne'}]}),
+            {'started': 1700000000.7, 'duration': 12.3, 'outcome': 'failed',
+             'phases': {'auth': [0.3, 0]},
+             'images': [['RegionOne', 'srcId', 'failed', None]],
+             'error': 'boom'})
+        self.assertEqual(
+            history.entry({'started': 1700000000.5, 'duration': 2.0,
+                           'success': True, 'up-to-date': True,
+                           'phases': {}})['outcome'],
+            'up-to-date')
+
+    def test_append(self):
+        entries = []
+        for i in range(5):
+            entries = history.append(entries, {'started': i}, size=3)
+        self.assertEqual(entries, [{'started': 2}, {'started': 3},
+                                   {'started': 4}])
+
+    def test_percentile(self):
+        self.assertIsNone(history.percentile([], 50))
+        self.assertEqual(history.percentile([3], 95), 3)
+        self.assertEqual(history.percentile([4, 1, 3, 2], 50), 2.5)
+        self.assertAlmostEqual(history.percentile(range(1, 101), 95), 95.05)
+
+    def test_summary(self):
+        entries = [record(0, download=10.0), record(1, download=20.0),
+                   record(2, download=1000.0, outcome='failed'),
+                   record(3, download=0.0, status='up-to-date',
+                          outcome='up-to-date')]
+        entries[3]['phases'] = {'auth': [1.5, 0]}
+        stats = history.summary(entries)
+        self.assertEqual(sorted(stats), ['auth', 'download', 'total'])
+        self.assertEqual(stats['auth'],
+                         {'runs': 2, 'seconds': {50: 0.5, 95: 0.5}})
+        self.assertEqual(stats['download']['seconds'], {50: 15.0, 95: 19.5})
+        self.assertEqual(stats['download']['throughput'],
+                         {50: 7.5 * MIB, 95: 9.75 * MIB})
+        self.assertEqual(stats['total']['runs'], 2)
+        # Up to date runs recorded as succeeded count but for the total.
+        entries[3]['outcome'] = 'succeeded'
+        stats = history.summary(entries)
+        self.assertEqual(stats['auth']['runs'], 3)
+        self.assertEqual(stats['total']['runs'], 2)
+
+    def test_action_results(self):
+        entries = [record(1700000000, download=10.0),
+                   record(1700003600, download=20.0)]
+        entries.append(record(1700003600.25, status='up-to-date',
+                              outcome='up-to-date'))
+        entries[1]['error'] = 'boom'
+        entries[1]['outcome'] = 'failed'
+        entries[1]['images'].append(['jammy-amd64', None, 'not-found', None])
+        results = history.action_results(entries[:2], limit=1)
+        self.assertEqual(results, {
+            'summary.runs': '2',
+            'summary.failed': '1',
+            'summary.up-to-date': '0',
+            'summary.auth.runs': '1',
+            'summary.auth.p50': '0.5s',
+            'summary.auth.p95': '0.5s',
+            'summary.download.runs': '1',
+            'summary.download.p50': '10.0s',
+            'summary.download.p95': '10.0s',
+            'summary.download.throughput-p50': '10.0 MiB/s',
+            'summary.download.throughput-p95': '10.0 MiB/s',
+            'summary.total.runs': '1',
+            'summary.total.p50': '15.0s',
+            'summary.total.p95': '15.0s',
+            'runs.20231114-231320-000000.outcome': 'failed',
+            'runs.20231114-231320-000000.duration': '25.0s',
+            'runs.20231114-231320-000000.error': 'boom',
+            'runs.20231114-231320-000000.phases.auth': '0.5s',
+            'runs.20231114-231320-000000.phases.download': '20.0s, 100.0 MiB',
+            'runs.20231114-231320-000000.images.regionone': (
+                'created from srcId as anId'),
+            'runs.20231114-231320-000000.images.jammy-amd64': 'not-found',
+        })
+        # Runs started in the same second are listed separately.
+        results = history.action_results(entries, limit=0)
+        self.assertEqual(
+            sorted(key for key in results if key.endswith('.outcome')),
+            ['runs.20231114-221320-000000.outcome',
+             'runs.20231114-231320-000000.outcome',
+             'runs.20231114-231320-250000.outcome'])
+        self.assertEqual(results['summary.up-to-date'], '1')
+        self.assertEqual(results['summary.failed'], '1')
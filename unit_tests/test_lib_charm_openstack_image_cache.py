@@ -0,0 +1,136 @@
+# Copyright 2022 Canonical Ltd
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#  http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import os
+import tempfile
+import threading
+
+import charms_openstack.test_utils as test_utils
+
+import charm.openstack.image_cache as image_cache
+
+
+class FakeImage(object):
+
+    def __init__(self, **kwargs):
+        self.__dict__.update(kwargs)
+
+
+class TestImageCache(test_utils.PatchHelper):
+
+    def setUp(self):
+        super().setUp()
+        self.tmpdir = tempfile.TemporaryDirectory()
+        self.cache_dir = os.path.join(self.tmpdir.name, 'cache')
+        self.target = image_cache.ImageCache(self.cache_dir, 100)
+
+    def tearDown(self):
+        self.tmpdir.cleanup()
+        super().tearDown()
+
+    def _make_file(self, name, size):
+        path = os.path.join(self.tmpdir.name, name)
+        with open(path, 'wb') as f:
+            f.write(b'x' * size)
+        return path
+
+    def test_cache_key(self):
+        self.assertEqual(
+            image_cache.cache_key(FakeImage(os_hash_algo='sha512',
+                                            os_hash_value='ABC123',
+                                            checksum='def')),
+            'sha512-abc123')
+        self.assertEqual(
+            image_cache.cache_key(FakeImage(checksum='def456')),
+            'md5-def456')
+        self.assertIsNone(image_cache.cache_key(FakeImage()))
+        self.assertIsNone(
+            image_cache.cache_key(FakeImage(checksum='../etc/passwd')))
+
+    def test_insert_lookup(self):
+        self.assertIsNone(self.target.lookup('md5-aa'))
+        entry = self.target.insert('md5-aa', self._make_file('a', 10))
+        self.assertEqual(entry, os.path.join(self.cache_dir, 'md5-aa'))
+        self.assertEqual(self.target.lookup('md5-aa'), entry)
+        self.assertIsNone(self.target.lookup(None))
+        self.assertEqual(self.target.size(), 10)
+
+    def test_insert_evicts_least_recently_used(self):
+        self.target.insert('md5-aa', self._make_file('a', 40))
+        self.target.insert('md5-bb', self._make_file('b', 40))
+        os.utime(os.path.join(self.cache_dir, 'md5-aa'), (1, 1))
+        os.utime(os.path.join(self.cache_dir, 'md5-bb'), (2, 2))
+        self.target.lookup('md5-aa')
+        self.target.insert('md5-cc', self._make_file('c', 40))
+        self.assertIsNotNone(self.target.lookup('md5-aa'))
+        self.assertIsNone(self.target.lookup('md5-bb'))
+        self.assertIsNotNone(self.target.lookup('md5-cc'))
+        self.assertEqual(self.target.size(), 80)
+
+    def test_key_digests(self):
+        self.assertEqual(image_cache.key_digests('sha512-abc123'),
+                         {'sha512': 'abc123'})
+
+    def test_insert_verified(self):
+        path = self._make_file('a', 10)
+        self.patch_object(image_cache.ch_core.hookenv, 'log')
+        self.assertIsNone(
+            self.target.insert('md5-aa', path, digests={'md5': 'bb'}))
+        self.assertIsNone(
+            self.target.insert('md5-aa', path, digests={'sha512': 'aa'}))
+        self.assertIsNone(self.target.lookup('md5-aa'))
+        self.assertIsNotNone(
+            self.target.insert('md5-aa', path, digests={'md5': 'aa'}))
+
+    def test_insert_concurrent_instances(self):
+        # Each run creates its own instance, the lock file serializes
+        # eviction and insertion between them.
+        paths = [self._make_file(str(i), 30) for i in range(8)]
+        errors = []
+
+        def insert(i):
+            try:
+                image_cache.ImageCache(self.cache_dir, 100).insert(
+                    'md5-{:02x}'.format(i), paths[i])
+            except Exception as e:
+                errors.append(e)
+
+        threads = [threading.Thread(target=insert, args=(i,))
+                   for i in range(8)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        self.assertEqual(errors, [])
+        self.assertLessEqual(self.target.size(), 100)
+        self.assertTrue(os.path.exists(
+            os.path.join(self.cache_dir, image_cache.LOCK_FILE)))
+
+    def test_remove(self):
+        self.target.insert('md5-aa', self._make_file('a', 10))
+        self.target.remove('md5-aa')
+        self.assertIsNone(self.target.lookup('md5-aa'))
+        self.target.remove('md5-aa')
+        self.target.remove(None)
+
+    def test_insert_too_large(self):
+        self.assertIsNone(
+            self.target.insert('md5-aa', self._make_file('a', 101)))
+        self.assertEqual(self.target.size(), 0)
+
+    def test_disabled(self):
+        target = image_cache.ImageCache(self.cache_dir, 0)
+        self.assertIsNone(target.insert('md5-aa', self._make_file('a', 1)))
+        self.assertIsNone(target.lookup('md5-aa'))
+        self.assertFalse(os.path.exists(self.cache_dir))
@@ -0,0 +1,135 @@
+# Copyright 2022 Canonical Ltd
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#  http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import os
+import stat
+import tempfile
+
+import charms_openstack.test_utils as test_utils
+
+import charm.openstack.metrics as metrics
+
+
+class TestRunMetrics(test_utils.PatchHelper):
+
+    def test_phase(self):
+        run = metrics.RunMetrics()
+        with run.phase(metrics.DOWNLOAD) as phase:
+            phase.bytes = 100
+        with self.assertRaises(ValueError):
+            with run.phase(metrics.DOWNLOAD) as phase:
+                phase.bytes = 50
+                raise ValueError()
+        run.add(metrics.UPLOAD, 2.0, 10)
+        run.finish(True)
+        data = run.to_dict()
+        self.assertTrue(data['success'])
+        self.assertGreaterEqual(data['duration'], 0)
+        self.assertEqual(data['phases']['download']['bytes'], 150)
+        self.assertEqual(data['phases']['download']['count'], 2)
+        self.assertEqual(data['phases']['upload'],
+                         {'seconds': 2.0, 'bytes': 10, 'count': 1})
+
+    def test_finish_keeps_failure(self):
+        run = metrics.RunMetrics()
+        run.success = False
+        run.finish(True)
+        self.assertFalse(run.success)
+
+    def test_summary(self):
+        run = {'duration': 10.0, 'phases': {
+            'upload': {'seconds': 2.0, 'bytes': 4 * metrics.MIB},
+            'auth': {'seconds': 0.5, 'bytes': 0}}}
+        self.assertEqual(metrics.summary(run),
+                         'total 10.0s: auth 0.5s, upload 2.0s '
+                         '(4.0 MiB, 2.0 MiB/s)')
+
+    def test_render(self):
+        run = {'duration': 10.0, 'finished': 1700000000.5, 'success': True,
+               'phases': {
+                   'download': {'seconds': 4.0, 'bytes': 4096, 'count': 1},
+                   'auth': {'seconds': 0.25, 'bytes': 0, 'count': 1}}}
+        self.assertEqual(
+            metrics.render(run, last_success=1700000000.5).splitlines(), [
+                '# HELP octavia_diskimage_retrofit_phase_duration_seconds '
+                'Time spent in each phase of the last retrofit run.',
+                '# TYPE octavia_diskimage_retrofit_phase_duration_seconds '
+                'gauge',
+                'octavia_diskimage_retrofit_phase_duration_seconds'
+                '{phase="auth"} 0.250',
+                'octavia_diskimage_retrofit_phase_duration_seconds'
+                '{phase="download"} 4.000',
+                '# HELP octavia_diskimage_retrofit_phase_bytes Bytes '
+                'transferred or written in each phase of the last retrofit '
+                'run.',
+                '# TYPE octavia_diskimage_retrofit_phase_bytes gauge',
+                'octavia_diskimage_retrofit_phase_bytes{phase="auth"} 0',
+                'octavia_diskimage_retrofit_phase_bytes{phase="download"} '
+                '4096',
+                '# HELP octavia_diskimage_retrofit_phase_throughput_bytes_'
+                'per_second Throughput of each phase of the last retrofit '
+                'run.',
+                '# TYPE octavia_diskimage_retrofit_phase_throughput_bytes_'
+                'per_second gauge',
+                'octavia_diskimage_retrofit_phase_throughput_bytes_per_second'
+                '{phase="download"} 1024.000',
+                '# HELP octavia_diskimage_retrofit_last_run_duration_seconds '
+                'Duration of the last retrofit run.',
+                '# TYPE octavia_diskimage_retrofit_last_run_duration_seconds '
+                'gauge',
+                'octavia_diskimage_retrofit_last_run_duration_seconds 10.000',
+                '# HELP octavia_diskimage_retrofit_last_run_timestamp_seconds '
+                'Time the last retrofit run ended.',
+                '# TYPE octavia_diskimage_retrofit_last_run_timestamp_seconds '
+                'gauge',
+                'octavia_diskimage_retrofit_last_run_timestamp_seconds '
+                '1700000000.500',
+                '# HELP octavia_diskimage_retrofit_last_run_success Whether '
+                'the last retrofit run succeeded.',
+                '# TYPE octavia_diskimage_retrofit_last_run_success gauge',
+                'octavia_diskimage_retrofit_last_run_success 1',
+                '# HELP octavia_diskimage_retrofit_last_success_timestamp_'
+                'seconds Time the last successful retrofit run ended.',
+                '# TYPE octavia_diskimage_retrofit_last_success_timestamp_'
+                'seconds gauge',
+                'octavia_diskimage_retrofit_last_success_timestamp_seconds '
+                '1700000000.500',
+                '# HELP octavia_diskimage_retrofit_up_to_date Whether the '
+                'last retrofit run found all images up to date.',
+                '# TYPE octavia_diskimage_retrofit_up_to_date gauge',
+                'octavia_diskimage_retrofit_up_to_date 0',
+            ])
+        run.update({'up-to-date': True, 'last-up-to-date': 1700003600.0})
+        self.assertEqual(
+            metrics.render(run).splitlines()[-4:], [
+                'octavia_diskimage_retrofit_up_to_date 1',
+                '# HELP octavia_diskimage_retrofit_last_up_to_date_timestamp_'
+                'seconds Time the last retrofit run finding all images up to '
+                'date ended.',
+                '# TYPE octavia_diskimage_retrofit_last_up_to_date_timestamp_'
+                'seconds gauge',
+                'octavia_diskimage_retrofit_last_up_to_date_timestamp_seconds '
+                '1700003600.000',
+            ])
+
+    def test_write_textfile(self):
+        run = metrics.RunMetrics()
+        run.finish(False)
+        with tempfile.TemporaryDirectory() as tmpdir:
+            path = os.path.join(tmpdir, metrics.TEXTFILE_NAME)
+            metrics.write_textfile(path, run.to_dict())
+            self.assertEqual(os.listdir(tmpdir), [metrics.TEXTFILE_NAME])
+            self.assertEqual(stat.S_IMODE(os.stat(path).st_mode), 0o644)
+            with open(path) as f:
+                self.assertEqual(f.read(), metrics.render(run.to_dict()))
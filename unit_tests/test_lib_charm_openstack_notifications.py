@@ -0,0 +1,305 @@
+# Copyright 2022 Canonical Ltd
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#  http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import collections
+import json
+import os
+import socket
+import stat
+import tempfile
+from unittest import mock
+
+import charms_openstack.test_utils as test_utils
+
+import charm.openstack.notifications as notifications
+
+
+def notification(event_type='image.activate', status='active',
+                 product_name='com.ubuntu.cloud:server:24.04:amd64'):
+    """Build notification as sent by oslo.messaging."""
+    return {
+        'oslo.version': '2.0',
+        'oslo.message': json.dumps({
+            'event_type': event_type,
+            'payload': {'id': 'aId', 'status': status,
+                        'properties': {'product_name': product_name}},
+        }),
+    }
+
+
+class FakeClock(object):
+
+    def __init__(self):
+        self.now = 0.0
+
+    def __call__(self):
+        return self.now
+
+
+class FakeBroker(object):
+    """In memory stand-in for an AMQP broker and kombu connection.
+
+    Messages published before consuming are delivered by
+    ``drain_events``, which calls ``on_idle`` once the queue is empty.
+    """
+
+    def __init__(self, on_idle=None, error=None):
+        self.messages = collections.deque()
+        self.on_idle = on_idle
+        self.error = error
+        self.consumers = []
+        self.heartbeats = 0
+
+    def publish(self, body):
+        self.messages.append(body)
+
+    def Connection(self, url, **kwargs):
+        self.url = url
+        return self
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        return False
+
+    def ensure_connection(self, max_retries=None):
+        if self.error:
+            raise self.error
+
+    def Consumer(self, queues, callbacks=None, **kwargs):
+        self.consumers.append((queues, callbacks, kwargs))
+        return self
+
+    def drain_events(self, timeout=None):
+        if not self.messages:
+            if self.on_idle:
+                self.on_idle()
+            raise socket.timeout()
+        body = self.messages.popleft()
+        for callback in self.consumers[-1][1]:
+            callback(body, mock.MagicMock())
+
+    def heartbeat_check(self):
+        self.heartbeats += 1
+
+
+class TestNotifications(test_utils.PatchHelper):
+
+    def test_broker_url(self):
+        self.assertEqual(
+            notifications.broker_url(
+                'rabbit://u:p@10.0.0.1:5672,u:p@10.0.0.2:5672/openstack'),
+            'amqp://u:p@10.0.0.1:5672/openstack;'
+            'amqp://u:p@10.0.0.2:5672/openstack')
+        self.assertEqual(notifications.broker_url('memory://'), 'memory://')
+
+    def test_parse(self):
+        self.assertEqual(
+            notifications.parse(notification())[0], 'image.activate')
+        self.assertEqual(
+            notifications.parse(json.dumps({'event_type': 'image.update'})),
+            ('image.update', {}))
+        with self.assertRaises(ValueError):
+            notifications.parse('{')
+
+    def test_is_source_image_event(self):
+        def check(**kwargs):
+            return notifications.is_source_image_event(
+                *notifications.parse(notification(**kwargs)))
+
+        self.assertTrue(check())
+        self.assertTrue(check(event_type='image.update'))
+        self.assertTrue(check(
+            product_name='com.ubuntu.cloud.daily:server:24.04:amd64'))
+        self.assertFalse(check(event_type='image.delete'))
+        self.assertFalse(check(status='queued'))
+        self.assertFalse(check(product_name=None))
+        self.assertFalse(check(product_name='com.example:image'))
+        self.assertTrue(notifications.is_source_image_event(
+            'image.activate', {'status': 'active',
+                               'product_name': 'com.ubuntu.cloud:x'}))
+
+    def test_debouncer(self):
+        clock = FakeClock()
+        debouncer = notifications.Debouncer(10, clock=clock)
+        self.assertEqual(debouncer.max_delay, 50)
+        self.assertFalse(debouncer.due())
+        debouncer.trigger()
+        clock.now = 9
+        self.assertFalse(debouncer.due())
+        clock.now = 10
+        self.assertTrue(debouncer.due())
+        self.assertEqual(debouncer.take(), 1)
+        self.assertFalse(debouncer.due())
+        # A steady stream of events is acted on after max_delay.
+        for now in range(100, 160, 5):
+            clock.now = now
+            debouncer.trigger()
+            if now - 100 >= 50:
+                break
+            self.assertFalse(debouncer.due())
+        self.assertTrue(debouncer.due())
+        self.assertEqual(debouncer.take(), 11)
+
+
+class TestListener(test_utils.PatchHelper):
+
+    def setUp(self):
+        super().setUp()
+        self.patch_object(notifications.supervisor, 'log')
+        self.clock = FakeClock()
+        self.listener = notifications.Listener(
+            'rabbit://u:p@host:5672/openstack', ['retrofit'], debounce=10,
+            poll_interval=3600, reconnect_interval=0, clock=self.clock)
+        self.runs = []
+        self.patch_object(self.listener, 'start_run',
+                          new=self.runs.append)
+
+    def test_on_message(self):
+        self.listener.on_message(notification(), None)
+        self.listener.on_message(notification(status='queued'), None)
+        self.listener.on_message('{', None)
+        self.assertEqual(self.listener.debouncer.events, 1)
+
+    def test_tick(self):
+        self.listener.tick()
+        self.listener.on_message(notification(), None)
+        self.listener.on_message(notification(), None)
+        self.listener.tick()
+        self.assertEqual(self.runs, [])
+        self.clock.now = 10
+        self.listener.tick()
+        self.assertEqual(self.runs, ['2 notification(s)'])
+        # Notifications received during a run are acted on after it.
+        self.patch_object(self.listener, 'running', return_value=True)
+        self.listener.on_message(notification(), None)
+        self.clock.now = 20
+        self.listener.tick()
+        self.assertEqual(len(self.runs), 1)
+        self.running.return_value = False
+        self.listener.tick()
+        self.assertEqual(self.runs[-1], '1 notification(s)')
+
+    def test_poll(self):
+        self.listener.poll()
+        self.assertEqual(len(self.runs), 1)
+        self.listener.last_started = 0
+        self.clock.now = 3599
+        self.listener.poll()
+        self.assertEqual(len(self.runs), 1)
+        self.clock.now = 3600
+        self.listener.poll()
+        self.assertEqual(len(self.runs), 2)
+
+    def test_consume(self):
+        broker = FakeBroker(on_idle=self.listener.stop)
+        self.patch_object(notifications, 'kombu', new=broker)
+        broker.Exchange = mock.MagicMock()
+        broker.Queue = mock.MagicMock()
+        for _ in range(3):
+            broker.publish(notification())
+        broker.publish(notification(product_name='com.example:image'))
+        self.listener.retry_delay = 600
+        self.listener.consume()
+        self.assertEqual(broker.url, 'amqp://u:p@host:5672/openstack')
+        broker.Exchange.assert_called_once_with('glance', type='topic',
+                                                passive=True)
+        broker.Queue.assert_called_once_with(
+            notifications.QUEUE_NAME, exchange=broker.Exchange(),
+            routing_key='notifications.info', durable=False,
+            queue_arguments={'x-expires': notifications.QUEUE_EXPIRES})
+        self.assertEqual(broker.consumers[0][2],
+                         {'accept': ['json'], 'no_ack': True})
+        self.assertEqual(broker.heartbeats, 1)
+        self.assertEqual(self.listener.retry_delay, 0)
+        # The run catching up on connect coalesces with the notifications.
+        self.assertEqual(self.listener.debouncer.events, 4)
+        self.clock.now = 10
+        self.listener.tick()
+        self.assertEqual(self.runs, ['4 notification(s)'])
+
+    def test_consume_reconnect(self):
+        broker = FakeBroker(on_idle=self.listener.stop)
+        self.patch_object(notifications, 'kombu', new=broker)
+        broker.Exchange = mock.MagicMock()
+        broker.Queue = mock.MagicMock()
+        self.listener.last_started = 0
+        self.clock.now = 100
+        self.listener.consume()
+        # Catching up waits for catchup_interval since the last run.
+        self.clock.now = 899
+        self.listener.tick()
+        self.assertEqual(self.listener.debouncer.events, 0)
+        self.clock.now = 900
+        self.listener.tick()
+        self.clock.now = 910
+        self.listener.tick()
+        self.assertEqual(self.runs, ['1 notification(s)'])
+        self.assertFalse(self.listener.catchup)
+        # Any run started after connecting catches up as well.
+        self.listener.last_started = 910
+        self.listener.stopping.clear()
+        self.listener.consume()
+        self.assertTrue(self.listener.catchup)
+        self.patch_object(self.listener, 'run_command')
+        notifications.Listener.start_run(self.listener, '1 notification(s)')
+        self.listener.worker.join()
+        self.assertFalse(self.listener.catchup)
+        self.clock.now = 2000
+        self.listener.tick()
+        self.assertEqual(self.listener.debouncer.events, 0)
+
+    def test_run_unreachable(self):
+        broker = FakeBroker(error=ConnectionRefusedError('refused'))
+        self.patch_object(notifications, 'kombu', new=broker)
+
+        def start_run(reason):
+            self.runs.append(reason)
+            self.listener.stop()
+
+        self.patch_object(self.listener, 'start_run', new=start_run)
+        self.listener.retry_delay = 30
+        self.assertEqual(self.listener.run(), 0)
+        self.assertEqual(self.runs,
+                         ['notification bus unreachable, polling'])
+        self.assertIn('Notification bus unreachable, retrying in 30s',
+                      self.log.call_args_list[0][0][1])
+
+    def test_run_command(self):
+        self.patch_object(notifications.subprocess, 'call', return_value=1)
+        self.listener.cwd = '/charm'
+        self.listener.run_command()
+        self.call.assert_called_once_with(
+            ['retrofit'], cwd='/charm', stdin=mock.ANY, stdout=mock.ANY,
+            stderr=mock.ANY)
+        self.log.assert_called_once_with(
+            notifications.LOG_NAME, 'Retrofit ended with return code 1')
+
+
+class TestConfig(test_utils.PatchHelper):
+
+    def test_write_config_main(self):
+        tmpdir = tempfile.TemporaryDirectory()
+        self.addCleanup(tmpdir.cleanup)
+        path = os.path.join(tmpdir.name, 'etc', 'listener.json')
+        notifications.write_config({'url': 'memory://',
+                                    'command': ['retrofit']}, path)
+        self.assertEqual(stat.S_IMODE(os.stat(path).st_mode), 0o600)
+        self.patch_object(notifications, 'Listener')
+        self.Listener().run.return_value = 0
+        self.patch_object(notifications.signal, 'signal')
+        self.assertEqual(notifications.main(['listener', path]), 0)
+        self.Listener.assert_called_with(url='memory://',
+                                         command=['retrofit'])
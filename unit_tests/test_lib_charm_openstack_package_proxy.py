@@ -0,0 +1,206 @@
+# Copyright 2022 Canonical Ltd
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#  http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import http.server
+import os
+import tempfile
+import threading
+import urllib.error
+import urllib.request
+
+import charms_openstack.test_utils as test_utils
+
+import charm.openstack.image_cache as image_cache
+import charm.openstack.package_proxy as package_proxy
+
+
+class MirrorHandler(http.server.BaseHTTPRequestHandler):
+    """Archive mirror, or forward proxy when requests carry absolute URLs."""
+
+    def log_message(self, *args):
+        pass
+
+    def do_GET(self):
+        self.server.requests.append(self.path)
+        path = self.path.split('/', 3)[-1] if '://' in self.path else (
+            self.path.lstrip('/'))
+        if path not in self.server.files:
+            self.send_error(404)
+            return
+        body, etag = self.server.files[path]
+        if self.headers.get('If-None-Match') == etag:
+            self.send_response(304)
+            self.end_headers()
+            return
+        self.send_response(200)
+        self.send_header('ETag', etag)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+
+class TestPackageProxy(test_utils.PatchHelper):
+
+    def setUp(self):
+        super().setUp()
+        self.patch_object(package_proxy.ch_core.hookenv, 'log')
+        self.patch_object(image_cache.ch_core.hookenv, 'log')
+        self.tmpdir = tempfile.TemporaryDirectory()
+        self.cache = image_cache.ImageCache(
+            os.path.join(self.tmpdir.name, 'cache'), 1024 * 1024)
+        self.mirror = self._start_server(MirrorHandler)
+        self.mirror.files = {
+            'ubuntu/pool/main/h/haproxy/haproxy_2.4_amd64.deb':
+                (b'deb' * 100, '"deb1"'),
+            'ubuntu/dists/jammy/InRelease': (b'release1', '"rel1"'),
+        }
+        self.mirror_url = 'http://127.0.0.1:{}/ubuntu'.format(
+            self.mirror.server_address[1])
+
+    def tearDown(self):
+        self.tmpdir.cleanup()
+        super().tearDown()
+
+    def _start_server(self, handler):
+        server = http.server.ThreadingHTTPServer(('127.0.0.1', 0), handler)
+        server.requests = []
+        threading.Thread(target=server.serve_forever, daemon=True).start()
+        self.addCleanup(server.server_close)
+        self.addCleanup(server.shutdown)
+        return server
+
+    def _get(self, proxy, path, token=None):
+        with package_proxy.serve(proxy) as port:
+            proxy_url = proxy.url('127.0.0.1', port)
+            if token is not None:
+                proxy_url = proxy_url.replace(proxy.token, token)
+            opener = urllib.request.build_opener(urllib.request.ProxyHandler(
+                {'http': proxy_url}))
+            with opener.open(self.mirror_url + path, timeout=10) as resp:
+                return resp.read()
+
+    def test_guest_reaches_host(self):
+        self.assertTrue(package_proxy.guest_reaches_host({}))
+        self.assertTrue(package_proxy.guest_reaches_host(
+            {'LIBGUESTFS_BACKEND': 'direct'}))
+        self.assertFalse(package_proxy.guest_reaches_host(
+            {'LIBGUESTFS_BACKEND': 'libvirt:qemu:///system'}))
+
+    def test_authentication_required(self):
+        proxy = package_proxy.PackageProxy(self.cache)
+        with self.assertRaises(urllib.error.HTTPError) as cm:
+            self._get(proxy, '/dists/jammy/InRelease', token='wrong')
+        self.assertEqual(cm.exception.code, 407)
+        self.assertEqual(self.mirror.requests, [])
+        self.assertEqual(proxy.stats['denied'], 1)
+        self.assertEqual(self._get(proxy, '/dists/jammy/InRelease'),
+                         b'release1')
+
+    def test_is_cacheable(self):
+        self.assertTrue(package_proxy.is_cacheable(
+            'http://archive/ubuntu/pool/main/h/haproxy/haproxy_2.4_amd64.deb'))
+        self.assertTrue(package_proxy.is_cacheable(
+            'http://archive/ubuntu/dists/jammy/main/binary-amd64/Packages.xz'))
+        self.assertTrue(package_proxy.is_cacheable(
+            'http://archive/ubuntu/dists/jammy/main/binary-amd64/by-hash/'
+            'SHA256/abc123'))
+        self.assertFalse(package_proxy.is_cacheable(
+            'http://archive/ubuntu/project/ubuntu-archive-keyring.gpg'))
+        self.assertTrue(package_proxy.is_immutable(
+            'http://archive/ubuntu/pool/main/h/haproxy/haproxy_2.4_amd64.deb'))
+        self.assertFalse(package_proxy.is_immutable(
+            'http://archive/ubuntu/dists/jammy/InRelease'))
+
+    def test_package_served_from_cache(self):
+        proxy = package_proxy.PackageProxy(self.cache)
+        path = '/pool/main/h/haproxy/haproxy_2.4_amd64.deb'
+        self.assertEqual(self._get(proxy, path), b'deb' * 100)
+        self.assertEqual(self._get(proxy, path), b'deb' * 100)
+        self.assertEqual(len(self.mirror.requests), 1)
+        self.assertEqual(proxy.stats, {'miss': 1, 'hit': 1})
+        # the validators are an entry of their own
+        key = package_proxy.url_key(self.mirror_url + path)
+        meta = self.cache.lookup(package_proxy.meta_key(key))
+        self.assertEqual(self.cache.size(), 300 + os.path.getsize(meta))
+        self.assertEqual(sorted(os.listdir(self.cache.path)),
+                         sorted([image_cache.LOCK_FILE, key,
+                                 package_proxy.meta_key(key)]))
+
+    def test_evicted_validators(self):
+        proxy = package_proxy.PackageProxy(self.cache)
+        path = '/pool/main/h/haproxy/haproxy_2.4_amd64.deb'
+        self._get(proxy, path)
+        key = package_proxy.url_key(self.mirror_url + path)
+        self.cache.remove(package_proxy.meta_key(key))
+        self.assertEqual(self._get(proxy, path), b'deb' * 100)
+        self.assertEqual(proxy.stats, {'miss': 2})
+        self.cache.max_bytes = 0
+        self.cache.evict()
+        self.assertEqual(os.listdir(self.cache.path), [image_cache.LOCK_FILE])
+
+    def test_index_revalidated(self):
+        proxy = package_proxy.PackageProxy(self.cache)
+        self.assertEqual(self._get(proxy, '/dists/jammy/InRelease'),
+                         b'release1')
+        self.assertEqual(self._get(proxy, '/dists/jammy/InRelease'),
+                         b'release1')
+        self.assertEqual(proxy.stats, {'miss': 1, 'revalidated': 1})
+        self.mirror.files['ubuntu/dists/jammy/InRelease'] = (
+            b'release2', '"rel2"')
+        self.assertEqual(self._get(proxy, '/dists/jammy/InRelease'),
+                         b'release2')
+        self.assertEqual(self._get(proxy, '/dists/jammy/InRelease'),
+                         b'release2')
+        self.assertEqual(proxy.stats,
+                         {'miss': 2, 'revalidated': 2})
+        self.assertEqual(len(self.mirror.requests), 4)
+
+    def test_stale_index_served_when_mirror_unreachable(self):
+        proxy = package_proxy.PackageProxy(self.cache)
+        self._get(proxy, '/dists/jammy/InRelease')
+        self.mirror.shutdown()
+        self.mirror.server_close()
+        self.assertEqual(self._get(proxy, '/dists/jammy/InRelease'),
+                         b'release1')
+        self.assertEqual(proxy.stats['stale'], 1)
+        with self.assertRaises(urllib.error.HTTPError) as cm:
+            self._get(proxy, '/dists/jammy/Release')
+        self.assertEqual(cm.exception.code, 502)
+
+    def test_not_cacheable_passed_through(self):
+        self.mirror.files['ubuntu/keyring.gpg'] = (b'key', '"key1"')
+        proxy = package_proxy.PackageProxy(self.cache)
+        self.assertEqual(self._get(proxy, '/keyring.gpg'), b'key')
+        self.assertEqual(self._get(proxy, '/keyring.gpg'), b'key')
+        self.assertEqual(len(self.mirror.requests), 2)
+        self.assertEqual(self.cache.size(), 0)
+        with self.assertRaises(urllib.error.HTTPError) as cm:
+            self._get(proxy, '/missing.deb')
+        self.assertEqual(cm.exception.code, 404)
+
+    def test_upstream_proxy(self):
+        upstream = self._start_server(MirrorHandler)
+        upstream.files = self.mirror.files
+        proxy = package_proxy.PackageProxy(
+            self.cache,
+            upstream='http://127.0.0.1:{}'.format(upstream.server_address[1]))
+        self._get(proxy, '/dists/jammy/InRelease')
+        self.assertEqual(upstream.requests,
+                         [self.mirror_url + '/dists/jammy/InRelease'])
+        self.assertEqual(self.mirror.requests, [])
+        proxy.no_proxy = '127.0.0.1'
+        self._get(proxy, '/dists/jammy/InRelease')
+        self.assertEqual(len(upstream.requests), 1)
+        self.assertEqual(self.mirror.requests,
+                         ['/ubuntu/dists/jammy/InRelease'])
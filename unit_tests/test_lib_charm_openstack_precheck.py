@@ -0,0 +1,224 @@
+# Copyright 2022 Canonical Ltd
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#  http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+from unittest import mock
+import os
+import stat
+import tempfile
+
+import charms_openstack.test_utils as test_utils
+
+import charm.openstack.precheck as precheck
+
+STATE = {
+    'credentials': {'username': 'aUser', 'password': 'aPassword'},
+    'region': 'aRegion',
+    'endpoint-type': 'publicURL',
+    'releases': ['22.04', '24.04'],
+    'config': {
+        'ubuntu-mirror': '',
+        'uca-mirror': '',
+        'image-format': 'qcow2',
+        'import-stores': '',
+        'retrofit-uca-pocket': '',
+    },
+}
+
+
+class TestPrecheck(test_utils.PatchHelper):
+
+    def test_get_snap_revision(self):
+        self.patch_object(precheck.os, 'readlink')
+        self.readlink.return_value = '42'
+        self.assertEqual(precheck.get_snap_revision(), '42')
+        self.readlink.assert_called_once_with(precheck.SNAP_CURRENT)
+        self.readlink.side_effect = OSError
+        self.assertIsNone(precheck.get_snap_revision())
+
+    def test_uca_pocket_for_release(self):
+        self.assertEqual(precheck.uca_pocket_for_release('', '18.04'),
+                         'ussuri')
+        self.assertEqual(precheck.uca_pocket_for_release('yoga', '18.04'),
+                         'yoga')
+        self.assertIsNone(precheck.uca_pocket_for_release('', '22.04'))
+
+    def test_retrofit_fingerprint(self):
+        source_image = mock.MagicMock()
+        source_image.id = 'aId'
+        source_image.os_hash_algo = None
+        source_image.checksum = None
+        fingerprint = precheck.retrofit_fingerprint(
+            source_image, None, STATE['config'], '42')
+        self.assertEqual(
+            precheck.retrofit_fingerprint(source_image, None,
+                                          STATE['config'], '42'),
+            fingerprint)
+        self.assertNotEqual(
+            precheck.retrofit_fingerprint(source_image, None,
+                                          STATE['config'], '43'),
+            fingerprint)
+        source_image.id = 'otherId'
+        self.assertNotEqual(
+            precheck.retrofit_fingerprint(source_image, None,
+                                          STATE['config'], '42'),
+            fingerprint)
+        # With 'auto' the chosen format is fingerprinted, not the setting.
+        config = dict(STATE['config'], **{'image-format': 'auto'})
+        self.assertEqual(
+            precheck.retrofit_fingerprint(source_image, None, config, '42',
+                                          disk_format='qcow2'),
+            precheck.retrofit_fingerprint(source_image, None,
+                                          STATE['config'], '42'))
+        self.assertNotEqual(
+            precheck.retrofit_fingerprint(source_image, None, config, '42',
+                                          disk_format='raw'),
+            precheck.retrofit_fingerprint(source_image, None,
+                                          STATE['config'], '42'))
+
+    def test_disk_format(self):
+        self.patch_object(precheck, 'glance_retrofitter')
+        config = dict(STATE['config'])
+        self.assertEqual(precheck.disk_format('aGlance', config), 'qcow2')
+        self.glance_retrofitter.get_stores.assert_not_called()
+        config['image-format'] = 'auto'
+        self.glance_retrofitter.get_stores.return_value = {
+            'ceph': {'id': 'ceph', 'default': True, 'type': 'rbd'},
+            'file': {'id': 'file', 'type': 'file'},
+        }
+        self.assertEqual(precheck.disk_format('aGlance', config), 'raw')
+        config['import-stores'] = 'file'
+        self.assertEqual(precheck.disk_format('aGlance', config), 'qcow2')
+        # Without store types the source image location is used.
+        self.glance_retrofitter.get_stores.return_value = {
+            'default': {'id': 'default', 'default': True}}
+        config['import-stores'] = ''
+        source_image = mock.MagicMock()
+        source_image.direct_url = 'rbd://fsid/glance/aId/snap'
+        self.assertEqual(
+            precheck.disk_format('aGlance', config, source_image), 'raw')
+        self.assertEqual(precheck.disk_format('aGlance', config), 'qcow2')
+
+    def test_read_write_state(self):
+        with tempfile.TemporaryDirectory() as tmpdir:
+            path = os.path.join(tmpdir, 'sub', 'state.json')
+            self.assertIsNone(precheck.read_state(path))
+            self.assertTrue(precheck.write_state(STATE, path))
+            self.assertEqual(stat.S_IMODE(os.stat(path).st_mode), 0o600)
+            self.assertEqual(precheck.read_state(path), STATE)
+            self.assertFalse(precheck.write_state(STATE, path))
+            with open(path, 'w') as f:
+                f.write('garbage')
+            self.assertIsNone(precheck.read_state(path))
+
+    def test_work_pending(self):
+        self.patch_object(precheck, 'glance_retrofitter')
+        self.patch_object(precheck, 'token_cache')
+        self.patch_object(precheck, 'retrofit_fingerprint')
+        self.patch_object(precheck, 'get_snap_revision')
+        glance = self.glance_retrofitter.get_glance_client.return_value
+        source_image = mock.MagicMock()
+        self.glance_retrofitter.find_source_image.side_effect = [
+            None, source_image]
+        self.glance_retrofitter.find_destination_image.return_value = []
+        self.assertTrue(precheck.work_pending(STATE))
+        keystone_cache = self.token_cache.TokenCache.return_value
+        self.glance_retrofitter.session_from_credentials.\
+            assert_called_once_with(STATE['credentials'],
+                                    token_cache=keystone_cache)
+        self.glance_retrofitter.get_glance_client.assert_called_once_with(
+            self.glance_retrofitter.session_from_credentials(),
+            endpoint_type='publicURL', region='aRegion',
+            token_cache=keystone_cache)
+        self.glance_retrofitter.discover_source_images.\
+            assert_called_once_with(glance, ['22.04', '24.04'])
+        self.retrofit_fingerprint.assert_called_once_with(
+            source_image, None, STATE['config'],
+            self.get_snap_revision(), disk_format='qcow2')
+        self.glance_retrofitter.find_destination_image.\
+            assert_called_once_with(
+                glance, source_image.product_name, source_image.version_name,
+                fingerprint=self.retrofit_fingerprint())
+        self.glance_retrofitter.find_source_image.side_effect = None
+        self.glance_retrofitter.find_source_image.return_value = \
+            source_image
+        self.glance_retrofitter.find_destination_image.return_value = [
+            'aImage']
+        self.assertFalse(precheck.work_pending(STATE))
+        self.glance_retrofitter.find_source_image.return_value = None
+        self.assertFalse(precheck.work_pending(STATE))
+
+    def test_work_pending_batch(self):
+        self.patch_object(precheck, 'glance_retrofitter')
+        self.patch_object(precheck, 'token_cache')
+        self.patch_object(precheck, 'retrofit_fingerprint')
+        self.patch_object(precheck, 'get_snap_revision')
+        glance = self.glance_retrofitter.get_glance_client.return_value
+        state = dict(STATE, batch=[['22.04', 'amd64'], ['22.04', 'arm64'],
+                                   ['24.04', 'arm64']])
+        arm64_image = mock.MagicMock()
+        self.glance_retrofitter.find_source_image.side_effect = (
+            lambda index, release, arch=None: (
+                arm64_image if arch == 'arm64' else None))
+        self.glance_retrofitter.find_destination_image.side_effect = [
+            ['aImage'], []]
+        self.assertTrue(precheck.work_pending(state))
+        self.glance_retrofitter.discover_source_images.\
+            assert_called_once_with(glance, ['22.04', '24.04'],
+                                    architectures=['amd64', 'arm64'])
+        self.assertEqual(
+            self.glance_retrofitter.find_destination_image.call_count, 2)
+        self.glance_retrofitter.find_destination_image.side_effect = None
+        self.glance_retrofitter.find_destination_image.return_value = [
+            'aImage']
+        self.assertFalse(precheck.work_pending(state))
+
+    def test_work_pending_regions(self):
+        self.patch_object(precheck, 'glance_retrofitter')
+        self.patch_object(precheck, 'token_cache')
+        self.patch_object(precheck, 'retrofit_fingerprint')
+        self.patch_object(precheck, 'get_snap_revision')
+        glances = {'RegionOne': mock.MagicMock(),
+                   'RegionTwo': mock.MagicMock()}
+        self.glance_retrofitter.get_glance_client.side_effect = (
+            lambda session, endpoint_type, region, token_cache: (
+                glances[region]))
+        published = {glances['RegionOne']: ['aImage'],
+                     glances['RegionTwo']: []}
+        self.glance_retrofitter.find_destination_image.side_effect = (
+            lambda glance, product, version, fingerprint: published[glance])
+        state = dict(STATE, region='RegionOne',
+                     regions=['RegionOne', 'RegionTwo'])
+        self.assertTrue(precheck.work_pending(state))
+        self.glance_retrofitter.discover_source_images.\
+            assert_called_once_with(glances['RegionOne'], ['22.04', '24.04'])
+        published[glances['RegionTwo']] = ['aImage']
+        self.assertFalse(precheck.work_pending(state))
+
+    def test_main(self):
+        self.patch_object(precheck, 'read_state')
+        self.patch_object(precheck, 'work_pending')
+        self.read_state.return_value = None
+        self.assertEqual(precheck.main(['retrofit-precheck.py']),
+                         precheck.EXIT_WORK_PENDING)
+        self.work_pending.assert_not_called()
+        self.read_state.return_value = STATE
+        self.work_pending.return_value = False
+        self.assertEqual(precheck.main(['retrofit-precheck.py']),
+                         precheck.EXIT_NO_WORK)
+        self.work_pending.return_value = True
+        self.assertEqual(precheck.main(['retrofit-precheck.py']),
+                         precheck.EXIT_WORK_PENDING)
+        self.work_pending.side_effect = Exception('unreachable')
+        self.assertEqual(precheck.main(['retrofit-precheck.py']),
+                         precheck.EXIT_WORK_PENDING)
@@ -0,0 +1,151 @@
+# Copyright 2022 Canonical Ltd
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#  http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import os
+import tempfile
+import tracemalloc
+
+import charms_openstack.test_utils as test_utils
+
+import charm.openstack.profiling as profiling
+
+
+def busy():
+    return [bytearray(1024) for _ in range(1024)]
+
+
+class TestProfiling(test_utils.PatchHelper):
+
+    def setUp(self):
+        super().setUp()
+        self.tmpdir = tempfile.TemporaryDirectory()
+        self.addCleanup(self.tmpdir.cleanup)
+
+    def profile(self, name='retrofit'):
+        profile = profiling.Profile(name)
+        profile.start()
+        try:
+            data = busy()
+        finally:
+            profile.stop()
+        del data
+        return profile
+
+    def test_profile(self):
+        profile = self.profile()
+        self.assertFalse(tracemalloc.is_tracing())
+        self.assertGreaterEqual(profile.peak_memory, 1024 * 1024)
+        self.assertGreaterEqual(profile.duration, 0)
+        allocations = profile.allocations(limit=1)
+        self.assertEqual(len(allocations), 1)
+        self.assertIn('test_lib_charm_openstack_profiling.py',
+                      allocations[0][0])
+        self.assertGreaterEqual(allocations[0][1], 1024 * 1024)
+
+    def test_profile_tracing(self):
+        tracemalloc.start()
+        self.addCleanup(tracemalloc.stop)
+        self.profile()
+        self.assertTrue(tracemalloc.is_tracing())
+
+    def test_dump_last_profile(self):
+        self.assertIsNone(profiling.last_profile(self.tmpdir.name))
+        self.assertIsNone(profiling.last_profile(
+            os.path.join(self.tmpdir.name, 'missing')))
+        directory = os.path.join(self.tmpdir.name, 'profiles')
+        profile = self.profile()
+        # A run of the same name started in the same second does not
+        # overwrite the profile.
+        earlier = self.profile()
+        earlier.started = profile.started = int(profile.started)
+        profile.started += 0.5
+        earlier_path = earlier.dump(directory)
+        path = profile.dump(directory)
+        self.assertTrue(path.endswith('-500000-retrofit.json'))
+        self.assertTrue(earlier_path.endswith('-000000-retrofit.json'))
+        self.assertTrue(os.path.exists(earlier_path))
+        base = path[:-len(profiling.SUMMARY_SUFFIX)]
+        self.assertTrue(os.path.exists(base + profiling.PSTATS_SUFFIX))
+        with open(base + profiling.ALLOCATIONS_SUFFIX) as f:
+            self.assertIn('test_lib_charm_openstack_profiling.py', f.read())
+        # An incomplete later profile is skipped.
+        with open(os.path.join(directory,
+                               '99999999-000000-000000-retrofit.json'),
+                  'w') as f:
+            f.write('{')
+        summary = profiling.last_profile(directory)
+        self.assertEqual(summary['name'], 'retrofit')
+        self.assertEqual(summary['peak-memory'], profile.peak_memory)
+        self.assertEqual(summary['pstats'], base + profiling.PSTATS_SUFFIX)
+
+        functions = profiling.hottest_functions(summary['pstats'], limit=50)
+        self.assertLessEqual(len(functions), 50)
+        self.assertTrue(any('busy' in function[0] for function in functions))
+        cumulative = [function[3] for function in functions]
+        self.assertEqual(cumulative, sorted(cumulative, reverse=True))
+        functions = profiling.hottest_functions(
+            summary['pstats'], sort=profiling.SORT_TOTTIME)
+        tottime = [function[2] for function in functions]
+        self.assertEqual(tottime, sorted(tottime, reverse=True))
+        with self.assertRaises(ValueError):
+            profiling.hottest_functions(summary['pstats'], sort='calls')
+
+    def test_prune(self):
+        self.assertEqual(profiling.prune(
+            os.path.join(self.tmpdir.name, 'missing')), [])
+        for stem in ('20260101-000000-a', '20260102-000000-b',
+                     '20260103-000000-c'):
+            for suffix in profiling.SUFFIXES:
+                open(os.path.join(self.tmpdir.name, stem + suffix),
+                     'w').close()
+        # Incomplete profile without summary.
+        open(os.path.join(self.tmpdir.name,
+                          '20260100-000000-x.pstats'), 'w').close()
+        open(os.path.join(self.tmpdir.name, 'unrelated'), 'w').close()
+        self.assertEqual(profiling.prune(self.tmpdir.name, keep=2),
+                         ['20260100-000000-x', '20260101-000000-a'])
+        self.assertEqual(sorted(os.listdir(self.tmpdir.name)), [
+            '20260102-000000-b.allocations.txt',
+            '20260102-000000-b.json',
+            '20260102-000000-b.pstats',
+            '20260103-000000-c.allocations.txt',
+            '20260103-000000-c.json',
+            '20260103-000000-c.pstats',
+            'unrelated',
+        ])
+
+    def test_action_results(self):
+        summary = {
+            'name': 'retrofit',
+            'started': 0,
+            'duration': 12.34,
+            'peak-memory': 3 * profiling.MIB,
+            'pstats': '/tmp/x.pstats',
+            'allocations': [['a.py:1', profiling.MIB, 10],
+                            ['b.py:2', 1024, 1]],
+        }
+        functions = [('a.py:1(f)', 3, 1.0, 2.5)]
+        self.assertEqual(
+            profiling.action_results(summary, functions, limit=1), {
+                'profile.name': 'retrofit',
+                'profile.started': '1970-01-01 00:00:00',
+                'profile.duration': '12.3s',
+                'profile.peak-memory': '3.0 MiB',
+                'profile.pstats': '/tmp/x.pstats',
+                'functions.01': '2.500s cumulative, 1.000s own, 3 calls: '
+                                'a.py:1(f)',
+                'allocations.01': '1.0 MiB in 10 blocks: a.py:1',
+            })
+        self.assertIn('allocations.02',
+                      profiling.action_results(summary, functions))
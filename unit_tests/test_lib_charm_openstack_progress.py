@@ -0,0 +1,105 @@
+# Copyright 2022 Canonical Ltd
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#  http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import io
+
+import charms_openstack.test_utils as test_utils
+
+import charm.openstack.progress as progress
+
+
+class TestProgressMeter(test_utils.PatchHelper):
+
+    def setUp(self):
+        super().setUp()
+        self.now = 100.0
+        self.patch_object(progress.time, 'monotonic',
+                          new=lambda: self.now)
+        self.reports = []
+
+    def test_format_duration(self):
+        self.assertEqual(progress.format_duration(42.4), '42s')
+        self.assertEqual(progress.format_duration(185), '3m05s')
+        self.assertEqual(progress.format_duration(3720), '1h02m')
+
+    def test_report(self):
+        meter = progress.ProgressMeter('Downloading x',
+                                       total=100 * progress.MIB,
+                                       report=self.reports.append,
+                                       interval=10)
+        self.now += 5
+        meter.update(10 * progress.MIB)
+        self.assertEqual(self.reports, [])
+        self.now += 5
+        meter.update(10 * progress.MIB)
+        self.assertEqual(self.reports,
+                         ['Downloading x: 20% at 2.0 MiB/s, 40s left'])
+        # A new attempt continues from the position it resumes at.
+        meter.restart(50 * progress.MIB)
+        self.now += 20
+        meter.update(10 * progress.MIB)
+        self.assertEqual(self.reports[-1],
+                         'Downloading x: 60% at 0.5 MiB/s, 1m20s left')
+
+    def test_report_unknown_total(self):
+        meter = progress.ProgressMeter('Uploading x',
+                                       report=self.reports.append,
+                                       interval=10)
+        self.now += 10
+        meter.update(30 * progress.MIB)
+        self.assertEqual(self.reports, ['Uploading x: 30 MiB at 3.0 MiB/s'])
+        self.assertEqual(meter.message(0),
+                         'Uploading x: 30 MiB at 0.0 MiB/s')
+        meter.total = 60 * progress.MIB
+        self.assertEqual(meter.message(0),
+                         'Uploading x: 50% at 0.0 MiB/s, unknown time left')
+
+    def test_stall(self):
+        meter = progress.ProgressMeter('Downloading x', min_rate=1000,
+                                       stall_timeout=60)
+        self.now += 59
+        meter.update(10)
+        self.now += 1
+        meter.update(60000)
+        self.now += 60
+        meter.update(60000)
+        self.now += 60
+        with self.assertRaises(progress.TransferStalled):
+            meter.update(100)
+        meter.restart()
+        meter.update(100)
+
+    def test_stall_disabled(self):
+        meter = progress.ProgressMeter('Downloading x', stall_timeout=60)
+        self.now += 3600
+        meter.update(1)
+
+    def test_progress_reporter(self):
+        reporter = progress.ProgressReporter(self.reports.append,
+                                             interval=10)
+        reporter('Examining the guest')
+        self.now += 9
+        reporter('Installing packages')
+        self.now += 1
+        reporter('Finishing off')
+        self.assertEqual(self.reports,
+                         ['Examining the guest', 'Finishing off'])
+
+    def test_metered_reader(self):
+        meter = progress.ProgressMeter('Uploading x')
+        reader = progress.MeteredReader(io.BytesIO(b'x' * 30), meter)
+        self.assertEqual(reader.read(20), b'x' * 20)
+        self.assertEqual(reader.read(), b'x' * 10)
+        self.assertEqual(reader.read(), b'')
+        self.assertEqual(meter.position, 30)
@@ -0,0 +1,64 @@
+# Copyright 2022 Canonical Ltd
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#  http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import io
+
+import charms_openstack.test_utils as test_utils
+
+import charm.openstack.ratelimit as ratelimit
+
+
+class TestRateLimit(test_utils.PatchHelper):
+
+    def setUp(self):
+        super().setUp()
+        self.now = 100.0
+        self.patch_object(ratelimit.time, 'monotonic',
+                          new=lambda: self.now)
+        self.patch_object(ratelimit.time, 'sleep')
+
+    def test_token_bucket(self):
+        bucket = ratelimit.TokenBucket(1000)
+        self.assertEqual(bucket.consume(1000), 0.0)
+        self.assertEqual(bucket.consume(500), 0.5)
+        self.sleep.assert_called_once_with(0.5)
+        # A second consumer queues up behind the debt of the first.
+        self.assertEqual(bucket.consume(500), 1.0)
+        self.now += 10
+        self.assertEqual(bucket.consume(1000), 0.0)
+
+    def test_token_bucket_burst(self):
+        bucket = ratelimit.TokenBucket(1000, burst=4000)
+        self.assertEqual(bucket.consume(4000), 0.0)
+        self.now += 1
+        self.assertEqual(bucket.consume(2000), 1.0)
+
+    def test_throttled_reader(self):
+        bucket = ratelimit.TokenBucket(10)
+        reader = ratelimit.ThrottledReader(io.BytesIO(b'x' * 30), bucket)
+        self.assertEqual(reader.read(20), b'x' * 20)
+        self.sleep.assert_called_once_with(1.0)
+        self.assertEqual(reader.read(), b'x' * 10)
+        self.assertEqual(reader.read(), b'')
+
+    def test_shared_bucket(self):
+        self.assertIsNone(ratelimit.shared_bucket(ratelimit.DOWNLOAD, 0))
+        self.assertIsNone(ratelimit.shared_bucket(ratelimit.DOWNLOAD, None))
+        bucket = ratelimit.shared_bucket(ratelimit.DOWNLOAD, 1000)
+        self.assertIs(ratelimit.shared_bucket(ratelimit.DOWNLOAD, 1000),
+                      bucket)
+        self.assertIsNot(ratelimit.shared_bucket(ratelimit.UPLOAD, 1000),
+                         bucket)
+        self.assertEqual(
+            ratelimit.shared_bucket(ratelimit.DOWNLOAD, 2000).rate, 2000)
@@ -0,0 +1,134 @@
+# Copyright 2022 Canonical Ltd
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#  http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+from unittest import mock
+import json
+import os
+import tempfile
+import time
+
+import charms_openstack.test_utils as test_utils
+
+import charm.openstack.scratch as scratch
+
+
+class TestScratchSpace(test_utils.PatchHelper):
+
+    def setUp(self):
+        super().setUp()
+        self.patch_object(scratch.ch_core.hookenv, 'log')
+        self.tmpdir = tempfile.TemporaryDirectory()
+        self.addCleanup(self.tmpdir.cleanup)
+        self.path = os.path.join(self.tmpdir.name, 'tmp')
+        self.scratch = scratch.ScratchSpace(self.path)
+
+    def _write(self, name, size=0):
+        path = os.path.join(self.path, name)
+        with open(path, 'wb') as f:
+            f.write(b'x' * size)
+        return path
+
+    def _set_owner(self, name, pid):
+        manifest_path = os.path.join(self.path, scratch.MANIFEST_FILE)
+        with open(manifest_path) as f:
+            manifest = json.load(f)
+        manifest[name]['pid'] = pid
+        with open(manifest_path, 'w') as f:
+            json.dump(manifest, f)
+
+    def test_space_needed(self):
+        image = mock.MagicMock(size=100, virtual_size=1000)
+        self.assertEqual(scratch.space_needed(image), 300)
+        self.assertEqual(scratch.space_needed(image, ['qcow2', 'qcow2']),
+                         300)
+        self.assertEqual(scratch.space_needed(image, ['raw']), 1100)
+        self.assertEqual(scratch.space_needed(image, ['raw'], cached=True),
+                         1000)
+        image.virtual_size = None
+        self.assertEqual(scratch.space_needed(image, ['raw', 'qcow2']),
+                         700)
+
+    def test_allocate_release(self):
+        path = self.scratch.allocate()
+        self.assertEqual(os.path.dirname(path), self.path)
+        self.assertTrue(os.path.exists(path))
+        manifest = self._write(os.path.basename(path) + '.manifest')
+        self.scratch.release(path)
+        self.assertFalse(os.path.exists(path))
+        self.assertFalse(os.path.exists(manifest))
+        # releasing again and releasing untracked paths are no-ops
+        self.scratch.release(path)
+        untracked = self._write('untracked')
+        self.scratch.release(untracked)
+        self.assertTrue(os.path.exists(untracked))
+        with tempfile.NamedTemporaryFile() as f:
+            self.scratch.release(f.name)
+            self.assertTrue(os.path.exists(f.name))
+
+    def test_sweep(self):
+        own = self.scratch.allocate()
+        dead = self.scratch.allocate()
+        self._write(os.path.basename(dead) + '.manifest')
+        self._set_owner(os.path.basename(dead), 2 ** 22 + 1)
+        partial = os.path.join(self.path, 'download-aId')
+        self.scratch.track(partial, resumable=True)
+        self._write('download-aId')
+        self._write('download-aId.journal')
+        self._set_owner('download-aId', 2 ** 22 + 1)
+        stale = os.path.join(self.path, 'download-oldId')
+        self.scratch.track(stale, resumable=True)
+        self._write('download-oldId')
+        old = time.time() - scratch.RESUMABLE_MAX_AGE - 1
+        os.utime(stale, (old, old))
+        self._write('tmpleaked')
+        os.mkdir(os.path.join(self.path, 'subdir'))
+        self.assertEqual(
+            sorted(self.scratch.sweep()),
+            sorted([os.path.basename(dead),
+                    os.path.basename(dead) + '.manifest',
+                    'download-oldId', 'tmpleaked']))
+        self.assertEqual(
+            sorted(os.listdir(self.path)),
+            sorted([scratch.LOCK_FILE, scratch.MANIFEST_FILE,
+                    os.path.basename(own), 'download-aId',
+                    'download-aId.journal', 'subdir']))
+        with open(os.path.join(self.path, scratch.MANIFEST_FILE)) as f:
+            self.assertEqual(sorted(json.load(f)),
+                             sorted([os.path.basename(own), 'download-aId']))
+
+    def test_admit(self):
+        self.patch_object(scratch.batch, 'free_space')
+        self.free_space.return_value = 10000
+        self.scratch.admit(10000)
+        with self.assertRaises(scratch.ScratchSpaceExhausted):
+            self.scratch.admit(10001)
+        partial = os.path.join(self.path, 'download-aId')
+        self.scratch.track(partial, resumable=True)
+        self._write('download-aId', 65536)
+        other = os.path.join(self.path, 'download-otherId')
+        self.scratch.track(other, resumable=True)
+        self._write('download-otherId', 65536)
+        self.scratch.quota = self.scratch.usage() + 1000
+        self.free_space.return_value = None
+        self.assertEqual(self.scratch.available(), 1000)
+        # the data of the kept partial download is not asked for again
+        self.scratch.admit(65536 + 1000, keep=[partial])
+        self.assertTrue(os.path.exists(other))
+        # resumable files of other images make room, the kept one stays
+        self.scratch.admit(65536 + 2000, keep=[partial])
+        self.assertTrue(os.path.exists(partial))
+        self.assertFalse(os.path.exists(other))
+        with self.assertRaises(scratch.ScratchSpaceExhausted):
+            self.scratch.admit(self.scratch.quota + 65536, keep=[partial])
+        self.assertTrue(os.path.exists(partial))
@@ -0,0 +1,94 @@
+# Copyright 2022 Canonical Ltd
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#  http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import os
+import tempfile
+
+import charms_openstack.test_utils as test_utils
+
+import charm.openstack.sizing as sizing
+
+
+class TestSizing(test_utils.PatchHelper):
+
+    def setUp(self):
+        super().setUp()
+        self.tmpdir = tempfile.TemporaryDirectory()
+        self.addCleanup(self.tmpdir.cleanup)
+
+    def write(self, name, content):
+        path = os.path.join(self.tmpdir.name, name)
+        with open(path, 'w') as f:
+            f.write(content)
+        return path
+
+    def test_host_cpus(self):
+        self.patch_object(sizing.os, 'sched_getaffinity')
+        self.sched_getaffinity.return_value = set(range(64))
+        self.patch_object(sizing, 'CGROUP_CPU_MAX',
+                          new=self.write('cpu.max', 'max 100000\n'))
+        self.assertEqual(sizing.host_cpus(), 64)
+        self.write('cpu.max', '200000 100000\n')
+        self.assertEqual(sizing.host_cpus(), 2)
+        self.write('cpu.max', '50000 100000\n')
+        self.assertEqual(sizing.host_cpus(), 1)
+
+    def test_available_memory(self):
+        self.patch_object(sizing, 'MEMINFO', new=self.write(
+            'meminfo', 'MemTotal: 16384000 kB\nMemAvailable: 8192000 kB\n'))
+        self.patch_object(sizing, 'CGROUP_MEMORY_MAX',
+                          new=self.write('memory.max', 'max\n'))
+        self.patch_object(sizing, 'CGROUP_MEMORY_CURRENT',
+                          new=self.write('memory.current', '1048576\n'))
+        self.assertEqual(sizing.available_memory(), 8000)
+        self.write('memory.max', '{}\n'.format(3 * 1024 * 1024 * 1024))
+        self.assertEqual(sizing.available_memory(), 3071)
+        os.unlink(sizing.MEMINFO)
+        os.unlink(sizing.CGROUP_MEMORY_MAX)
+        self.assertIsNone(sizing.available_memory())
+
+    def test_plan(self):
+        # small container without KVM
+        self.assertEqual(sizing.plan(2, 2048, False), {
+            'memsize': 1024, 'smp': 2, 'backend': 'tcg'})
+        # large host shared between build workers
+        self.assertEqual(sizing.plan(64, 262144, True, workers=4), {
+            'memsize': 4096, 'smp': 8, 'backend': 'kvm'})
+        self.assertEqual(sizing.plan(8, 12288, True, workers=4), {
+            'memsize': 1536, 'smp': 2, 'backend': 'kvm'})
+        # memory starved hosts get the minimum, unknown memory the maximum
+        self.assertEqual(sizing.plan(1, 512, True)['memsize'],
+                         sizing.MIN_MEMSIZE)
+        self.assertEqual(sizing.plan(1, None, True)['memsize'],
+                         sizing.MAX_MEMSIZE)
+        # config overrides
+        self.assertEqual(
+            sizing.plan(2, 2048, False, memsize=3000, smp=6, backend='kvm'),
+            {'memsize': 3000, 'smp': 6, 'backend': 'kvm'})
+
+    def test_environment(self):
+        self.assertEqual(
+            sizing.environment({'memsize': 2048, 'smp': 2, 'backend': 'kvm'}),
+            {'LIBGUESTFS_MEMSIZE': '2048'})
+        self.assertEqual(
+            sizing.environment({'memsize': 1024, 'smp': 2, 'backend': 'tcg'}),
+            {'LIBGUESTFS_MEMSIZE': '1024',
+             'LIBGUESTFS_BACKEND_SETTINGS': 'force_tcg'})
+
+    def test_action_results(self):
+        self.assertEqual(
+            sizing.action_results({'memsize': 1024, 'smp': 2,
+                                   'backend': 'tcg'}),
+            {'appliance.memsize': '1024', 'appliance.smp': '2',
+             'appliance.backend': 'tcg'})
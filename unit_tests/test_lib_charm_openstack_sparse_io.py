@@ -0,0 +1,75 @@
+# Copyright 2022 Canonical Ltd
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#  http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import errno
+import os
+import tempfile
+
+import charms_openstack.test_utils as test_utils
+
+import charm.openstack.sparse_io as sparse_io
+
+BS = sparse_io.BLOCK_SIZE
+
+
+class TestSparseIO(test_utils.PatchHelper):
+
+    def setUp(self):
+        super().setUp()
+        self.tmpfile = tempfile.NamedTemporaryFile()
+
+    def tearDown(self):
+        self.tmpfile.close()
+        super().tearDown()
+
+    def test_data_runs(self):
+        data = b'a' * BS + bytes(2 * BS) + b'b' + bytes(BS)
+        self.assertEqual(list(sparse_io.data_runs(data)), [
+            (0, BS, False),
+            (BS, 2 * BS, True),
+            (3 * BS, BS + 1, False),
+        ])
+        self.assertEqual(list(sparse_io.data_runs(bytes(BS))),
+                         [(0, BS, True)])
+        self.assertEqual(list(sparse_io.data_runs(b'')), [])
+
+    def test_write_sparse(self):
+        fd = self.tmpfile.fileno()
+        data = b'a' * BS + bytes(2 * BS) + b'b' * 10
+        os.ftruncate(fd, 64 * BS)
+        self.assertEqual(sparse_io.write_sparse(fd, data, BS), 2 * BS)
+        self.assertEqual(os.pread(fd, len(data), BS), data)
+        self.assertEqual(os.pread(fd, BS, 0), bytes(BS))
+        self.assertEqual(os.fstat(fd).st_size, 64 * BS)
+
+    def test_sparse_reader(self):
+        fd = self.tmpfile.fileno()
+        os.pwrite(fd, b'a' * BS, 0)
+        os.pwrite(fd, b'b' * BS, 64 * BS)
+        os.ftruncate(fd, 128 * BS)
+        reader = sparse_io.SparseReader(self.tmpfile)
+        chunks = list(iter(lambda: reader.read(16 * BS), b''))
+        self.assertEqual(b''.join(chunks),
+                         b'a' * BS + bytes(63 * BS) + b'b' * BS +
+                         bytes(63 * BS))
+        self.assertEqual(reader.read(), b'')
+
+    def test_sparse_reader_no_seek_data(self):
+        self.tmpfile.write(b'abc')
+        self.tmpfile.flush()
+        self.patch_object(sparse_io.os, 'lseek')
+        self.lseek.side_effect = OSError(errno.EINVAL, '')
+        reader = sparse_io.SparseReader(self.tmpfile)
+        self.assertEqual(reader.read(2), b'ab')
+        self.assertEqual(reader.read(), b'c')
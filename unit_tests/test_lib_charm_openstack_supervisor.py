@@ -0,0 +1,101 @@
+# Copyright 2022 Canonical Ltd
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#  http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import os
+import subprocess
+import tempfile
+import time
+
+import charms_openstack.test_utils as test_utils
+
+import charm.openstack.supervisor as supervisor
+
+
+class TestSupervisor(test_utils.PatchHelper):
+
+    def setUp(self):
+        super().setUp()
+        self.tmpdir = tempfile.TemporaryDirectory()
+        self.addCleanup(self.tmpdir.cleanup)
+        self.log_file = os.path.join(self.tmpdir.name, 'log', 'tool.log')
+
+    def test_parse_progress(self):
+        self.assertEqual(
+            supervisor.parse_progress('[  12.3] Installing packages: a b '),
+            'Installing packages: a b')
+        self.assertEqual(
+            supervisor.parse_progress('[   0.0] Examining the guest ...'),
+            'Examining the guest ...')
+        self.assertIsNone(supervisor.parse_progress('libguestfs: trace'))
+        self.assertIsNone(supervisor.parse_progress('[  12.3]'))
+
+    def test_limit_resources(self):
+        cmd = ['octavia-diskimage-retrofit', 'in', 'out']
+        self.assertEqual(supervisor.limit_resources(cmd), cmd)
+        self.assertEqual(
+            supervisor.limit_resources(cmd, niceness=10,
+                                       ionice_class='idle'),
+            ['ionice', '-c', '3', 'nice', '-n', '10'] + cmd)
+        self.assertEqual(
+            supervisor.limit_resources(cmd, cpu_weight=20, io_weight=10),
+            ['systemd-run', '--scope', '--quiet', '--collect',
+             '--property', 'CPUWeight=20', '--property', 'IOWeight=10'] +
+            cmd)
+
+    def test_run(self):
+        progress = []
+        output = supervisor.run(
+            ['sh', '-c', 'echo "[   0.0] Examining the guest"; '
+                         'for i in $(seq 1 50); do echo line $i; done; '
+                         'echo "[   1.5] Finishing off" >&2'],
+            name='anImage', on_progress=progress.append,
+            log_file=self.log_file, tail_lines=3)
+        self.assertEqual(output,
+                         'line 49\nline 50\n[   1.5] Finishing off')
+        self.assertEqual(progress,
+                         ['Examining the guest', 'Finishing off'])
+        with open(self.log_file) as f:
+            log = f.read()
+        self.assertIn('anImage: line 1\n', log)
+        self.assertIn('anImage: line 50\n', log)
+        self.assertIn('anImage: Exited with 0\n', log)
+
+    def test_run_failure(self):
+        with self.assertRaises(subprocess.CalledProcessError) as ctx:
+            supervisor.run(
+                ['sh', '-c', 'echo one; echo two; echo three; exit 3'],
+                log_file=self.log_file, tail_lines=2)
+        self.assertEqual(ctx.exception.returncode, 3)
+        self.assertEqual(ctx.exception.output, 'two\nthree')
+
+    def test_run_timeout_kills_process_group(self):
+        pid_file = os.path.join(self.tmpdir.name, 'child.pid')
+        start = time.monotonic()
+        with self.assertRaises(subprocess.TimeoutExpired) as ctx:
+            supervisor.run(
+                ['sh', '-c', 'sleep 60 & echo $! > {}; echo started; wait'
+                 .format(pid_file)],
+                timeout=0.5, log_file=self.log_file)
+        self.assertLess(time.monotonic() - start, 10)
+        self.assertEqual(ctx.exception.output, 'started')
+        with open(pid_file) as f:
+            child = int(f.read())
+        for _ in range(50):
+            try:
+                os.kill(child, 0)
+            except ProcessLookupError:
+                break
+            time.sleep(0.1)
+        else:
+            self.fail('child of timed out process still running')
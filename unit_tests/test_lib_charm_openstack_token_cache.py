@@ -0,0 +1,100 @@
+# Copyright 2022 Canonical Ltd
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#  http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+from unittest import mock
+import datetime
+import os
+import stat
+import tempfile
+
+import charms_openstack.test_utils as test_utils
+
+import charm.openstack.token_cache as token_cache
+
+CREDENTIALS = {'username': 'aUser', 'password': 'aPassword'}
+
+
+class TestTokenCache(test_utils.PatchHelper):
+
+    def setUp(self):
+        super().setUp()
+        self.tmpdir = tempfile.TemporaryDirectory()
+        self.path = os.path.join(self.tmpdir.name, 'token-cache.json')
+
+    def tearDown(self):
+        self.tmpdir.cleanup()
+        super().tearDown()
+
+    def _auth(self, expires_in):
+        auth = mock.MagicMock()
+        auth.get_auth_state.return_value = '{"auth_token": "aToken"}'
+        auth.auth_ref.expires = (
+            datetime.datetime.now(datetime.timezone.utc) + expires_in)
+        return auth
+
+    def test_credentials_key(self):
+        self.assertEqual(
+            token_cache.credentials_key(CREDENTIALS),
+            token_cache.credentials_key(dict(reversed(CREDENTIALS.items()))))
+        self.assertNotEqual(
+            token_cache.credentials_key(CREDENTIALS),
+            token_cache.credentials_key({'username': 'aUser'}))
+
+    def test_restore_update(self):
+        cache = token_cache.TokenCache(self.path)
+        auth = self._auth(datetime.timedelta(hours=1))
+        self.assertFalse(cache.restore(auth, CREDENTIALS))
+        self.assertIsNone(cache.endpoint('aRegion', 'publicURL'))
+        cache.update(auth, 'aRegion', 'publicURL', 'https://glance:9292')
+        self.assertEqual(stat.S_IMODE(os.stat(self.path).st_mode), 0o600)
+
+        cache = token_cache.TokenCache(self.path)
+        new_auth = mock.MagicMock()
+        self.assertTrue(cache.restore(new_auth, CREDENTIALS))
+        new_auth.set_auth_state.assert_called_once_with(
+            '{"auth_token": "aToken"}')
+        self.assertEqual(cache.endpoint('aRegion', 'publicURL'),
+                         'https://glance:9292')
+        self.assertIsNone(cache.endpoint('aRegion', 'internalURL'))
+
+    def test_restore_expiring(self):
+        cache = token_cache.TokenCache(self.path)
+        cache.restore(mock.MagicMock(), CREDENTIALS)
+        cache.update(self._auth(datetime.timedelta(minutes=2)),
+                     'aRegion', 'publicURL', 'https://glance:9292')
+        cache = token_cache.TokenCache(self.path)
+        new_auth = mock.MagicMock()
+        self.assertFalse(cache.restore(new_auth, CREDENTIALS))
+        new_auth.set_auth_state.assert_not_called()
+        self.assertIsNone(cache.endpoint('aRegion', 'publicURL'))
+
+    def test_restore_credentials_changed(self):
+        cache = token_cache.TokenCache(self.path)
+        cache.restore(mock.MagicMock(), CREDENTIALS)
+        cache.update(self._auth(datetime.timedelta(hours=1)),
+                     'aRegion', 'publicURL', 'https://glance:9292')
+        cache = token_cache.TokenCache(self.path)
+        new_auth = mock.MagicMock()
+        self.assertFalse(cache.restore(
+            new_auth, dict(CREDENTIALS, password='newPassword')))
+        new_auth.set_auth_state.assert_not_called()
+        self.assertIsNone(cache.endpoint('aRegion', 'publicURL'))
+
+    def test_update_unauthenticated(self):
+        cache = token_cache.TokenCache(self.path)
+        cache.restore(mock.MagicMock(), CREDENTIALS)
+        auth = mock.MagicMock()
+        auth.get_auth_state.return_value = None
+        cache.update(auth, 'aRegion', 'publicURL', 'https://glance:9292')
+        self.assertFalse(os.path.exists(self.path))
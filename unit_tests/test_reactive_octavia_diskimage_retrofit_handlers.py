@@ -37,17 +37,35 @@ class TestRegisteredHooks(test_utils.TestRegisteredHooks):
                     'identity-credentials.available',),
                 'build': (
                     'octavia-diskimage-retrofit.build',),
+                'prewarm_appliance': (
+                    'snap.installed.octavia-diskimage-retrofit',),
+                'precheck_config_changed': (
+                    'config.changed',),
             },
             'when_any': {
                 'retrofit_by_cron': (
                     'config.changed.auto-retrofit',
-                    'config.changed.frequency',),
+                    'config.changed.frequency',
+                    'config.changed.notification-transport-url',
+                    'config.changed.notification-exchange',
+                    'config.changed.notification-topic',
+                    'config.changed.notification-debounce',),
             },
             'when_not': {
                 'request_credentials': (
                     'identity-credentials.available',),
                 'snap_install': (
                     'snap.installed.octavia-diskimage-retrofit',),
+                'prewarm_appliance': (
+                    'octavia-diskimage-retrofit.appliance.prewarm',),
+                'credentials_available': (
+                    'octavia-diskimage-retrofit.precheck-state',),
+            },
+            'hook': {
+                'snap_refreshed': ('upgrade-charm',),
+                'precheck_state_changed': (
+                    'identity-credentials-relation-changed',
+                    'upgrade-charm',),
             },
         }
         # test that the hooks were registered via the
@@ -77,8 +95,38 @@ class TestOctaviaDiskimageRetrofitHandlers(test_utils.PatchHelper):
         self.charm_instance.assess_status.assert_called_once_with()
 
     def test_credentials_available(self):
+        self.patch_object(handlers, 'set_flag')
+        self.patch_object(handlers.reactive, 'endpoint_from_flag')
+        self.endpoint_from_flag.return_value = 'endpoint'
         handlers.credentials_available()
+        self.endpoint_from_flag.assert_called_once_with(
+            'identity-credentials.available')
+        self.charm_instance.update_precheck_state.assert_called_once_with(
+            'endpoint')
         self.charm_instance.assess_status.assert_called_once_with()
+        self.set_flag.assert_called_once_with(
+            'octavia-diskimage-retrofit.precheck-state')
+
+    def test_precheck_state_changed(self):
+        self.patch_object(handlers, 'clear_flag')
+        handlers.precheck_state_changed()
+        handlers.precheck_config_changed()
+        self.clear_flag.assert_has_calls([
+            mock.call('octavia-diskimage-retrofit.precheck-state'),
+            mock.call('octavia-diskimage-retrofit.precheck-state')])
+
+    def test_prewarm_appliance(self):
+        self.patch_object(handlers, 'set_flag')
+        handlers.prewarm_appliance()
+        self.charm_instance.prewarm_appliance.assert_called_once_with()
+        self.set_flag.assert_called_once_with(
+            'octavia-diskimage-retrofit.appliance.prewarm')
+
+    def test_snap_refreshed(self):
+        self.patch_object(handlers, 'clear_flag')
+        handlers.snap_refreshed()
+        self.clear_flag.assert_called_once_with(
+            'octavia-diskimage-retrofit.appliance.prewarm')
 
 
 class TestValidateSnapRisk(unittest.TestCase):